@@ -3,7 +3,7 @@ Interface abstracta para proveedores de identidad.
 Define el contrato que debe cumplir cualquier proveedor (Keycloak, Auth0, etc.)
 """
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from typing import Any, Dict, Iterable, List, Optional
 from pydantic import BaseModel
 
 
@@ -85,3 +85,79 @@ class IdentityProvider(ABC):
     def remove_role(self, user_id: str, role: str) -> bool:
         """Remueve un rol de un usuario"""
         pass
+    
+    def get_users_roles(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Roles de varios usuarios en bloque (vacío si el proveedor no lo soporta)"""
+        return {}
+    
+    def invalidate_user(self, user_id: str) -> None:
+        """Revoca los tokens ya emitidos del usuario y descarta lo cacheado (tokens verificados, etc.)"""
+        pass
+
+
+class AsyncIdentityProvider(ABC):
+    """
+    Variante asíncrona de IdentityProvider.
+    Permite mantener muchas llamadas al proveedor en vuelo desde el event loop
+    sin ocupar hilos del threadpool de Starlette.
+    """
+    
+    @abstractmethod
+    async def login(self, username: str, password: str) -> TokenResponse:
+        """Autentica usuario y retorna tokens"""
+        pass
+    
+    @abstractmethod
+    async def decode_token(self, token: str) -> UserInfo:
+        """Decodifica y valida token, retorna info del usuario"""
+        pass
+    
+    @abstractmethod
+    async def refresh_token(self, refresh_token: str) -> TokenResponse:
+        """Refresca el access token"""
+        pass
+    
+    @abstractmethod
+    async def create_user(
+        self,
+        username: str,
+        email: str,
+        password: str,
+        first_name: str = "",
+        last_name: str = ""
+    ) -> UserInfo:
+        """Crea un nuevo usuario en el proveedor"""
+        pass
+    
+    @abstractmethod
+    async def get_user_by_id(self, user_id: str) -> UserInfo:
+        """Obtiene información de un usuario por ID"""
+        pass
+    
+    @abstractmethod
+    async def update_user(self, user_id: str, **kwargs) -> UserInfo:
+        """Actualiza información del usuario"""
+        pass
+    
+    @abstractmethod
+    async def delete_user(self, user_id: str) -> bool:
+        """Elimina un usuario"""
+        pass
+    
+    @abstractmethod
+    async def assign_role(self, user_id: str, role: str) -> bool:
+        """Asigna un rol a un usuario"""
+        pass
+    
+    @abstractmethod
+    async def remove_role(self, user_id: str, role: str) -> bool:
+        """Remueve un rol de un usuario"""
+        pass
+    
+    async def get_users_roles(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Roles de varios usuarios en bloque (vacío si el proveedor no lo soporta)"""
+        return {}
+    
+    def invalidate_user(self, user_id: str) -> None:
+        """Revoca los tokens ya emitidos del usuario y descarta lo cacheado (tokens verificados, etc.)"""
+        pass
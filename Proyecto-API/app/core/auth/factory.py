@@ -3,14 +3,19 @@ Factory para crear el proveedor de identidad según configuración.
 Permite cambiar de proveedor sin modificar el código de negocio.
 """
 import os
-from app.core.auth.base import IdentityProvider
+from functools import lru_cache
+from app.core.auth.base import IdentityProvider, AsyncIdentityProvider
 from app.core.auth.providers.keycloak import KeycloakProvider
+from app.core.auth.providers.keycloak_async import AsyncKeycloakProvider
 
 
+@lru_cache(maxsize=1)
 def get_identity_provider() -> IdentityProvider:
     """
     Factory que retorna el proveedor de identidad configurado.
     Cambia fácilmente entre Keycloak, Auth0, Cognito, etc.
+    La instancia es única por proceso para que sus cachés (JWKS, etc.)
+    se reutilicen entre peticiones.
     """
     provider_type = os.getenv("IDENTITY_PROVIDER", "keycloak").lower()
     
@@ -23,3 +28,17 @@ def get_identity_provider() -> IdentityProvider:
         )
     else:
         raise ValueError(f"Unknown identity provider: {provider_type}")
+
+
+@lru_cache(maxsize=1)
+def get_async_identity_provider() -> AsyncIdentityProvider:
+    """
+    Factory del proveedor de identidad asíncrono.
+    Comparte cachés con la instancia síncrona del mismo proceso.
+    """
+    provider = get_identity_provider()
+    
+    if isinstance(provider, KeycloakProvider):
+        return AsyncKeycloakProvider(provider)
+    else:
+        raise ValueError(f"No async implementation for provider: {type(provider).__name__}")
@@ -0,0 +1,122 @@
+"""
+Almacén de claves públicas (JWKS) del proveedor de identidad.
+Indexa las claves por `kid`, las refresca en segundo plano y sigue
+sirviendo las claves antiguas si el proveedor no responde.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSKeyStore:
+    """
+    Caché de claves JWKS con TTL.
+
+    - Las claves se indexan por `kid` (búsqueda O(1) por petición).
+    - Un hilo en segundo plano refresca el conjunto antes de que caduque.
+    - Un `kid` desconocido fuerza como mucho un refetch cada
+      `min_refetch_interval` segundos (rotación de claves).
+    - Si el proveedor cae, se siguen usando las claves caducadas
+      (stale-while-revalidate).
+    """
+
+    def __init__(
+        self,
+        fetch_jwks: Callable[[], Dict[str, Any]],
+        ttl: float = 300.0,
+        min_refetch_interval: float = 10.0,
+        background_refresh: bool = True
+    ):
+        self._fetch_jwks = fetch_jwks
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.background_refresh = background_refresh
+
+        self._keys: Dict[str, Dict[str, Any]] = {}
+        self._fetched_at: float = 0.0
+        self._last_attempt: float = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _index_keys(jwks: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Convierte la respuesta JWKS en un dict kid -> clave RSA"""
+        keys = {}
+        for key in jwks.get("keys", []):
+            if "kid" not in key or key.get("use", "sig") != "sig":
+                continue
+            keys[key["kid"]] = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"]
+            }
+        return keys
+
+    def refresh(self) -> bool:
+        """Descarga el JWKS. Devuelve False si falla (se conservan las claves previas)"""
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        try:
+            keys = self._index_keys(self._fetch_jwks())
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo refrescar el JWKS: {e}")
+            return False
+
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return True
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def get_key(self, kid: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Devuelve la clave para `kid` o None si no existe"""
+        self._ensure_background_refresh()
+
+        if not self._keys:
+            if self._can_refetch():
+                self.refresh()
+        elif self.is_stale() and self._can_refetch():
+            # Servir la clave antigua y refrescar en segundo plano
+            self._wakeup.set()
+
+        key = self._keys.get(kid)
+        if key is not None or kid is None:
+            return key
+
+        # kid desconocido: posible rotación, un único refetch forzado
+        if self._can_refetch():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def _can_refetch(self) -> bool:
+        return time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    def has_keys(self) -> bool:
+        return bool(self._keys)
+
+    def _ensure_background_refresh(self):
+        if not self.background_refresh or (self._thread and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._refresh_loop, name="jwks-refresh", daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        delay = self.ttl * 0.8
+        while True:
+            # Refrescar al 80% del TTL, o antes si una petición vio claves caducadas
+            self._wakeup.wait(timeout=delay)
+            self._wakeup.clear()
+            # Si el proveedor no responde, reintentar pronto
+            delay = self.ttl * 0.8 if self.refresh() else self.min_refetch_interval
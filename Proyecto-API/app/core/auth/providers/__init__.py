@@ -2,5 +2,6 @@
 Proveedores de identidad disponibles
 """
 from app.core.auth.providers.keycloak import KeycloakProvider
+from app.core.auth.providers.keycloak_async import AsyncKeycloakProvider
 
-__all__ = ["KeycloakProvider"]
+__all__ = ["KeycloakProvider", "AsyncKeycloakProvider"]
@@ -2,13 +2,24 @@
 Implementación del proveedor Keycloak.
 Adapta la API de Keycloak a nuestra interfaz genérica.
 """
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from jose import jwt, JWTError
-from functools import lru_cache
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List, Optional, Set
+from urllib.parse import quote
 from fastapi import HTTPException, status
 
 from app.core.auth.base import IdentityProvider, UserInfo, TokenResponse
+from app.core.auth.jwks import JWKSKeyStore
+from app.core.auth.role_index import RoleIndex
+from app.core.auth.token_cache import TokenCache
+
+# Roles de realm que Keycloak asigna a todos y no se indexan
+BUILTIN_REALM_ROLES = {"offline_access", "uma_authorization"}
+ROLE_MEMBERS_PAGE_SIZE = 500
 
 
 class KeycloakProvider(IdentityProvider):
@@ -30,6 +41,54 @@ class KeycloakProvider(IdentityProvider):
         self.token_url = f"{server_url}/realms/{realm}/protocol/openid-connect/token"
         self.jwks_url = f"{server_url}/realms/{realm}/protocol/openid-connect/certs"
         self.admin_url = f"{server_url}/admin/realms/{realm}"
+        
+        # Claves públicas cacheadas por kid (compartidas por todo el proceso)
+        self.jwks = JWKSKeyStore(
+            self._fetch_public_keys,
+            ttl=float(os.getenv("KEYCLOAK_JWKS_TTL", "300")),
+            min_refetch_interval=float(os.getenv("KEYCLOAK_JWKS_MIN_REFETCH", "10"))
+        )
+        
+        # Sesión HTTP con pool de conexiones keep-alive hacia Keycloak
+        pool_size = int(os.getenv("KEYCLOAK_HTTP_POOL_SIZE", "20"))
+        self.timeout = (
+            float(os.getenv("KEYCLOAK_HTTP_CONNECT_TIMEOUT", "3")),
+            float(os.getenv("KEYCLOAK_HTTP_READ_TIMEOUT", "10"))
+        )
+        self.http = requests.Session()
+        self.http.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        
+        # Token de administrador (client_credentials) reutilizado hasta que caduca
+        self.admin_token_margin = float(os.getenv("KEYCLOAK_ADMIN_TOKEN_MARGIN", "30"))
+        self._admin_token = None
+        self._admin_token_expires_at = 0.0
+        self._admin_token_lock = threading.Lock()
+        
+        # Tokens ya verificados, válidos hasta su claim `exp`
+        self.token_cache = TokenCache(
+            max_size=int(os.getenv("KEYCLOAK_TOKEN_CACHE_SIZE", "10000")),
+            skew=float(os.getenv("KEYCLOAK_TOKEN_CACHE_SKEW", "30")),
+            revocation_ttl=float(os.getenv("KEYCLOAK_TOKEN_REVOCATION_TTL", "86400"))
+        )
+        
+        # Roles de realm por usuario, para enriquecer listados sin una llamada por fila.
+        # KEYCLOAK_INDEXED_ROLES limita los roles indexados (por defecto, todos salvo los de sistema)
+        self.indexed_roles = [
+            role.strip()
+            for role in os.getenv("KEYCLOAK_INDEXED_ROLES", "").split(",")
+            if role.strip()
+        ]
+        self.role_index = RoleIndex(
+            self._fetch_role_memberships,
+            ttl=float(os.getenv("KEYCLOAK_ROLE_INDEX_TTL", "300"))
+        )
+        # Representaciones de rol (id + nombre) que piden las role-mappings
+        self._role_representations: Dict[str, Dict[str, Any]] = {}
+        # Roles compuestos: su asignación concede otros roles
+        self._composite_roles: Set[str] = set()
     
     def login(self, username: str, password: str) -> TokenResponse:
         """Autenticación con Keycloak"""
@@ -37,7 +96,7 @@ class KeycloakProvider(IdentityProvider):
             print(f"DEBUG: Intentando login en: {self.token_url}")
             print(f"DEBUG: Client ID: {self.client_id}")
             
-            response = requests.post(
+            response = self.http.post(
                 self.token_url,
                 data={
                     "grant_type": "password",
@@ -46,8 +105,7 @@ class KeycloakProvider(IdentityProvider):
                     "username": username,
                     "password": password,
                 },
-                verify=False,
-                timeout=10
+                timeout=self.timeout
             )
             
             print(f"DEBUG: Status code: {response.status_code}")
@@ -80,33 +138,30 @@ class KeycloakProvider(IdentityProvider):
                 detail=f"Error de conexión: {str(e)}"
             )
     
-    @lru_cache()
-    def _get_public_keys(self) -> Dict[str, Any]:
-        """Obtiene las claves públicas de Keycloak"""
-        response = requests.get(self.jwks_url, verify=False, timeout=10)
+    def _fetch_public_keys(self) -> Dict[str, Any]:
+        """Descarga las claves públicas de Keycloak"""
+        response = self.http.get(self.jwks_url, timeout=self.timeout)
         response.raise_for_status()
         return response.json()
     
     def decode_token(self, token: str) -> UserInfo:
         """Decodifica y valida token JWT de Keycloak"""
+        cached = self.token_cache.get(token)
+        if cached is not None:
+            return cached
+        
         try:
-            jwks = self._get_public_keys()
             unverified_header = jwt.get_unverified_header(token)
             
-            # Buscar la clave RSA correspondiente
-            rsa_key = None
-            for key in jwks.get("keys", []):
-                if key["kid"] == unverified_header["kid"]:
-                    rsa_key = {
-                        "kty": key["kty"],
-                        "kid": key["kid"],
-                        "use": key["use"],
-                        "n": key["n"],
-                        "e": key["e"]
-                    }
-                    break
+            # Buscar la clave RSA correspondiente (dict en memoria)
+            rsa_key = self.jwks.get_key(unverified_header.get("kid"))
             
             if not rsa_key:
+                if not self.jwks.has_keys():
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="Error al conectar con el proveedor de identidad"
+                    )
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Token inválido"
@@ -121,6 +176,13 @@ class KeycloakProvider(IdentityProvider):
                 options={"verify_aud": False}
             )
             
+            # Cambio de roles, actualización o borrado posterior a la emisión del token
+            if self.token_cache.is_revoked(payload["sub"], payload.get("iat")):
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Token revocado, vuelve a autenticarte"
+                )
+            
             # Extraer roles
             roles = []
             if "realm_access" in payload:
@@ -129,7 +191,7 @@ class KeycloakProvider(IdentityProvider):
                 roles.extend(payload["resource_access"][self.client_id].get("roles", []))
             
             # Mapear a nuestro modelo UserInfo normalizado
-            return UserInfo(
+            user_info = UserInfo(
                 user_id=payload["sub"],
                 username=payload.get("preferred_username", ""),
                 email=payload.get("email"),
@@ -139,6 +201,8 @@ class KeycloakProvider(IdentityProvider):
                 email_verified=payload.get("email_verified", False),
                 raw_data=payload
             )
+            self.token_cache.put(token, user_info, payload.get("exp"), payload.get("iat"))
+            return user_info
             
         except JWTError:
             raise HTTPException(
@@ -149,7 +213,7 @@ class KeycloakProvider(IdentityProvider):
     def refresh_token(self, refresh_token: str) -> TokenResponse:
         """Refresca el access token"""
         try:
-            response = requests.post(
+            response = self.http.post(
                 self.token_url,
                 data={
                     "grant_type": "refresh_token",
@@ -157,8 +221,7 @@ class KeycloakProvider(IdentityProvider):
                     "client_secret": self.client_secret,
                     "refresh_token": refresh_token,
                 },
-                verify=False,
-                timeout=10
+                timeout=self.timeout
             )
             response.raise_for_status()
             data = response.json()
@@ -174,26 +237,69 @@ class KeycloakProvider(IdentityProvider):
                 detail="Refresh token inválido o expirado"
             )
     
-    def _get_admin_token(self) -> str:
-        """Obtiene token de administrador para operaciones de gestión"""
-        response = requests.post(
-            self.token_url,
-            data={
-                "grant_type": "client_credentials",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-            },
-            verify=False,
-            timeout=10
+    def _get_admin_token(self, force_refresh: bool = False) -> str:
+        """
+        Obtiene token de administrador para operaciones de gestión.
+        Se cachea y solo se renueva poco antes de `expires_in`.
+        """
+        with self._admin_token_lock:
+            if (
+                not force_refresh
+                and self._admin_token
+                and time.monotonic() < self._admin_token_expires_at
+            ):
+                return self._admin_token
+            
+            response = self.http.post(
+                self.token_url,
+                data={
+                    "grant_type": "client_credentials",
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                },
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            data = response.json()
+            
+            self._admin_token = data["access_token"]
+            expires_in = data.get("expires_in", 60)
+            self._admin_token_expires_at = time.monotonic() + max(expires_in - self.admin_token_margin, 0)
+            return self._admin_token
+    
+    def _admin_request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Llamada a la API de administración con el token cacheado.
+        Si Keycloak responde 401 (token revocado) se renueva y se reintenta una vez.
+        """
+        url = f"{self.admin_url}{path}"
+        response = self.http.request(
+            method,
+            url,
+            headers={"Authorization": f"Bearer {self._get_admin_token()}"},
+            timeout=self.timeout,
+            **kwargs
         )
-        response.raise_for_status()
-        return response.json()["access_token"]
+        if response.status_code == 401:
+            response = self.http.request(
+                method,
+                url,
+                headers={"Authorization": f"Bearer {self._get_admin_token(force_refresh=True)}"},
+                timeout=self.timeout,
+                **kwargs
+            )
+        return response
     
-    def create_user(    self,    username: str,    email: str,    password: str,    first_name: str = "",    last_name: str = "") -> UserInfo:
-        """Crea un usuario en Keycloak"""
-        admin_token = self._get_admin_token()
-        
-        user_data = {
+    @staticmethod
+    def _new_user_representation(
+        username: str,
+        email: str,
+        password: str,
+        first_name: str = "",
+        last_name: str = ""
+    ) -> Dict[str, Any]:
+        """Cuerpo de alta de usuario para la API de administración"""
+        return {
             "username": username,
             "email": email,
             "enabled": True,
@@ -206,14 +312,41 @@ class KeycloakProvider(IdentityProvider):
                 "temporary": False
             }]
         }
-        
-        response = requests.post(
-            f"{self.admin_url}/users",
-            json=user_data,
-            headers={"Authorization": f"Bearer {admin_token}"},
-            verify=False,
-            timeout=10
+    
+    @staticmethod
+    def _user_id_from_location(location: Optional[str]) -> Optional[str]:
+        """ID del usuario en la cabecera Location (.../users/<id>) del alta"""
+        if not location:
+            return None
+        return location.rstrip("/").rsplit("/", 1)[-1] or None
+    
+    @staticmethod
+    def _user_id_from_search(users: List[Dict[str, Any]], username: str) -> Optional[str]:
+        """ID del usuario con ese username exacto en una búsqueda de /users"""
+        for user in users:
+            if user.get("username", "").lower() == username.lower():
+                return user["id"]
+        return None
+    
+    @staticmethod
+    def _user_from_representation(data: Dict[str, Any]) -> UserInfo:
+        """Mapea un UserRepresentation de Keycloak a UserInfo"""
+        return UserInfo(
+            user_id=data["id"],
+            username=data["username"],
+            email=data.get("email"),
+            first_name=data.get("firstName"),
+            last_name=data.get("lastName"),
+            is_active=data.get("enabled", True),
+            email_verified=data.get("emailVerified", False),
+            raw_data=data
         )
+    
+    def create_user(    self,    username: str,    email: str,    password: str,    first_name: str = "",    last_name: str = "") -> UserInfo:
+        """Crea un usuario en Keycloak"""
+        user_data = self._new_user_representation(username, email, password, first_name, last_name)
+        
+        response = self._admin_request("POST", "/users", json=user_data)
         
         if response.status_code == 409:
             raise HTTPException(
@@ -232,30 +365,18 @@ class KeycloakProvider(IdentityProvider):
         
         response.raise_for_status()
         
-        # Obtener ID del usuario creado
-        user_id = None
-        
-        # Intentar obtener del header Location
-        location = response.headers.get("Location")
-        if location:
-            user_id = location.split("/")[-1]
+        # ID del usuario creado: cabecera Location (201 Created)
+        user_id = self._user_id_from_location(response.headers.get("Location"))
         
-        # Si no está en Location, buscar por username (más confiable)
+        # Sin Location, buscar por username: el alta ya está confirmada, no hace falta esperar
         if not user_id:
-            import time
-            time.sleep(0.5)  # Pequeña espera para que Keycloak procese
-            
-            search_response = requests.get(
-                f"{self.admin_url}/users?username={username}&exact=true",
-                headers={"Authorization": f"Bearer {admin_token}"},
-                verify=False,
-                timeout=10
+            search_response = self._admin_request(
+                "GET",
+                "/users",
+                params={"username": username, "exact": "true"}
             )
-            
             if search_response.status_code == 200:
-                users = search_response.json()
-                if users and len(users) > 0:
-                    user_id = users[0]["id"]
+                user_id = self._user_id_from_search(search_response.json(), username)
         
         # Si aún no tenemos user_id, error
         if not user_id:
@@ -276,63 +397,173 @@ class KeycloakProvider(IdentityProvider):
  
     def get_user_by_id(self, user_id: str) -> UserInfo:
         """Obtiene un usuario por ID"""
-        admin_token = self._get_admin_token()
-        
-        response = requests.get(
-            f"{self.admin_url}/users/{user_id}",
-            headers={"Authorization": f"Bearer {admin_token}"},
-            verify=False,
-            timeout=10
-        )
+        response = self._admin_request("GET", f"/users/{user_id}")
         response.raise_for_status()
-        data = response.json()
-        
-        return UserInfo(
-            user_id=data["id"],
-            username=data["username"],
-            email=data.get("email"),
-            first_name=data.get("firstName"),
-            last_name=data.get("lastName"),
-            is_active=data.get("enabled", True),
-            email_verified=data.get("emailVerified", False),
-            raw_data=data
-        )
+        return self._user_from_representation(response.json())
     
     def update_user(self, user_id: str, **kwargs) -> UserInfo:
         """Actualiza un usuario"""
-        admin_token = self._get_admin_token()
-        
-        response = requests.put(
-            f"{self.admin_url}/users/{user_id}",
-            json=kwargs,
-            headers={"Authorization": f"Bearer {admin_token}"},
-            verify=False,
-            timeout=10
-        )
+        response = self._admin_request("PUT", f"/users/{user_id}", json=kwargs)
         response.raise_for_status()
+        self.invalidate_user(user_id)
         
         return self.get_user_by_id(user_id)
     
     def delete_user(self, user_id: str) -> bool:
         """Elimina un usuario"""
-        admin_token = self._get_admin_token()
+        response = self._admin_request("DELETE", f"/users/{user_id}")
+        if response.status_code == 204:
+            self.invalidate_user(user_id)
+            self.role_index.discard_user(user_id)
+            return True
+        return False
+    
+    def invalidate_user(self, user_id: str) -> None:
+        """
+        Revoca los tokens ya emitidos del usuario (borrado, actualización o
+        cambio de roles): con un token nuevo llegan los claims actualizados
+        """
+        self.token_cache.revoke_user(user_id)
+    
+    def _realm_role(self, role: str) -> Dict[str, Any]:
+        """Representación {id, name} de un rol de realm (cacheada)"""
+        representation = self._role_representations.get(role)
+        if representation is not None:
+            return representation
         
-        response = requests.delete(
-            f"{self.admin_url}/users/{user_id}",
-            headers={"Authorization": f"Bearer {admin_token}"},
-            verify=False,
-            timeout=10
+        response = self._admin_request("GET", f"/roles/{quote(role, safe='')}")
+        if response.status_code == 404:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"El rol '{role}' no existe"
+            )
+        response.raise_for_status()
+        data = response.json()
+        representation = {"id": data["id"], "name": data["name"]}
+        if data.get("composite"):
+            self._composite_roles.add(role)
+        self._role_representations[role] = representation
+        return representation
+    
+    def _paged(self, path: str, **params) -> List[Dict[str, Any]]:
+        """Todas las páginas de un listado del API de administración"""
+        items: List[Dict[str, Any]] = []
+        first = 0
+        while True:
+            response = self._admin_request(
+                "GET", path, params={**params, "first": first, "max": ROLE_MEMBERS_PAGE_SIZE}
+            )
+            response.raise_for_status()
+            page = response.json()
+            items.extend(page)
+            if len(page) < ROLE_MEMBERS_PAGE_SIZE:
+                return items
+            first += ROLE_MEMBERS_PAGE_SIZE
+    
+    def _indexed_role_names(self, realm_roles: List[Dict[str, Any]]) -> List[str]:
+        if self.indexed_roles:
+            return self.indexed_roles
+        return [
+            role["name"]
+            for role in realm_roles
+            if role["name"] not in BUILTIN_REALM_ROLES
+            and not role["name"].startswith("default-roles-")
+        ]
+    
+    def _granting_roles(self, realm_roles: List[Dict[str, Any]]) -> Dict[str, Set[str]]:
+        """Rol -> roles compuestos que lo incluyen, directa o indirectamente"""
+        children: Dict[str, List[str]] = {}
+        for role in realm_roles:
+            if not role.get("composite"):
+                continue
+            response = self._admin_request("GET", f"/roles/{quote(role['name'], safe='')}/composites/realm")
+            response.raise_for_status()
+            children[role["name"]] = [child["name"] for child in response.json()]
+        
+        granting: Dict[str, Set[str]] = {}
+        for parent in children:
+            pending, seen = list(children[parent]), set()
+            while pending:
+                child = pending.pop()
+                if child in seen:
+                    continue
+                seen.add(child)
+                granting.setdefault(child, set()).add(parent)
+                pending.extend(children.get(child, ()))
+        return granting
+    
+    def _group_members(self, group_id: str, cache: Dict[str, Set[str]]) -> Set[str]:
+        """Miembros de un grupo y de sus subgrupos (heredan sus roles)"""
+        members = cache.get(group_id)
+        if members is not None:
+            return members
+        members = cache[group_id] = set()
+        members.update(
+            member["id"]
+            for member in self._paged(f"/groups/{group_id}/members", briefRepresentation="true")
+        )
+        for child in self._paged(f"/groups/{group_id}/children", briefRepresentation="true"):
+            members.update(self._group_members(child["id"], cache))
+        return members
+    
+    def _role_holders(self, role: str, group_cache: Dict[str, Set[str]]) -> Set[str]:
+        """Usuarios con el rol asignado directamente o a través de un grupo"""
+        path = f"/roles/{quote(role, safe='')}"
+        holders = {member["id"] for member in self._paged(f"{path}/users", briefRepresentation="true")}
+        for group in self._paged(f"{path}/groups", briefRepresentation="true"):
+            holders.update(self._group_members(group["id"], group_cache))
+        return holders
+    
+    def _fetch_role_memberships(self) -> Dict[str, Set[str]]:
+        """
+        user_id -> roles efectivos de realm, con una llamada por rol, grupo y
+        página (no una por usuario). Incluye las asignaciones directas, las
+        heredadas por grupo (y subgrupo) y las concedidas por roles compuestos.
+        """
+        realm_roles = self._paged("/roles", briefRepresentation="false")
+        granting = self._granting_roles(realm_roles)
+        holders: Dict[str, Set[str]] = {}
+        group_cache: Dict[str, Set[str]] = {}
+        memberships: Dict[str, Set[str]] = {}
+        for role in self._indexed_role_names(realm_roles):
+            for source in {role} | granting.get(role, set()):
+                if source not in holders:
+                    holders[source] = self._role_holders(source, group_cache)
+                for user_id in holders[source]:
+                    memberships.setdefault(user_id, set()).add(role)
+        return memberships
+    
+    def get_users_roles(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Roles de varios usuarios desde el índice (sin llamadas por usuario)"""
+        return self.role_index.get_roles(user_ids)
+    
+    def _change_role(self, method: str, user_id: str, role: str) -> bool:
+        response = self._admin_request(
+            method,
+            f"/users/{user_id}/role-mappings/realm",
+            json=[self._realm_role(role)]
         )
-        return response.status_code == 204
+        if response.status_code != 204:
+            return False
+        # Los tokens ya emitidos llevan los roles antiguos
+        self.invalidate_user(user_id)
+        return True
     
     def assign_role(self, user_id: str, role: str) -> bool:
-        """Asigna un rol a un usuario"""
-        # Implementación específica de Keycloak
-        # Omitida por brevedad
-        pass
+        """Asigna un rol de realm a un usuario"""
+        if not self._change_role("POST", user_id, role):
+            return False
+        self.role_index.add(user_id, role)
+        if role in self._composite_roles:
+            # Los roles que concede se recalculan en la próxima lectura
+            self.role_index.invalidate()
+        return True
     
     def remove_role(self, user_id: str, role: str) -> bool:
-        """Remueve un rol de un usuario"""
-        # Implementación específica de Keycloak
-        # Omitida por brevedad
-        pass
+        """Remueve un rol de realm de un usuario"""
+        if not self._change_role("DELETE", user_id, role):
+            return False
+        self.role_index.remove(user_id, role)
+        # El usuario puede conservar el rol por un grupo o un rol compuesto
+        self.role_index.invalidate()
+        return True
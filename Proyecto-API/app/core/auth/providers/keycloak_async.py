@@ -0,0 +1,247 @@
+"""
+Implementación asíncrona del proveedor Keycloak (httpx).
+Comparte con KeycloakProvider el almacén JWKS y la caché de tokens verificados.
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+import httpx
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from app.core.auth.base import AsyncIdentityProvider, UserInfo, TokenResponse
+from app.core.auth.providers.keycloak import KeycloakProvider
+
+
+class AsyncKeycloakProvider(AsyncIdentityProvider):
+    """Adaptador asíncrono para Keycloak como proveedor de identidad"""
+
+    def __init__(self, sync_provider: KeycloakProvider):
+        # La verificación de tokens (JWKS + caché) se comparte con el proveedor síncrono
+        self.sync_provider = sync_provider
+        self.client_id = sync_provider.client_id
+        self.client_secret = sync_provider.client_secret
+        self.token_url = sync_provider.token_url
+        self.admin_url = sync_provider.admin_url
+
+        pool_size = int(os.getenv("KEYCLOAK_HTTP_POOL_SIZE", "20"))
+        connect_timeout, read_timeout = sync_provider.timeout
+        self.http = httpx.AsyncClient(
+            verify=False,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size
+            )
+        )
+
+        self.admin_token_margin = sync_provider.admin_token_margin
+        self._admin_token: Optional[str] = None
+        self._admin_token_expires_at = 0.0
+        self._admin_token_lock = asyncio.Lock()
+
+    async def aclose(self):
+        """Cierra el pool de conexiones"""
+        await self.http.aclose()
+
+    async def _token_request(self, data: dict) -> TokenResponse:
+        response = await self.http.post(
+            self.token_url,
+            data={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                **data
+            }
+        )
+        response.raise_for_status()
+        payload = response.json()
+
+        return TokenResponse(
+            access_token=payload["access_token"],
+            refresh_token=payload.get("refresh_token"),
+            expires_in=payload.get("expires_in")
+        )
+
+    async def login(self, username: str, password: str) -> TokenResponse:
+        """Autenticación con Keycloak"""
+        try:
+            return await self._token_request({
+                "grant_type": "password",
+                "username": username,
+                "password": password,
+            })
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (400, 401):
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Credenciales inválidas"
+                )
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Error al conectar con el proveedor de identidad"
+            )
+        except httpx.HTTPError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Error al conectar con el proveedor de identidad"
+            )
+
+    async def decode_token(self, token: str) -> UserInfo:
+        """Decodifica y valida token JWT de Keycloak"""
+        cached = self.sync_provider.token_cache.get(token)
+        if cached is not None:
+            return cached
+
+        # Un kid desconocido puede implicar descargar el JWKS: fuera del event loop
+        return await run_in_threadpool(self.sync_provider.decode_token, token)
+
+    async def refresh_token(self, refresh_token: str) -> TokenResponse:
+        """Refresca el access token"""
+        try:
+            return await self._token_request({
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+            })
+        except httpx.HTTPStatusError:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Refresh token inválido o expirado"
+            )
+
+    async def _get_admin_token(self, force_refresh: bool = False, stale_token: Optional[str] = None) -> str:
+        """
+        Token client_credentials cacheado hasta poco antes de `expires_in`.
+        Con `stale_token`, solo se renueva si sigue siendo ese: muchas llamadas
+        concurrentes que reciben 401 comparten una única renovación.
+        """
+        async with self._admin_token_lock:
+            if (
+                (not force_refresh or (stale_token and self._admin_token != stale_token))
+                and self._admin_token
+                and time.monotonic() < self._admin_token_expires_at
+            ):
+                return self._admin_token
+
+            response = await self.http.post(
+                self.token_url,
+                data={
+                    "grant_type": "client_credentials",
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                }
+            )
+            response.raise_for_status()
+            data = response.json()
+
+            self._admin_token = data["access_token"]
+            expires_in = data.get("expires_in", 60)
+            self._admin_token_expires_at = time.monotonic() + max(expires_in - self.admin_token_margin, 0)
+            return self._admin_token
+
+    async def _admin_request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Llamada a la API de administración; reintenta una vez si el token fue revocado"""
+        url = f"{self.admin_url}{path}"
+        token = await self._get_admin_token()
+        response = await self.http.request(
+            method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs
+        )
+        if response.status_code == 401:
+            token = await self._get_admin_token(force_refresh=True, stale_token=token)
+            response = await self.http.request(
+                method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs
+            )
+        return response
+
+    async def create_user(
+        self,
+        username: str,
+        email: str,
+        password: str,
+        first_name: str = "",
+        last_name: str = ""
+    ) -> UserInfo:
+        """Crea un usuario en Keycloak"""
+        user_data = KeycloakProvider._new_user_representation(
+            username, email, password, first_name, last_name
+        )
+
+        response = await self._admin_request("POST", "/users", json=user_data)
+
+        if response.status_code == 409:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="El usuario o email ya existe"
+            )
+        if response.status_code >= 400:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Error de Keycloak: {response.text}"
+            )
+
+        user_id = KeycloakProvider._user_id_from_location(response.headers.get("Location"))
+        if not user_id:
+            # El alta ya está confirmada: buscar sin esperar
+            search_response = await self._admin_request(
+                "GET", "/users", params={"username": username, "exact": "true"}
+            )
+            if search_response.status_code == 200:
+                user_id = KeycloakProvider._user_id_from_search(search_response.json(), username)
+
+        if not user_id:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Usuario creado en Keycloak pero no se pudo obtener su ID"
+            )
+
+        return UserInfo(
+            user_id=user_id,
+            username=username,
+            email=email,
+            first_name=first_name,
+            last_name=last_name,
+            roles=[],
+            email_verified=True
+        )
+
+    async def get_user_by_id(self, user_id: str) -> UserInfo:
+        """Obtiene un usuario por ID"""
+        response = await self._admin_request("GET", f"/users/{user_id}")
+        response.raise_for_status()
+        return KeycloakProvider._user_from_representation(response.json())
+
+    async def update_user(self, user_id: str, **kwargs) -> UserInfo:
+        """Actualiza un usuario"""
+        response = await self._admin_request("PUT", f"/users/{user_id}", json=kwargs)
+        response.raise_for_status()
+        self.invalidate_user(user_id)
+
+        return await self.get_user_by_id(user_id)
+
+    async def delete_user(self, user_id: str) -> bool:
+        """Elimina un usuario"""
+        response = await self._admin_request("DELETE", f"/users/{user_id}")
+        if response.status_code == 204:
+            self.invalidate_user(user_id)
+            self.sync_provider.role_index.discard_user(user_id)
+            return True
+        return False
+
+    async def assign_role(self, user_id: str, role: str) -> bool:
+        """Asigna un rol a un usuario"""
+        return await run_in_threadpool(self.sync_provider.assign_role, user_id, role)
+
+    async def remove_role(self, user_id: str, role: str) -> bool:
+        """Remueve un rol de un usuario"""
+        return await run_in_threadpool(self.sync_provider.remove_role, user_id, role)
+
+    async def get_users_roles(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Roles de varios usuarios; solo sale del event loop si hay que reconstruir el índice"""
+        if self.sync_provider.role_index.is_fresh():
+            return self.sync_provider.get_users_roles(user_ids)
+        return await run_in_threadpool(self.sync_provider.get_users_roles, list(user_ids))
+
+    def invalidate_user(self, user_id: str) -> None:
+        """Revoca los tokens ya emitidos del usuario"""
+        self.sync_provider.invalidate_user(user_id)
@@ -0,0 +1,141 @@
+"""
+Índice en memoria de pertenencia a roles (user_id -> roles).
+Se construye con los endpoints de miembros de cada rol del proveedor
+(una llamada por rol, grupo y página, no una por usuario) y se actualiza
+en el sitio cuando se asigna o retira un rol desde la API.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RoleIndex:
+    """
+    Caché con TTL de los roles de todos los usuarios.
+
+    - Una lectura con el índice vigente no llama al proveedor.
+    - Al caducar, un solo hilo lo reconstruye; el resto sigue sirviendo
+      el índice anterior mientras tanto.
+    - Los cambios hechos durante una reconstrucción se reaplican sobre
+      el resultado, para no perderlos.
+    - Si el proveedor falla se mantiene el índice anterior y se reintenta
+      pasados `retry_interval` segundos.
+    """
+
+    def __init__(
+        self,
+        fetch_memberships: Callable[[], Dict[str, Iterable[str]]],
+        ttl: float = 300.0,
+        retry_interval: float = 30.0
+    ):
+        self._fetch_memberships = fetch_memberships
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+
+        self._roles: Dict[str, Set[str]] = {}
+        self._loaded = False
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # (user_id, rol, asignado) aplicados mientras se reconstruye; rol None = todos
+        self._pending: Optional[List[Tuple[str, Optional[str], bool]]] = None
+
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def is_fresh(self) -> bool:
+        return self._loaded and time.monotonic() - self._fetched_at < self.ttl
+
+    def refresh(self) -> bool:
+        """Reconstruye el índice completo; False si el proveedor falla"""
+        with self._refresh_lock:
+            if self.is_fresh():
+                return True
+            with self._lock:
+                self._pending = []
+            try:
+                memberships = self._fetch_memberships()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo reconstruir el índice de roles: {e}")
+                with self._lock:
+                    self._pending = None
+                self.refresh_errors += 1
+                self._retry_at = time.monotonic() + self.retry_interval
+                return False
+
+            roles = {user_id: set(user_roles) for user_id, user_roles in memberships.items()}
+            with self._lock:
+                for user_id, role, assigned in self._pending:
+                    self._apply(roles, user_id, role, assigned)
+                self._pending = None
+                self._roles = roles
+                self._loaded = True
+                self._fetched_at = time.monotonic()
+            self.refreshes += 1
+            return True
+
+    def _ensure_fresh(self):
+        if self.is_fresh() or time.monotonic() < self._retry_at:
+            return
+        if self._loaded and self._refresh_lock.locked():
+            # Otro hilo ya lo está reconstruyendo: servir el índice anterior
+            return
+        self.refresh()
+
+    def get_roles(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Roles de cada usuario pedido (lista vacía si no tiene ninguno indexado)"""
+        self._ensure_fresh()
+        with self._lock:
+            return {user_id: sorted(self._roles.get(user_id, ())) for user_id in user_ids}
+
+    @staticmethod
+    def _apply(roles: Dict[str, Set[str]], user_id: str, role: Optional[str], assigned: bool):
+        if role is None:
+            roles.pop(user_id, None)
+        elif assigned:
+            roles.setdefault(user_id, set()).add(role)
+        else:
+            user_roles = roles.get(user_id)
+            if user_roles is not None:
+                user_roles.discard(role)
+                if not user_roles:
+                    del roles[user_id]
+
+    def _update(self, user_id: str, role: Optional[str], assigned: bool):
+        with self._lock:
+            self._apply(self._roles, user_id, role, assigned)
+            if self._pending is not None:
+                self._pending.append((user_id, role, assigned))
+
+    def add(self, user_id: str, role: str):
+        """Refleja en el índice un rol recién asignado"""
+        self._update(user_id, role, True)
+
+    def remove(self, user_id: str, role: str):
+        """Refleja en el índice un rol recién retirado"""
+        self._update(user_id, role, False)
+
+    def discard_user(self, user_id: str):
+        """Elimina un usuario borrado del índice"""
+        self._update(user_id, None, False)
+
+    def invalidate(self):
+        """Fuerza la reconstrucción en la próxima lectura"""
+        with self._lock:
+            self._fetched_at = 0.0
+        self._retry_at = 0.0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._roles),
+                "loaded": self._loaded,
+                "age_seconds": time.monotonic() - self._fetched_at if self._loaded else None,
+                "ttl": self.ttl,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors
+            }
@@ -0,0 +1,148 @@
+"""
+Caché LRU de tokens ya verificados.
+Evita repetir la verificación RS256 para un mismo bearer token
+mientras no haya caducado.
+
+También guarda las revocaciones por usuario: un JWT sigue siendo válido
+hasta su `exp` aunque se borre de la caché, así que tras un cambio de
+roles o un borrado se rechazan los tokens con `iat` anterior (en este
+proceso; el resto de workers los aceptan hasta que caducan).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from app.core.auth.base import UserInfo
+
+
+class TokenCache:
+    """
+    LRU indexada por el hash SHA-256 del token.
+    Cada entrada vive hasta el claim `exp` del token menos `skew` segundos.
+    Las revocaciones se recuerdan `revocation_ttl` segundos, que debe ser
+    mayor que la vida máxima de un access token.
+    """
+
+    def __init__(self, max_size: int = 10000, skew: float = 30.0, revocation_ttl: float = 86400.0):
+        self.max_size = max_size
+        self.skew = skew
+        self.revocation_ttl = revocation_ttl
+
+        # hash -> (usuario, expira, iat)
+        self._entries: "OrderedDict[bytes, Tuple[UserInfo, float, Optional[float]]]" = OrderedDict()
+        self._by_user: Dict[str, Set[bytes]] = {}
+        # user_id -> se rechazan los tokens con iat anterior
+        self._revoked_before: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[UserInfo]:
+        """Devuelve el UserInfo cacheado o None si no está o ha caducado"""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            user_info, expires_at, iat = entry
+            if time.time() >= expires_at or self._is_revoked(user_info.user_id, iat):
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return user_info
+
+    def put(self, token: str, user_info: UserInfo, exp: Optional[float], iat: Optional[float] = None):
+        """Guarda un token verificado hasta `exp - skew` (salvo que esté revocado)"""
+        if not exp:
+            return
+        expires_at = exp - self.skew
+        if expires_at <= time.time():
+            return
+
+        key = self._key(token)
+        with self._lock:
+            if self._is_revoked(user_info.user_id, iat):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (user_info, expires_at, iat)
+            self._by_user.setdefault(user_info.user_id, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: str) -> int:
+        """Elimina todos los tokens cacheados de un usuario (no los revoca)"""
+        with self._lock:
+            return self._drop_user(user_id)
+
+    def revoke_user(self, user_id: str, at: Optional[float] = None) -> int:
+        """Rechaza los tokens del usuario emitidos antes de `at` (por defecto, ahora)"""
+        at = time.time() if at is None else at
+        with self._lock:
+            cutoff = at - self.revocation_ttl
+            self._revoked_before = {
+                other: revoked for other, revoked in self._revoked_before.items() if revoked > cutoff
+            }
+            self._revoked_before[user_id] = max(at, self._revoked_before.get(user_id, 0.0))
+            return self._drop_user(user_id)
+
+    def is_revoked(self, user_id: str, iat: Optional[float]) -> bool:
+        with self._lock:
+            return self._is_revoked(user_id, iat)
+
+    def _is_revoked(self, user_id: str, iat: Optional[float]) -> bool:
+        revoked_before = self._revoked_before.get(user_id)
+        if revoked_before is None:
+            return False
+        if time.time() - revoked_before > self.revocation_ttl:
+            del self._revoked_before[user_id]
+            return False
+        # iat va en segundos enteros: un token del mismo segundo que la revocación también se rechaza
+        return iat is None or iat < revoked_before
+
+    def _drop_user(self, user_id: str) -> int:
+        keys = self._by_user.pop(user_id, set())
+        for key in keys:
+            self._entries.pop(key, None)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._revoked_before.clear()
+
+    def _remove(self, key: bytes):
+        user_info = self._entries.pop(key)[0]
+        keys = self._by_user.get(user_info.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_info.user_id]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "revoked_users": len(self._revoked_before)
+            }
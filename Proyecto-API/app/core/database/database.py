@@ -1,21 +1,292 @@
 """
 Configuración centralizada de la base de datos
 """
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from app.core.config import DATABASE_URL
 
+logger = logging.getLogger(__name__)
+
+# Tamaño del pool de cada engine (síncrono y asíncrono)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Muestras de espera de checkout usadas para las estadísticas
+POOL_WAIT_SAMPLES = 1000
+
+# Réplica de solo lectura (opcional): lecturas pesadas del dashboard
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))
+DB_REPLICA_MAX_OVERFLOW = int(os.getenv("DB_REPLICA_MAX_OVERFLOW", str(DB_MAX_OVERFLOW)))
+# Retraso máximo tolerado (s); por encima las lecturas van al primario
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+# Cada cuánto se vuelve a medir el retraso de la réplica (s)
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "5"))
+# Espera máxima (s) para conectar con la réplica o medir su retraso; después, al primario
+DB_REPLICA_TIMEOUT = float(os.getenv("DB_REPLICA_TIMEOUT", "2"))
+
+# Retraso de replicación en una standby de PostgreSQL (0 si está al día)
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+# Drivers asíncronos por backend
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
 # Configuración del engine con mejores prácticas para PostgreSQL
 engine = create_engine(
     DATABASE_URL,
     echo=False,
     pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW
 )
 
+def to_async_url(url: str) -> str:
+    """URL equivalente con el driver asíncrono (asyncpg / aiosqlite)"""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No hay driver asíncrono para {parsed.get_backend_name()}")
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+def _create_async_engine(
+    url: str, pool_size: int, max_overflow: int, connect_args: Optional[Dict[str, Any]] = None
+) -> AsyncEngine:
+    return create_async_engine(
+        to_async_url(url),
+        echo=False,
+        pool_pre_ping=True,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        connect_args=connect_args or {}
+    )
+
+_async_engine: Optional[AsyncEngine] = None
+_async_replica_engine: Optional[AsyncEngine] = None
+_async_engine_lock = threading.Lock()
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Engine asíncrono, creado en el primer uso (así los scripts y el CLI no
+    necesitan el driver asíncrono instalado).
+    Las rutas async no ocupan hilos del threadpool: su concurrencia la
+    limita el pool (DB_POOL_SIZE + DB_MAX_OVERFLOW conexiones).
+    """
+    global _async_engine
+    if _async_engine is None:
+        with _async_engine_lock:
+            if _async_engine is None:
+                _async_engine = _create_async_engine(DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW)
+    return _async_engine
+
+def get_async_replica_engine() -> Optional[AsyncEngine]:
+    """Engine asíncrono de la réplica, o None si no hay DATABASE_REPLICA_URL"""
+    global _async_replica_engine
+    if not DATABASE_REPLICA_URL:
+        return None
+    if _async_replica_engine is None:
+        with _async_engine_lock:
+            if _async_replica_engine is None:
+                # Una réplica caída no debe dejar colgada la conexión
+                _async_replica_engine = _create_async_engine(
+                    DATABASE_REPLICA_URL, DB_REPLICA_POOL_SIZE, DB_REPLICA_MAX_OVERFLOW,
+                    connect_args={"timeout": DB_REPLICA_TIMEOUT}
+                )
+    return _async_replica_engine
+
+async def dispose_async_engine():
+    """Cierra las conexiones de los engines asíncronos (apagado de la aplicación)"""
+    global _async_engine, _async_replica_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+    if _async_replica_engine is not None:
+        await _async_replica_engine.dispose()
+        _async_replica_engine = None
+
+class PoolWaitStats:
+    """Tiempo de espera hasta obtener una conexión del pool asíncrono"""
+
+    def __init__(self, samples: int = POOL_WAIT_SAMPLES):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=samples)
+        self.checkouts = 0
+        self.total_wait = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._waits.append(seconds)
+            self.checkouts += 1
+            self.total_wait += seconds
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self._waits)
+            checkouts = self.checkouts
+            total_wait = self.total_wait
+        if not ordered:
+            return {"checkouts": checkouts, "avg_ms": None, "p95_ms": None, "max_ms": None}
+        return {
+            "checkouts": checkouts,
+            "total_wait_s": total_wait,
+            "avg_ms": sum(ordered) / len(ordered) * 1000,
+            "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+
+class ReplicaRouter:
+    """
+    Decide si una lectura puede ir a la réplica.
+    El retraso de replicación se mide como mucho cada `check_interval`
+    segundos; si supera `max_lag` (o la réplica no responde en `timeout`
+    segundos) las lecturas vuelven al primario hasta la siguiente medición.
+    """
+
+    def __init__(self, max_lag: float, check_interval: float, timeout: float = DB_REPLICA_TIMEOUT):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.lag: Optional[float] = None
+        self.healthy = False
+        self._checked_at = 0.0
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    async def _query_lag(self, replica: AsyncEngine) -> float:
+        if replica.dialect.name != "postgresql":
+            return 0.0
+        async with replica.connect() as connection:
+            return float((await connection.execute(text(REPLICA_LAG_SQL))).scalar())
+
+    async def _measure_lag(self, replica: AsyncEngine) -> Optional[float]:
+        try:
+            return await asyncio.wait_for(self._query_lag(replica), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ La réplica no responde en {self.timeout}s, lecturas al primario")
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Réplica no disponible, lecturas al primario: {e}")
+            return None
+
+    async def use_replica(self, replica: AsyncEngine) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            # Marcar antes de medir: las peticiones concurrentes usan el último valor
+            self._checked_at = now
+            self.lag = await self._measure_lag(replica)
+            healthy = self.lag is not None and self.lag <= self.max_lag
+            if healthy != self.healthy:
+                if healthy:
+                    logger.info(f"✅ Lecturas a la réplica (retraso {self.lag:.1f}s)")
+                else:
+                    logger.warning(f"⚠️ Réplica con retraso {self.lag}s, lecturas al primario")
+            self.healthy = healthy
+        if self.healthy:
+            self.replica_reads += 1
+        else:
+            self.primary_reads += 1
+        return self.healthy
+
+    def mark_unavailable(self, error: BaseException):
+        """No se pudo abrir la sesión en la réplica: al primario hasta la siguiente medición"""
+        if self.healthy:
+            logger.warning(f"⚠️ Réplica no disponible, lecturas al primario: {error!r}")
+        self.healthy = False
+        self.lag = None
+        self._checked_at = time.monotonic()
+        self.replica_reads -= 1
+        self.primary_reads += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "lag_s": self.lag,
+            "max_lag_s": self.max_lag,
+            "replica_reads": self.replica_reads,
+            "primary_fallback_reads": self.primary_reads,
+        }
+
+# Instancias globales
+pool_wait_stats = PoolWaitStats()
+replica_pool_wait_stats = PoolWaitStats()
+replica_router = ReplicaRouter(DB_REPLICA_MAX_LAG, DB_REPLICA_LAG_CHECK_INTERVAL)
+
+def _pool_status(pool, max_overflow: int) -> Dict[str, Any]:
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": max_overflow,
+    }
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Estado de los pools de conexiones (primario y réplica) y espera de checkout"""
+    stats = {"sync": _pool_status(engine.pool, DB_MAX_OVERFLOW)}
+    if _async_engine is not None:
+        stats["async"] = {
+            **_pool_status(_async_engine.sync_engine.pool, DB_MAX_OVERFLOW),
+            "checkout_wait": pool_wait_stats.get_stats(),
+        }
+    if _async_replica_engine is not None:
+        stats["replica"] = {
+            **_pool_status(_async_replica_engine.sync_engine.pool, DB_REPLICA_MAX_OVERFLOW),
+            "checkout_wait": replica_pool_wait_stats.get_stats(),
+            **replica_router.get_stats(),
+        }
+    return stats
+
 def create_db_and_tables():
     """Crea todas las tablas definidas en los modelos"""
+    import app.models.indexes  # noqa: F401 (registra los índices compuestos)
+    
+    partitioned = False
+    if engine.dialect.name == "postgresql":
+        from app.services.metrics_partitions import PARTITIONING_ENABLED, prepare_partitioned_table
+        if PARTITIONING_ENABLED:
+            # motor_metrics se crea particionada por rango de created_at
+            prepare_partitioned_table()
+            partitioned = True
+    
     SQLModel.metadata.create_all(engine)
+    
+    if partitioned:
+        # Antes de la primera escritura, no desde el hilo de mantenimiento
+        from app.services.metrics_partitions import ensure_partitions_now
+        ensure_partitions_now()
+    
+    # create_all no añade índices nuevos a tablas que ya existen
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError:
+                # Índice único sobre datos que ya tienen duplicados
+                logger.error(
+                    f"❌ No se pudo crear el índice único {index.name}: "
+                    f"hay filas duplicadas en {table.name}, elimínalas y reinicia"
+                )
 
 def get_session():
     """
@@ -24,3 +295,57 @@ def get_session():
     """
     with Session(engine) as session:
         yield session
+
+async def _open_session(async_engine: AsyncEngine, wait_stats: PoolWaitStats) -> AsyncSession:
+    """Sesión con la conexión ya pedida al pool (mide la espera de checkout)"""
+    session = AsyncSession(async_engine, expire_on_commit=False)
+    start = time.perf_counter()
+    try:
+        await session.connection()
+    except BaseException:
+        await session.close()
+        raise
+    wait_stats.record(time.perf_counter() - start)
+    return session
+
+@asynccontextmanager
+async def _timed_session(async_engine: AsyncEngine, wait_stats: PoolWaitStats):
+    async with await _open_session(async_engine, wait_stats) as session:
+        yield session
+
+async def get_async_session():
+    """
+    Dependency para obtener una sesión asíncrona (AsyncSession) del primario.
+    La conexión se pide al pool al empezar para medir la espera de checkout.
+    """
+    async with _timed_session(get_async_engine(), pool_wait_stats) as session:
+        yield session
+
+@asynccontextmanager
+async def read_session():
+    """
+    Sesión asíncrona de solo lectura: en la réplica si está configurada y su
+    retraso no supera DB_REPLICA_MAX_LAG, si no en el primario.
+    Así las lecturas del dashboard no compiten con la ingesta por el pool del primario.
+    Las rutas con caché la abren dentro del cálculo: un acierto de caché o un
+    304 no piden conexión al pool.
+    Si la réplica no da conexión en DB_REPLICA_TIMEOUT se lee del primario.
+    """
+    session = None
+    replica = get_async_replica_engine()
+    if replica is not None and await replica_router.use_replica(replica):
+        try:
+            session = await asyncio.wait_for(
+                _open_session(replica, replica_pool_wait_stats), replica_router.timeout
+            )
+        except Exception as e:
+            replica_router.mark_unavailable(e)
+    if session is None:
+        session = await _open_session(get_async_engine(), pool_wait_stats)
+    async with session:
+        yield session
+
+async def get_read_session():
+    """Dependency de solo lectura (ver read_session)"""
+    async with read_session() as session:
+        yield session
@@ -0,0 +1,97 @@
+"""
+Paginación por cursor (keyset) sobre (created_at, id).
+El cursor es opaco para el cliente: base64 de la última clave devuelta.
+
+Si created_at admite NULL (filas anteriores a la columna), esas filas van
+al final en orden ascendente y al principio en descendente, el mismo orden
+que el índice de PostgreSQL, y el cursor puede apuntar a una de ellas.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, func, or_, select, text, tuple_
+from sqlmodel import Session
+
+
+def encode_cursor(created_at: Optional[datetime], row_id: int) -> str:
+    """Cursor opaco a partir de la clave de la última fila"""
+    raw = json.dumps(
+        [created_at.isoformat() if created_at is not None else None, row_id],
+        separators=(",", ":")
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    """Recupera (created_at, id) de un cursor; 400 si no es válido"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (
+            datetime.fromisoformat(created_at) if created_at is not None else None,
+            int(row_id)
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+
+def apply_keyset(statement, model, cursor: Optional[str], descending: bool = False):
+    """
+    Ordena por (created_at, id) y, si hay cursor, continúa tras la última clave.
+    La comparación por tupla usa directamente el índice compuesto.
+    """
+    created_at = model.created_at
+    nullable = model.__table__.c.created_at.nullable
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor)
+        if last_created_at is None:
+            # El cursor está en el tramo de filas sin created_at
+            after = model.id < last_id if descending else model.id > last_id
+            condition = and_(created_at.is_(None), after)
+            if descending:
+                condition = or_(condition, created_at.is_not(None))
+        else:
+            key, last = tuple_(created_at, model.id), tuple_(last_created_at, last_id)
+            condition = key < last if descending else key > last
+            if nullable and not descending:
+                condition = or_(condition, created_at.is_(None))
+        statement = statement.where(condition)
+    if descending:
+        order = created_at.desc().nulls_first() if nullable else created_at.desc()
+        return statement.order_by(order, model.id.desc())
+    order = created_at.asc().nulls_last() if nullable else created_at
+    return statement.order_by(order, model.id)
+
+
+def next_cursor(rows, limit: int) -> Optional[str]:
+    """Cursor de la siguiente página, o None si no hay más filas"""
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(last.created_at, last.id)
+
+
+def estimated_count(session: Session, model) -> int:
+    """
+    Total aproximado de filas de una tabla.
+    En PostgreSQL usa la estadística del planificador (sin escanear la tabla).
+    Una tabla particionada nunca se analiza (reltuples = -1): se suman sus particiones.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        estimate = session.execute(
+            text(
+                "SELECT CASE WHEN c.relkind = 'p' THEN ("
+                "    SELECT sum(p.reltuples) FROM pg_inherits i "
+                "    JOIN pg_class p ON p.oid = i.inhrelid "
+                "    WHERE i.inhparent = c.oid AND p.reltuples >= 0"
+                ") ELSE c.reltuples END::bigint "
+                "FROM pg_class c WHERE c.oid = CAST(:table AS regclass)"
+            ),
+            {"table": model.__tablename__}
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+    return session.execute(select(func.count()).select_from(model)).scalar_one()
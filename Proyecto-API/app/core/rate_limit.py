@@ -0,0 +1,395 @@
+"""
+Rate limiting por token bucket (issue #8).
+
+Cada regla asocia un prefijo de ruta con un presupuesto "N peticiones cada
+S segundos" (ráfaga de N, recarga de N/S por segundo) que se aplica por
+cliente: el subject del token si ya está verificado en la caché de tokens
+del proveedor, y si no la IP. Un token inventado no da un presupuesto
+nuevo, porque solo cuentan los subjects de tokens ya verificados.
+
+El almacén por defecto está en memoria, repartido en shards con un lock
+cada uno; un bucket lleno equivale a uno inexistente, así que se borran
+de forma perezosa. Con varios workers o réplicas cada proceso lleva su
+propia cuenta; RATE_LIMIT_BACKEND=redis comparte los buckets entre todos.
+
+Registro en la aplicación:
+
+    app.add_middleware(RateLimitMiddleware)
+
+Las rutas de /auth además dependen de `enforce_rate_limit`, que aplica el
+mismo límite si el middleware no está registrado (y no cuenta dos veces
+si lo está).
+"""
+import logging
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+# "prefijo:peticiones/segundos" separados por comas; "*" es el límite del resto de rutas
+RATE_LIMIT_RULES = os.getenv(
+    "RATE_LIMIT_RULES",
+    "/auth/login:10/60,/auth/register:5/300,/auth:60/60,*:300/60"
+)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+# Buckets en memoria como máximo (entre todos los shards)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Solo detrás de un proxy propio: la IP del cliente sale de X-Forwarded-For
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+
+# Buckets caducados que se revisan en cada petición, por shard
+_EXPIRE_PER_TAKE = 2
+
+
+class RateLimitRule:
+    """Presupuesto de `limit` peticiones cada `period` segundos para un prefijo de ruta"""
+
+    __slots__ = ("prefix", "limit", "period", "rate")
+
+    def __init__(self, prefix: str, limit: int, period: float):
+        if limit <= 0 or period <= 0:
+            raise ValueError(f"Límite no válido para {prefix}: {limit}/{period}")
+        self.prefix = prefix
+        self.limit = limit
+        self.period = period
+        self.rate = limit / period
+
+    def matches(self, path: str) -> bool:
+        if self.prefix == "*":
+            return True
+        return path == self.prefix or path.startswith(self.prefix.rstrip("/") + "/")
+
+    def __repr__(self) -> str:
+        return f"RateLimitRule({self.prefix!r}, {self.limit}/{self.period:g}s)"
+
+
+def parse_rules(spec: str) -> List[RateLimitRule]:
+    """Reglas de RATE_LIMIT_RULES, de la más específica a la menos"""
+    rules = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            prefix, budget = item.rsplit(":", 1)
+            limit, period = budget.split("/", 1)
+            rules.append(RateLimitRule(prefix.strip(), int(limit), float(period)))
+        except ValueError as e:
+            raise ValueError(f"Regla de rate limit no válida '{item}': {e}")
+    # Prefijos más largos primero y el comodín siempre al final
+    return sorted(rules, key=lambda rule: (rule.prefix == "*", -len(rule.prefix)))
+
+
+class RateLimitBackend(ABC):
+    """
+    Almacén de buckets. `take` consume `cost` fichas del bucket `key` y
+    devuelve (permitida, segundos hasta poder reintentar).
+    """
+
+    @abstractmethod
+    async def take(self, key: str, rate: float, burst: int, cost: float = 1.0) -> Tuple[bool, float]:
+        """Consume fichas del bucket; (permitida, segundos hasta poder reintentar)"""
+        pass
+
+    def get_stats(self) -> dict:
+        return {}
+
+
+class _Shard:
+    __slots__ = ("lock", "buckets")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [fichas, última actualización, momento en que vuelve a estar lleno];
+        # el orden es el de la última actualización, así que los caducados quedan al principio
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    Buckets en memoria del proceso, repartidos en shards por hash de la
+    clave para que peticiones de clientes distintos no compitan por el
+    mismo lock. Cada `take` es O(1): actualiza el bucket, lo mueve al final
+    y borra como mucho un par de buckets ya llenos del principio.
+    """
+
+    def __init__(self, shards: int = 16, max_keys: int = 100000):
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self.max_keys_per_shard = max(1, max_keys // len(self._shards))
+        self.evictions = 0
+
+    def take_nowait(
+        self,
+        key: str,
+        rate: float,
+        burst: int,
+        cost: float = 1.0,
+        now: Optional[float] = None
+    ) -> Tuple[bool, float]:
+        now = time.monotonic() if now is None else now
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            buckets = shard.buckets
+            bucket = buckets.get(key)
+            if bucket is None or bucket[2] <= now:
+                tokens = float(burst)
+            else:
+                tokens = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                allowed, retry_after = True, 0.0
+            else:
+                allowed, retry_after = False, (cost - tokens) / rate
+
+            full_at = now + (burst - tokens) / rate
+            if bucket is None:
+                buckets[key] = [tokens, now, full_at]
+            else:
+                bucket[0], bucket[1], bucket[2] = tokens, now, full_at
+                buckets.move_to_end(key)
+
+            # Expiración perezosa: los buckets del principio llevan más tiempo sin uso
+            for _ in range(_EXPIRE_PER_TAKE):
+                oldest_key, oldest = next(iter(buckets.items()))
+                if oldest_key == key or oldest[2] > now:
+                    break
+                del buckets[oldest_key]
+            while len(buckets) > self.max_keys_per_shard:
+                buckets.popitem(last=False)
+                self.evictions += 1
+
+        return allowed, retry_after
+
+    async def take(self, key: str, rate: float, burst: int, cost: float = 1.0) -> Tuple[bool, float]:
+        return self.take_nowait(key, rate, burst, cost)
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.buckets.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "shards": len(self._shards),
+            "keys": sum(len(shard.buckets) for shard in self._shards),
+            "evictions": self.evictions
+        }
+
+
+# Token bucket atómico en Redis; el reloj es el del servidor, común a todos los workers
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+if tokens == nil then
+  tokens = burst
+else
+  tokens = math.min(burst, tokens + (now - tonumber(bucket[2])) * rate)
+end
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    Buckets compartidos entre workers y réplicas en Redis (un script Lua
+    por petición). Requiere el paquete `redis`, que no es dependencia de
+    la API salvo que se active este backend.
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requiere el paquete 'redis' (pip install redis)")
+        self.prefix = prefix
+        self._client = redis_asyncio.from_url(url)
+        self._script = self._client.register_script(_REDIS_TOKEN_BUCKET)
+
+    async def take(self, key: str, rate: float, burst: int, cost: float = 1.0) -> Tuple[bool, float]:
+        allowed, retry_after = await self._script(keys=[self.prefix + key], args=[rate, burst, cost])
+        return bool(int(allowed)), float(retry_after)
+
+    def get_stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+def create_backend(kind: str = RATE_LIMIT_BACKEND) -> RateLimitBackend:
+    if kind == "memory":
+        return MemoryRateLimitBackend(shards=RATE_LIMIT_SHARDS, max_keys=RATE_LIMIT_MAX_KEYS)
+    if kind == "redis":
+        return RedisRateLimitBackend(RATE_LIMIT_REDIS_URL)
+    raise ValueError(f"Unknown rate limit backend: {kind}")
+
+
+class RateLimiter:
+    """Reglas + backend; si el backend falla se deja pasar la petición"""
+
+    def __init__(self, rules: List[RateLimitRule], backend: RateLimitBackend, enabled: bool = True):
+        self.rules = rules
+        self.backend = backend
+        self.enabled = enabled
+        self.allowed = 0
+        self.limited = 0
+        self.backend_errors = 0
+        self._last_error_log = 0.0
+
+    def match(self, path: str) -> Optional[RateLimitRule]:
+        for rule in self.rules:
+            if rule.matches(path):
+                return rule
+        return None
+
+    async def hit(self, path: str, client: str) -> Optional[float]:
+        """None si la petición entra en el presupuesto; si no, segundos hasta reintentar"""
+        if not self.enabled:
+            return None
+        rule = self.match(path)
+        if rule is None:
+            return None
+        try:
+            allowed, retry_after = await self.backend.take(f"{rule.prefix}|{client}", rule.rate, rule.limit)
+        except Exception as e:
+            self.backend_errors += 1
+            now = time.monotonic()
+            if now - self._last_error_log > 30:
+                self._last_error_log = now
+                logger.warning(f"⚠️ Backend de rate limit no disponible, se deja pasar el tráfico: {e}")
+            return None
+        if allowed:
+            self.allowed += 1
+            return None
+        self.limited += 1
+        return retry_after
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "rules": [f"{rule.prefix}:{rule.limit}/{rule.period:g}" for rule in self.rules],
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "backend_errors": self.backend_errors,
+            **self.backend.get_stats()
+        }
+
+
+def cached_subject(token: str) -> Optional[str]:
+    """Subject de un token ya verificado por el proveedor (sin verificarlo aquí)"""
+    from app.core.auth.factory import get_identity_provider
+
+    token_cache = getattr(get_identity_provider(), "token_cache", None)
+    user_info = token_cache.get(token) if token_cache is not None else None
+    return user_info.user_id if user_info is not None else None
+
+
+def client_key(
+    scope: dict,
+    subject_lookup: Optional[Callable[[str], Optional[str]]] = cached_subject,
+    trust_proxy: bool = RATE_LIMIT_TRUST_PROXY
+) -> str:
+    """'sub:<id>' para tokens ya verificados, 'ip:<dirección>' en el resto de casos"""
+    authorization = forwarded_for = None
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            authorization = value
+        elif name == b"x-forwarded-for":
+            forwarded_for = value
+
+    if authorization and subject_lookup is not None:
+        scheme, _, token = authorization.decode("latin-1").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                subject = subject_lookup(token.strip())
+            except Exception:
+                subject = None
+            if subject:
+                return f"sub:{subject}"
+
+    if trust_proxy and forwarded_for:
+        # La última entrada es la que añade nuestro proxy; las anteriores las pone el cliente
+        return f"ip:{forwarded_for.decode('latin-1').split(',')[-1].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+def _retry_after_header(retry_after: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+class RateLimitMiddleware:
+    """Middleware ASGI: responde 429 con Retry-After cuando se agota el presupuesto"""
+
+    def __init__(
+        self,
+        app,
+        limiter: Optional[RateLimiter] = None,
+        subject_lookup: Optional[Callable[[str], Optional[str]]] = cached_subject,
+        trust_proxy: bool = RATE_LIMIT_TRUST_PROXY
+    ):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+        self.subject_lookup = subject_lookup
+        self.trust_proxy = trust_proxy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["rate_limit_checked"] = True
+        client = client_key(scope, self.subject_lookup, self.trust_proxy)
+        retry_after = await self.limiter.hit(scope["path"], client)
+        if retry_after is not None:
+            response = JSONResponse(
+                {"detail": "Demasiadas peticiones, inténtalo más tarde"},
+                status_code=429,
+                headers=_retry_after_header(retry_after)
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+async def enforce_rate_limit(request: Request):
+    """Dependency con el mismo límite, para routers que deben quedar protegidos sin el middleware"""
+    if request.scope.get("state", {}).get("rate_limit_checked"):
+        return
+    request.scope.setdefault("state", {})["rate_limit_checked"] = True
+    retry_after = await rate_limiter.hit(request.scope["path"], client_key(request.scope))
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones, inténtalo más tarde",
+            headers=_retry_after_header(retry_after)
+        )
+
+
+# Instancia global
+rate_limiter = RateLimiter(parse_rules(RATE_LIMIT_RULES), create_backend(), enabled=RATE_LIMIT_ENABLED)
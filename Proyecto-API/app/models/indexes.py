@@ -0,0 +1,20 @@
+"""
+Índices compuestos para consultas por rango temporal y paginación keyset.
+Se registran sobre las tablas existentes; create_db_and_tables los crea
+también en bases de datos ya inicializadas.
+"""
+from sqlalchemy import Index
+
+from app.models.motor_metrics import MotorMetrics
+from app.models.user import Message, User
+
+# Historial global ordenado por (created_at, id)
+Index("ix_motor_metrics_created_at_id", MotorMetrics.created_at, MotorMetrics.id)
+# Historial / stats de un dispositivo en una ventana temporal
+Index("ix_motor_metrics_device_created_at", MotorMetrics.device_id, MotorMetrics.created_at, MotorMetrics.id)
+# Ingesta idempotente: una lectura por dispositivo e instante (QoS 1 puede reentregar)
+Index("ux_motor_metrics_device_timestamp", MotorMetrics.device_id, MotorMetrics.timestamp, unique=True)
+# Listado de usuarios paginado
+Index("ix_users_created_at_id", User.created_at, User.id)
+# Mensajes de un usuario, del más reciente al más antiguo
+Index("ix_message_owner_id_id", Message.owner_id, Message.id)
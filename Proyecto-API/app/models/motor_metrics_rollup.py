@@ -0,0 +1,61 @@
+"""
+Tablas de agregados (rollups) por dispositivo de las métricas del motor.
+Cada fila resume un intervalo fijo (1 minuto o 1 hora) que empieza en
+`bucket` (epoch en segundos, UTC).
+"""
+from datetime import datetime
+from typing import Optional
+from sqlmodel import SQLModel, Field
+
+
+class MotorMetricsRollupBase(SQLModel):
+    """Columnas comunes: count, sum, min, max y suma de cuadrados por métrica"""
+    device_id: str = Field(primary_key=True)
+    bucket: int = Field(primary_key=True)
+    count: int = 0
+
+    temperature_sum: float = 0.0
+    temperature_min: Optional[float] = None
+    temperature_max: Optional[float] = None
+    temperature_sumsq: float = 0.0
+
+    rpm_sum: float = 0.0
+    rpm_min: Optional[float] = None
+    rpm_max: Optional[float] = None
+    rpm_sumsq: float = 0.0
+
+    oil_pressure_sum: float = 0.0
+    oil_pressure_min: Optional[float] = None
+    oil_pressure_max: Optional[float] = None
+    oil_pressure_sumsq: float = 0.0
+
+    vibration_sum: float = 0.0
+    vibration_min: Optional[float] = None
+    vibration_max: Optional[float] = None
+    vibration_sumsq: float = 0.0
+
+    load_percentage_sum: float = 0.0
+    load_percentage_min: Optional[float] = None
+    load_percentage_max: Optional[float] = None
+    load_percentage_sumsq: float = 0.0
+
+    status_running: int = 0
+    status_warning: int = 0
+    status_error: int = 0
+
+
+class MotorMetricsRollup1m(MotorMetricsRollupBase, table=True):
+    """Agregados por minuto"""
+    __tablename__ = "motor_metrics_rollup_1m"
+
+
+class MotorMetricsRollup1h(MotorMetricsRollupBase, table=True):
+    """Agregados por hora"""
+    __tablename__ = "motor_metrics_rollup_1h"
+
+
+class MotorMetricsRollupState(SQLModel, table=True):
+    """Marca de cobertura: los rollups están completos para created_at >= complete_from"""
+    __tablename__ = "motor_metrics_rollup_state"
+    name: str = Field(primary_key=True)
+    complete_from: datetime
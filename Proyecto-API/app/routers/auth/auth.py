@@ -3,42 +3,46 @@ Router de autenticación - Agnóstico del proveedor
 """
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 
 from app.models.schemas import Token, UserOut, TokenRefresh, UserRegister, UserLogin
 from app.core.auth import (
-    get_auth_provider,
+    get_async_auth_provider,
     get_current_user,
     get_current_user_with_db
 )
-from app.core.auth.base import IdentityProvider, UserInfo
+from app.core.auth.base import AsyncIdentityProvider, UserInfo
+from app.core.rate_limit import enforce_rate_limit
+from app.services.user_cache import LocalUser, upsert_local_user
 
-router = APIRouter()
+# Login y registro llegan al proveedor en cada intento: siempre con rate limit
+router = APIRouter(dependencies=[Depends(enforce_rate_limit)])
 
 @router.post("/login", response_model=Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    auth_provider: IdentityProvider = Depends(get_auth_provider)
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
 ):
     """Login con formulario (compatible con Swagger OAuth2)"""
-    token_response = auth_provider.login(form_data.username, form_data.password)
+    token_response = await auth_provider.login(form_data.username, form_data.password)
     return Token(**token_response.dict())
 
 @router.post("/login/json", response_model=Token)
-def login_json(
+async def login_json(
     user_data: UserLogin,
-    auth_provider: IdentityProvider = Depends(get_auth_provider)
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
 ):
     """Login con JSON (más cómodo para apps)"""
-    token_response = auth_provider.login(user_data.username, user_data.password)
+    token_response = await auth_provider.login(user_data.username, user_data.password)
     return Token(**token_response.dict())
 
 @router.post("/register", status_code=201, response_model=UserOut)
-def register(
+async def register(
     user_data: UserRegister,
-    auth_provider: IdentityProvider = Depends(get_auth_provider)
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
 ):
     """Registro agnóstico del proveedor"""
-    user_info = auth_provider.create_user(
+    user_info = await auth_provider.create_user(
         username=user_data.username,
         email=user_data.email,
         password=user_data.password,
@@ -46,20 +50,15 @@ def register(
         last_name=user_data.last_name
     )
     
-    # Sincronizar con DB local
+    # Sincronizar con DB local (sesión síncrona, fuera del event loop)
+    return await run_in_threadpool(_create_local_user, user_info)
+
+def _create_local_user(user_info: UserInfo) -> UserOut:
+    """Crea (upsert) el usuario local a partir del usuario recién creado en el proveedor"""
     from app.core.database.database import get_session
-    from app.models.user import User
-    from sqlmodel import Session
     
     with next(get_session()) as session:
-        user = User(
-            keycloak_id=user_info.user_id,
-            username=user_info.username,
-            email=user_info.email
-        )
-        session.add(user)
-        session.commit()
-        session.refresh(user)
+        user = upsert_local_user(session, user_info)
         
         return UserOut(
             id=user.id,
@@ -76,8 +75,7 @@ def register(
 def get_me(current_user: dict = Depends(get_current_user_with_db)):
     """Perfil del usuario actual"""
     user_info: UserInfo = current_user["user_info"]
-    from app.models.user import User
-    db_user: User = current_user["db_user"]
+    db_user: LocalUser = current_user["db_user"]
     
     return UserOut(
         id=db_user.id,
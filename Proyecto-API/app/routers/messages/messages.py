@@ -1,41 +1,65 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import SQLModel, create_engine, Session, select
-from app.models.user import Message, User
+"""
+Router de mensajes del usuario autenticado
+"""
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import delete
+from sqlmodel import Session, select
+from typing import List, Optional
+from app.models.user import Message
 from app.models.schemas import MessageCreate, MessageOut
-from app.core.security import get_current_user
-import os
-
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database/data.db")
-engine = create_engine(DATABASE_URL, echo=False)
-
-# Ensure tables exist
-SQLModel.metadata.create_all(engine)
+from app.core.auth import get_current_user_with_db
+from app.core.database.database import get_session
 
 router = APIRouter()
 
 @router.post("/", response_model=MessageOut, status_code=201)
-def create_message(payload: MessageCreate, user=Depends(get_current_user)):
-    with Session(engine) as session:
-        db_user = session.exec(select(User).where(User.username == user["username"])).first()
-        msg = Message(content=payload.content, owner_id=db_user.id)
-        session.add(msg)
-        session.commit()
-        session.refresh(msg)
-        return msg
+def create_message(
+    payload: MessageCreate,
+    current_user: dict = Depends(get_current_user_with_db),
+    session: Session = Depends(get_session)
+):
+    """Crea un mensaje del usuario actual"""
+    msg = Message(content=payload.content, owner_id=current_user["db_user"].id)
+    session.add(msg)
+    session.commit()
+    session.refresh(msg)
+    return msg
+
+@router.get("/", response_model=List[MessageOut])
+def list_my_messages(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor de la página anterior"),
+    current_user: dict = Depends(get_current_user_with_db),
+    session: Session = Depends(get_session)
+):
+    """
+    Lista los mensajes del usuario actual, del más reciente al más antiguo.
+    Paginación keyset sobre id: la siguiente página va en la cabecera X-Next-Cursor.
+    """
+    statement = select(Message).where(Message.owner_id == current_user["db_user"].id)
+    if cursor is not None:
+        statement = statement.where(Message.id < cursor)
+    msgs = session.exec(statement.order_by(Message.id.desc()).limit(limit)).all()
 
-@router.get("/", response_model=list[MessageOut])
-def list_my_messages(user=Depends(get_current_user)):
-    with Session(engine) as session:
-        db_user = session.exec(select(User).where(User.username == user["username"])).first()
-        msgs = session.exec(select(Message).where(Message.owner_id == db_user.id)).all()
-        return msgs
+    if len(msgs) == limit:
+        response.headers["X-Next-Cursor"] = str(msgs[-1].id)
+    return msgs
 
 @router.delete("/{message_id}", status_code=204)
-def delete_message(message_id: int, user=Depends(get_current_user)):
-    with Session(engine) as session:
-        msg = session.get(Message, message_id)
-        if not msg or msg.owner_id != session.exec(select(User).where(User.username == user["username"])).first().id:
-            raise HTTPException(status_code=404, detail="Message not found")
-        session.delete(msg)
-        session.commit()
-        return
+def delete_message(
+    message_id: int,
+    current_user: dict = Depends(get_current_user_with_db),
+    session: Session = Depends(get_session)
+):
+    """Elimina un mensaje propio (comprobación de propietario en la misma sentencia)"""
+    result = session.execute(
+        delete(Message).where(
+            Message.id == message_id,
+            Message.owner_id == current_user["db_user"].id
+        )
+    )
+    if result.rowcount == 0:
+        session.rollback()
+        raise HTTPException(status_code=404, detail="Message not found")
+    session.commit()
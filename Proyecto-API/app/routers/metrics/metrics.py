@@ -1,72 +1,512 @@
 """
 Router para métricas del motor
 """
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
-from typing import List
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from fastapi import (
+    APIRouter, Depends, Header, HTTPException, Query, Request,
+    WebSocket, WebSocketDisconnect, status
+)
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Optional, Union
 from app.models.motor_metrics import MotorMetrics, MotorMetricsOut
-from app.core.database.database import get_session
-from app.core.auth import get_current_user
+from app.core.database.database import get_pool_stats, read_session
+from app.core.auth import get_current_user, get_async_auth_provider
+from app.core.auth.base import AsyncIdentityProvider, UserInfo
+from app.core.pagination import apply_keyset, decode_cursor, estimated_count, next_cursor
 from app.services.mqtt_service import mqtt_service
+from app.services.metrics_broadcast import MetricsSubscription, metrics_broadcaster
+from app.services.metrics_cache import metrics_response_cache, normalize_key
+from app.services.metrics_export import (
+    EXPORT_MEDIA_TYPES,
+    STREAMERS,
+    check_format,
+    iter_batches
+)
+from app.services.metrics_store import metrics_store
+from app.services.metrics_streaming import streaming_stats
+from app.services.metrics_partitions import archive_file, list_archives, read_archive
+from app.services.metrics_history import (
+    build_bucket_query,
+    check_bucket_count,
+    check_bucket_rows,
+    downsample_lttb,
+    limit_buckets,
+    lttb_bucket_seconds,
+    parse_bucket,
+    rows_to_buckets
+)
+from app.services.metrics_rollup import (
+    build_rollup_bucket_query,
+    choose_rollup,
+    choose_rollup_for_buckets,
+    rollup_complete_from,
+    rollup_stats,
+    rollup_window
+)
+from app.services.metrics_stats import (
+    METRIC_FIELDS,
+    apply_filters,
+    build_stats_query,
+    row_to_stats,
+    validate_fields,
+    validate_percentiles
+)
 
 router = APIRouter()
 
+# Intervalo de keep-alive de los streams (segundos)
+STREAM_HEARTBEAT = float(os.getenv("METRICS_STREAM_HEARTBEAT", "15"))
+
 @router.get("/latest", response_model=dict)
-def get_latest_metrics(current_user: dict = Depends(get_current_user)):
+async def get_latest_metrics(
+    device_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """
-    Obtiene las últimas métricas en tiempo real (desde memoria)
+    Obtiene las últimas métricas en tiempo real (desde memoria).
+    Sin `device_id` devuelve la última lectura recibida de cualquier dispositivo.
     """
-    metrics = mqtt_service.get_latest_metrics()
+    metrics = mqtt_service.get_latest_metrics(device_id)
     if not metrics:
         raise HTTPException(status_code=404, detail="No hay métricas disponibles")
     return metrics
 
-@router.get("/history", response_model=List[MotorMetricsOut])
-def get_metrics_history(
-    limit: int = 100,
-    session: Session = Depends(get_session),
+@router.get("/latest/devices", response_model=dict)
+async def get_latest_metrics_by_device(current_user: dict = Depends(get_current_user)):
+    """
+    Obtiene la última lectura de cada dispositivo (desde memoria)
+    """
+    return metrics_store.latest_all()
+
+@router.get("/recent", response_model=dict)
+async def get_recent_metrics(
+    device_id: str,
+    minutes: float = Query(5, gt=0, le=1440),
+    fields: Optional[List[str]] = Query(None, description=f"Métricas: {', '.join(METRIC_FIELDS)}"),
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Obtiene el historial de métricas desde la base de datos
+    Obtiene las lecturas de los últimos `minutes` minutos de un dispositivo
+    y su resumen (count/avg/min/max), desde memoria y sin consultar la base de datos.
+    La ventana disponible está limitada por METRICS_STORE_CAPACITY muestras.
     """
-    statement = select(MotorMetrics).order_by(MotorMetrics.created_at.desc()).limit(limit)
-    metrics = session.exec(statement).all()
-    return metrics
+    fields = validate_fields(fields)
+    recent = metrics_store.recent(device_id, minutes * 60, fields)
+    if recent is None:
+        raise HTTPException(status_code=404, detail="No hay métricas disponibles")
+    return recent
+
+def _bearer_token(token: Optional[str], authorization: Optional[str]) -> Optional[str]:
+    """Token de la query (?token=, EventSource/WebSocket no envían cabeceras) o del header"""
+    if token:
+        return token
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:]
+    return None
+
+def _token_expired(user_info: UserInfo) -> bool:
+    exp = user_info.raw_data.get("exp")
+    return exp is not None and time.time() >= exp
+
+@router.get("/stream")
+async def stream_metrics(
+    request: Request,
+    device_id: Optional[List[str]] = Query(None, description="Filtra por dispositivo (repetible)"),
+    token: Optional[str] = Query(None),
+    authorization: Optional[str] = Header(None),
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
+):
+    """
+    Stream de métricas en vivo (Server-Sent Events).
+    Se autentica una sola vez al conectar; el stream se cierra cuando caduca el token.
+    """
+    bearer = _bearer_token(token, authorization)
+    if not bearer:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    user_info = await auth_provider.decode_token(bearer)
+    
+    try:
+        subscription = metrics_broadcaster.subscribe(device_id)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    
+    async def events():
+        async with subscription:
+            while not await request.is_disconnected():
+                if _token_expired(user_info):
+                    yield "event: expired\ndata: {}\n\n"
+                    break
+                message = await subscription.get(timeout=STREAM_HEARTBEAT)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"data: {message}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _forward_ws(websocket: WebSocket, subscription: MetricsSubscription, user_info: UserInfo):
+    """Reenvía los mensajes de la suscripción hasta que caduca el token"""
+    while not _token_expired(user_info):
+        message = await subscription.get(timeout=STREAM_HEARTBEAT)
+        if message is not None:
+            await websocket.send_text(message)
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token expirado")
+
+async def _wait_ws_disconnect(websocket: WebSocket):
+    """Descarta lo que envíe el cliente hasta que cierra la conexión"""
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@router.websocket("/stream/ws")
+async def stream_metrics_ws(
+    websocket: WebSocket,
+    device_id: Optional[List[str]] = Query(None),
+    token: Optional[str] = Query(None),
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
+):
+    """Stream de métricas en vivo por WebSocket (autenticado al conectar)"""
+    bearer = _bearer_token(token, websocket.headers.get("authorization"))
+    try:
+        if not bearer:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        user_info = await auth_provider.decode_token(bearer)
+        subscription = metrics_broadcaster.subscribe(device_id)
+    except (HTTPException, OverflowError):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    async with subscription:
+        # La desconexión se detecta aunque no llegue ningún mensaje de sus dispositivos
+        forward = asyncio.create_task(_forward_ws(websocket, subscription, user_info))
+        disconnect = asyncio.create_task(_wait_ws_disconnect(websocket))
+        done, pending = await asyncio.wait({forward, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        try:
+            for task in done:
+                task.result()
+        except WebSocketDisconnect:
+            pass
+
+@router.get("/ingest", response_model=dict)
+async def get_ingest_stats(current_user: dict = Depends(get_current_user)):
+    """
+    Obtiene los contadores de la ingesta MQTT (filas/s, lotes, profundidad de cola)
+    y el estado de los pools de conexiones (con la espera de checkout)
+    """
+    return {
+        **mqtt_service.get_ingest_stats(),
+        "memory_store": metrics_store.get_stats(),
+        "db_pool": get_pool_stats(),
+        "response_cache": metrics_response_cache.get_stats()
+    }
+
+async def _rollup_complete_from(session: AsyncSession, start: datetime, end: datetime) -> Optional[datetime]:
+    """Marca de cobertura de los rollups; solo se consulta si la ventana es larga"""
+    if not rollup_window(start, end):
+        return None
+    return await session.run_sync(rollup_complete_from)
+
+def _bucket_statement(dialect_name, bucket_seconds, fields, start, end, device_id, complete_from):
+    """Consulta por buckets: desde rollups en ventanas largas ya cubiertas, si no desde filas crudas"""
+    rollup = choose_rollup_for_buckets(start, end, bucket_seconds, complete_from)
+    if rollup is not None:
+        rollup_seconds, table = rollup
+        return build_rollup_bucket_query(
+            table, rollup_seconds, bucket_seconds, fields, start, end, device_id
+        )
+    return build_bucket_query(dialect_name, bucket_seconds, fields, start, end, device_id)
+
+@router.get("/history", response_model=Union[List[MotorMetricsOut], dict])
+async def get_metrics_history(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="Cursor X-Next-Cursor de la página anterior"),
+    include_total: bool = Query(False, description="Añade X-Total-Count"),
+    bucket: Optional[str] = Query(None, description="Agrega por intervalos: 10s, 1m, 1h, 1d..."),
+    mode: Optional[str] = Query(None, pattern="^lttb$", description="lttb: submuestreo a max_points"),
+    max_points: int = Query(500, ge=3, le=5000),
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    device_id: Optional[str] = None,
+    fields: Optional[List[str]] = Query(None, description=f"Métricas: {', '.join(METRIC_FIELDS)}"),
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Obtiene el historial de métricas desde la base de datos.
+    - Sin `bucket` ni `mode`: filas crudas (hasta `limit`), paginadas por cursor
+      sobre (created_at, id); la siguiente página va en la cabecera X-Next-Cursor.
+    - Con `bucket`: min/avg/max por intervalo y dispositivo, calculado en SQL.
+    - Con `mode=lttb`: como mucho `max_points` puntos por métrica (requiere `device_id`).
+    Las respuestas se cachean hasta que llegan métricas nuevas (con ETag / 304).
+    """
+    if bucket is not None or mode is not None:
+        fields = validate_fields(fields)
+    key = normalize_key("history", {
+        "limit": limit, "cursor": cursor, "include_total": include_total,
+        "bucket": bucket, "mode": mode, "max_points": max_points,
+        "from": from_, "to": to, "device_id": device_id, "fields": fields
+    })
+    
+    async def compute():
+        # La sesión se abre solo si hay que calcular
+        async with read_session() as session:
+            return await _metrics_history(
+                session, limit, cursor, include_total, bucket, mode, max_points,
+                from_, to, device_id, fields
+            )
+    
+    cached = await metrics_response_cache.get_or_compute(key, device_id, compute)
+    return metrics_response_cache.respond(cached, if_none_match)
+
+async def _metrics_history(
+    session: AsyncSession,
+    limit: int,
+    cursor: Optional[str],
+    include_total: bool,
+    bucket: Optional[str],
+    mode: Optional[str],
+    max_points: int,
+    from_: Optional[datetime],
+    to: Optional[datetime],
+    device_id: Optional[str],
+    fields: Optional[List[str]]
+):
+    """Calcula el historial: (contenido, cabeceras extra)"""
+    headers = {}
+    if bucket is None and mode is None:
+        statement = apply_filters(select(MotorMetrics), from_, to, device_id)
+        statement = apply_keyset(statement, MotorMetrics, cursor, descending=True).limit(limit)
+        metrics = (await session.exec(statement)).all()
+        
+        cursor_next = next_cursor(metrics, limit)
+        if cursor_next:
+            headers["X-Next-Cursor"] = cursor_next
+        if include_total:
+            if from_ is None and to is None and device_id is None:
+                total = await session.run_sync(estimated_count, MotorMetrics)
+            else:
+                count_statement = apply_filters(
+                    select(func.count()).select_from(MotorMetrics), from_, to, device_id
+                )
+                total = (await session.exec(count_statement)).one()
+            headers["X-Total-Count"] = str(total)
+        return [MotorMetricsOut.model_validate(m, from_attributes=True) for m in metrics], headers
+    
+    end = to or datetime.utcnow()
+    start = from_ or end - timedelta(hours=24)
+    dialect_name = session.get_bind().dialect.name
+    complete_from = await _rollup_complete_from(session, start, end)
+    
+    if mode == "lttb":
+        if device_id is None:
+            raise HTTPException(status_code=400, detail="El modo lttb requiere device_id")
+        bucket_seconds = lttb_bucket_seconds(start, end, max_points)
+        if bucket_seconds >= 60:
+            # Redondear a minutos para poder leer del rollup
+            bucket_seconds = -(-bucket_seconds // 60) * 60
+        statement = _bucket_statement(
+            dialect_name, bucket_seconds, fields, start, end, device_id, complete_from
+        )
+        return {
+            "mode": "lttb",
+            "from": start,
+            "to": end,
+            "device_id": device_id,
+            "max_points": max_points,
+            "series": downsample_lttb((await session.exec(statement)).all(), fields, max_points)
+        }, headers
+    
+    bucket_seconds = parse_bucket(bucket)
+    check_bucket_count(start, end, bucket_seconds)
+    statement = limit_buckets(_bucket_statement(
+        dialect_name, bucket_seconds, fields, start, end, device_id, complete_from
+    ))
+    rows = (await session.exec(statement)).all()
+    check_bucket_rows(rows)
+    return {
+        "bucket": bucket,
+        "bucket_seconds": bucket_seconds,
+        "from": start,
+        "to": end,
+        "device_id": device_id,
+        "buckets": rows_to_buckets(rows, fields)
+    }, headers
+
+@router.get("/export")
+def export_metrics(
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet)$"),
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    device_id: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="Columna cursor de la última fila recibida (reanudar)"),
+    include_cursor: bool = Query(True, description="Añade a cada fila la columna cursor"),
+    batch_size: int = Query(5000, ge=100, le=50000),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Exporta el historial de métricas en streaming (CSV, NDJSON o Parquet).
+    Las filas se leen en lotes con un cursor del servidor, ordenadas por
+    (created_at, id); la memoria no depende del tamaño del rango.
+    Para reanudar una descarga interrumpida, pasa como `cursor` el valor de
+    la columna `cursor` de la última fila recibida.
+    """
+    check_format(format)
+    if cursor:
+        # Validar antes de empezar a enviar la respuesta
+        decode_cursor(cursor)
+    
+    batches = iter_batches(from_, to, device_id, cursor, batch_size)
+    filename = f"motor_metrics_{datetime.utcnow():%Y%m%dT%H%M%S}.{format}"
+    return StreamingResponse(
+        STREAMERS[format](batches, include_cursor),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @router.get("/stats", response_model=dict)
-def get_metrics_stats(
-    session: Session = Depends(get_session),
+async def get_metrics_stats(
+    from_: Optional[datetime] = Query(None, alias="from", description="Inicio (por defecto, hace 24h)"),
+    to: Optional[datetime] = Query(None, description="Fin (exclusivo, por defecto ahora)"),
+    device_id: Optional[str] = None,
+    fields: Optional[List[str]] = Query(None, description=f"Métricas: {', '.join(METRIC_FIELDS)}"),
+    percentiles: Optional[List[float]] = Query(None, description="Percentiles entre 0 y 1"),
+    source: str = Query(
+        "auto", pattern="^(auto|raw|rollup)$",
+        description="rollup: ventanas largas desde los rollups (sin percentiles)"
+    ),
+    if_none_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Obtiene estadísticas agregadas de las métricas
+    Obtiene estadísticas agregadas de las métricas.
+    Se calculan en la base de datos desde las filas crudas. Con
+    `source=rollup` (o `auto` sin percentiles) las ventanas largas se leen
+    de los rollups, sin percentiles, si ya cubren el inicio de la ventana.
+    Las respuestas se cachean hasta que llegan métricas nuevas (con ETag / 304).
     """
-    # Últimas 100 métricas
-    statement = select(MotorMetrics).order_by(MotorMetrics.created_at.desc()).limit(100)
-    metrics = session.exec(statement).all()
+    fields = validate_fields(fields)
+    percentiles = validate_percentiles(percentiles)
+    key = normalize_key("stats", {
+        "from": from_, "to": to, "device_id": device_id, "fields": fields,
+        "percentiles": percentiles, "source": source
+    })
     
-    if not metrics:
-        raise HTTPException(status_code=404, detail="No hay datos disponibles")
+    async def compute():
+        async with read_session() as session:
+            return await _metrics_stats(session, from_, to, device_id, fields, percentiles, source), {}
     
-    temps = [m.temperature for m in metrics]
-    rpms = [m.rpm for m in metrics]
+    cached = await metrics_response_cache.get_or_compute(key, device_id, compute)
+    return metrics_response_cache.respond(cached, if_none_match)
+
+async def _metrics_stats(
+    session: AsyncSession,
+    from_: Optional[datetime],
+    to: Optional[datetime],
+    device_id: Optional[str],
+    fields: List[str],
+    percentiles: List[float],
+    source: str
+) -> dict:
+    end = to or datetime.utcnow()
+    start = from_ or end - timedelta(hours=24)
     
+    if source == "rollup":
+        percentiles = []
+    rollup = None
+    if source == "rollup" or (source == "auto" and not percentiles):
+        rollup = choose_rollup(start, end, await _rollup_complete_from(session, start, end))
+    if rollup is not None:
+        # Ventana larga: buckets completos del rollup + bordes desde filas crudas
+        bucket_seconds, table = rollup
+        stats = await session.run_sync(
+            rollup_stats, bucket_seconds, table, fields, percentiles, start, end, device_id
+        )
+    else:
+        statement = build_stats_query(
+            session.get_bind().dialect.name, fields, percentiles,
+            start=start, end=end, device_id=device_id
+        )
+        stats = row_to_stats((await session.exec(statement)).one(), fields, percentiles)
+    
+    if not stats["total_records"]:
+        raise HTTPException(status_code=404, detail="No hay datos disponibles")
+    
+    stats["from"] = start
+    stats["to"] = end
+    stats["device_id"] = device_id
+    return stats
+
+@router.get("/stats/live", response_model=dict)
+async def get_live_stats(
+    device_id: str,
+    fields: Optional[List[str]] = Query(None, description=f"Métricas: {', '.join(METRIC_FIELDS)}"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Obtiene las estadísticas incrementales de un dispositivo (desde memoria):
+    último valor, EWMA, media/desviación/min/max y cuantiles aproximados
+    del total, de la ventana fija actual y anterior y de la ventana deslizante.
+    """
+    fields = validate_fields(fields)
+    stats = streaming_stats.get_stats(device_id, fields)
+    if not stats:
+        raise HTTPException(status_code=404, detail="No hay datos disponibles")
     return {
-        "temperature": {
-            "avg": sum(temps) / len(temps),
-            "min": min(temps),
-            "max": max(temps)
-        },
-        "rpm": {
-            "avg": sum(rpms) / len(rpms),
-            "min": min(rpms),
-            "max": max(rpms)
-        },
-        "total_records": len(metrics),
-        "status_distribution": {
-            "running": sum(1 for m in metrics if m.status == "running"),
-            "warning": sum(1 for m in metrics if m.status == "warning"),
-            "error": sum(1 for m in metrics if m.status == "error")
-        }
+        "device_id": device_id,
+        "tumbling_seconds": streaming_stats.tumbling_seconds,
+        "sliding_seconds": streaming_stats.sliding_seconds,
+        "metrics": stats
     }
+
+@router.get("/anomalies", response_model=List[dict])
+async def get_anomalies(
+    device_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Obtiene las últimas anomalías detectadas (umbral fijo o z-score), de la más reciente a la más antigua
+    """
+    return streaming_stats.recent_anomalies(device_id, limit)
+
+@router.get("/archive", response_model=List[dict])
+def get_archived_partitions(current_user: dict = Depends(get_current_user)):
+    """
+    Lista las particiones archivadas por la política de retención
+    (periodo, filas y tamaño del fichero comprimido)
+    """
+    return list_archives()
+
+@router.get("/archive/{name}")
+def query_archived_partition(
+    name: str,
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    device_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Consulta una partición archivada: devuelve sus filas en NDJSON (streaming),
+    filtradas por ventana temporal y dispositivo
+    """
+    path = archive_file(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Partición archivada no encontrada")
+    return StreamingResponse(
+        read_archive(path, from_, to, device_id, limit),
+        media_type="application/x-ndjson"
+    )
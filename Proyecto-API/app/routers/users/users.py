@@ -1,41 +1,96 @@
 """
 Router de Usuarios
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 from sqlmodel import Session, select
-from typing import List
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Optional
 
 from app.models.user import User
 from app.models.schemas import UserOut
-from app.core.auth import require_role, get_current_user_with_db
-from app.core.database.database import get_session
+from app.core.auth import require_role, get_async_auth_provider, get_current_user_with_db
+from app.core.auth.base import AsyncIdentityProvider
+from app.core.database.database import get_read_session, get_session
+from app.core.pagination import apply_keyset, estimated_count, next_cursor
+from app.services.user_cache import LocalUser, local_user_cache
+from app.services.user_import import import_users, parse_rows
 
 router = APIRouter()
 
-@router.get("/", dependencies=[Depends(require_role("admin"))], response_model=List[UserOut])
-def list_users(session: Session = Depends(get_session)):
+class UserPage(BaseModel):
+    """Página de usuarios (formato que consume dashboard.js)"""
+    users: List[UserOut]
+    total: int
+    page: int
+    page_size: int
+    next_cursor: Optional[str] = None
+
+@router.get("/", dependencies=[Depends(require_role("admin"))], response_model=UserPage)
+async def list_users(
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="next_cursor de la respuesta anterior"),
+    session: AsyncSession = Depends(get_read_session),
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
+):
     """
-    Lista todos los usuarios (solo admins).
+    Lista usuarios paginados (solo admins).
+    Con `cursor` se usa paginación keyset sobre (created_at, id), de coste
+    constante en cualquier página; `page` se mantiene para el dashboard.
+    `total` es aproximado en PostgreSQL (estadística del planificador).
+    Los roles salen del índice de roles del proveedor (sin una llamada por usuario).
     """
-    users = session.exec(select(User)).all()
+    statement = apply_keyset(select(User), User, cursor)
+    if not cursor:
+        statement = statement.offset((page - 1) * page_size)
+    users = (await session.exec(statement.limit(page_size))).all()
+    total = await session.run_sync(estimated_count, User)
+    roles = await auth_provider.get_users_roles([user.keycloak_id for user in users])
     
-    # Convertir a schema con roles vacíos (no están en DB local)
-    return [
-        UserOut(
-            id=user.id,
-            keycloak_id=user.keycloak_id,
-            username=user.username,
-            email=user.email,
-            is_active=user.is_active,
-            profile_completed=user.profile_completed,
-            created_at=user.created_at,
-            roles=[]  # Los roles están en Keycloak, no en DB
-        )
-        for user in users
-    ]
+    return UserPage(
+        users=[
+            UserOut(
+                id=user.id,
+                keycloak_id=user.keycloak_id,
+                username=user.username,
+                email=user.email,
+                is_active=user.is_active,
+                profile_completed=user.profile_completed,
+                created_at=user.created_at,
+                roles=roles.get(user.keycloak_id, [])  # Los roles están en Keycloak, no en DB
+            )
+            for user in users
+        ],
+        total=total,
+        page=page,
+        page_size=page_size,
+        next_cursor=next_cursor(users, page_size)
+    )
+
+@router.post("/import", dependencies=[Depends(require_role("admin"))])
+async def bulk_import_users(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|json)$", description="Por defecto, según el Content-Type"),
+    auth_provider: AsyncIdentityProvider = Depends(get_async_auth_provider)
+):
+    """
+    Alta masiva de usuarios (solo admins).
+    Cuerpo: CSV con cabecera (username,email,password,first_name,last_name,roles)
+    o array JSON con esos campos; `roles` separados por ';' en el CSV.
+    Las altas en el proveedor se hacen con USER_IMPORT_CONCURRENCY llamadas en
+    vuelo y la respuesta es NDJSON: una línea por fila, progreso y resumen final.
+    """
+    import_format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "json")
+    rows = parse_rows(await request.body(), import_format)
+    return StreamingResponse(
+        import_users(auth_provider, rows),
+        media_type="application/x-ndjson"
+    )
 
 @router.get("/me", response_model=UserOut)
-def get_current_user_profile(
+async def get_current_user_profile(
     current_user: dict = Depends(get_current_user_with_db)
 ):
     """
@@ -65,7 +120,10 @@ def update_profile(
     Actualiza campos específicos de la aplicación.
     NO puedes cambiar email/username (están en Keycloak).
     """
-    db_user = current_user["db_user"]
+    # db_user es una copia cacheada: actualizar la fila real y refrescar la caché
+    db_user = session.get(User, current_user["db_user"].id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     # Actualizar campos locales
     db_user.profile_completed = profile_completed
@@ -75,6 +133,7 @@ def update_profile(
     session.add(db_user)
     session.commit()
     session.refresh(db_user)
+    local_user_cache.put(LocalUser.model_validate(db_user))
     
     return UserOut(
         id=db_user.id,
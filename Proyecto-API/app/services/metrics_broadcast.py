@@ -0,0 +1,132 @@
+"""
+Difusión en vivo de métricas MQTT a clientes asyncio (SSE / WebSocket).
+
+El hilo de red de paho publica cada mensaje; cada suscriptor tiene un
+buffer acotado propio con política drop-oldest, de modo que un cliente
+lento solo pierde sus mensajes más antiguos y nunca bloquea al resto.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsSubscription:
+    """Suscripción de un cliente: buffer acotado + despertador del event loop"""
+
+    def __init__(
+        self,
+        broadcaster: "MetricsBroadcaster",
+        loop: asyncio.AbstractEventLoop,
+        device_ids: Optional[Set[str]],
+        buffer_size: int
+    ):
+        self._broadcaster = broadcaster
+        self._loop = loop
+        self.device_ids = device_ids
+        self.buffer: deque = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._event = asyncio.Event()
+        self._wakeup_pending = False
+        self.closed = False
+
+    def matches(self, payload: Dict[str, Any]) -> bool:
+        return self.device_ids is None or payload.get("device_id") in self.device_ids
+
+    def push(self, message: str):
+        """Llamado desde el hilo MQTT; nunca bloquea"""
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1  # deque(maxlen) descarta el más antiguo
+        self.buffer.append(message)
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            try:
+                self._loop.call_soon_threadsafe(self._event.set)
+            except RuntimeError:
+                # Event loop cerrado: el cliente ya no existe
+                self.close()
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Siguiente mensaje (JSON), o None si vence el timeout"""
+        while True:
+            self._wakeup_pending = False
+            self._event.clear()
+            if self.buffer:
+                return self.buffer.popleft()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._broadcaster.unsubscribe(self)
+
+    async def __aenter__(self) -> "MetricsSubscription":
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+class MetricsBroadcaster:
+    """Fan-out de métricas desde el hilo MQTT a los suscriptores asyncio"""
+
+    def __init__(self, buffer_size: int = None, max_subscribers: int = None):
+        self.buffer_size = buffer_size or int(os.getenv("METRICS_STREAM_BUFFER", "100"))
+        self.max_subscribers = max_subscribers or int(os.getenv("METRICS_STREAM_MAX_CLIENTS", "500"))
+        self._subscribers: Set[MetricsSubscription] = set()
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, device_ids: Optional[Iterable[str]] = None) -> MetricsSubscription:
+        """Crea una suscripción ligada al event loop actual"""
+        subscription = MetricsSubscription(
+            self,
+            asyncio.get_running_loop(),
+            set(device_ids) if device_ids else None,
+            self.buffer_size
+        )
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise OverflowError("Demasiados clientes de streaming")
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: MetricsSubscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, payload: Dict[str, Any]):
+        """Entrega un mensaje a todos los suscriptores interesados (thread-safe)"""
+        self.published += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        # Se serializa una sola vez para todos los clientes
+        message = None
+        for subscription in subscribers:
+            if subscription.matches(payload):
+                if message is None:
+                    message = json.dumps(payload)
+                subscription.push(message)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        return {
+            "subscribers": len(subscribers),
+            "published": self.published,
+            "dropped": sum(s.dropped for s in subscribers),
+            "buffer_size": self.buffer_size
+        }
+
+
+# Instancia global
+metrics_broadcaster = MetricsBroadcaster()
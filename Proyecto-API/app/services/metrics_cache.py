@@ -0,0 +1,207 @@
+"""
+Caché de respuestas de /metrics/stats y /metrics/history.
+
+Cada entrada se guarda con la versión de datos vigente al calcularla: el
+writer sube la versión (global y del dispositivo) cada vez que confirma
+filas nuevas, así que una entrada de una versión anterior ya no se sirve.
+El TTL corto acota el resto de cambios que no pasan por este proceso
+(otros workers de la suscripción compartida, ventanas relativas a "ahora").
+
+Peticiones idénticas concurrentes comparten un único cálculo (single-flight)
+y las respuestas llevan ETag para contestar 304 a If-None-Match.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+
+def normalize_key(endpoint: str, params: Dict[str, Any]) -> Tuple:
+    """Clave estable a partir de los parámetros ya validados de la consulta"""
+    items = []
+    for name, value in sorted(params.items()):
+        if isinstance(value, (list, tuple)):
+            value = tuple(value)
+        elif hasattr(value, "isoformat"):
+            value = value.isoformat()
+        items.append((name, value))
+    return (endpoint, tuple(items))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (admite listas, W/ y *)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class CachedResponse:
+    """Cuerpo JSON ya serializado, cabeceras extra y su ETag"""
+
+    __slots__ = ("body", "headers", "etag")
+
+    def __init__(self, content: Any, headers: Optional[Dict[str, str]] = None):
+        self.body = json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+        self.headers = dict(headers or {})
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+
+    def to_response(self, if_none_match: Optional[str] = None) -> Response:
+        headers = {**self.headers, "ETag": self.etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(if_none_match, self.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+
+class _LeaderCancelled(Exception):
+    """El cálculo compartido se canceló (el cliente que lo lanzó se desconectó)"""
+
+
+class MetricsResponseCache:
+    """Caché LRU con TTL y versión de datos; debe usarse desde el event loop"""
+
+    def __init__(self, ttl: float = 5.0, max_entries: int = 500, max_body_bytes: int = 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        # key -> (versión, expira, respuesta)
+        self._entries: "OrderedDict[Tuple, Tuple[int, float, CachedResponse]]" = OrderedDict()
+        self._inflight: Dict[Tuple[Hashable, int], asyncio.Future] = {}
+        # Las versiones las sube el hilo del writer
+        self._version_lock = threading.Lock()
+        self._version = 0
+        self._device_versions: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+
+    # --- Versiones de datos ---
+
+    def version(self, device_id: Optional[str] = None) -> int:
+        """Versión global o, si se filtra por dispositivo, la de ese dispositivo"""
+        with self._version_lock:
+            if device_id is None:
+                return self._version
+            return self._device_versions.get(device_id, 0)
+
+    def on_rows(self, rows: List[Dict[str, Any]]):
+        """Listener del writer: filas recién confirmadas en la DB"""
+        devices = {row["device_id"] for row in rows}
+        with self._version_lock:
+            self._version += 1
+            for device_id in devices:
+                self._device_versions[device_id] = self._version
+
+    def invalidate(self):
+        """Invalida todas las entradas (p. ej. tras borrar datos)"""
+        with self._version_lock:
+            self._version += 1
+            self._device_versions = {device: self._version for device in self._device_versions}
+
+    # --- Caché ---
+
+    def _get(self, key: Tuple, version: int) -> Optional[CachedResponse]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        entry_version, expires, response = item
+        if entry_version != version or expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _put(self, key: Tuple, version: int, response: CachedResponse):
+        if self.ttl <= 0 or len(response.body) > self.max_body_bytes:
+            return
+        self._entries[key] = (version, time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(
+        self,
+        key: Tuple,
+        device_id: Optional[str],
+        compute: Callable[[], Awaitable[Tuple[Any, Dict[str, str]]]]
+    ) -> CachedResponse:
+        """
+        Respuesta cacheada o calculada con `compute()` (contenido, cabeceras).
+        Si ya hay un cálculo en curso para la misma clave y versión, se espera
+        a ese en lugar de repetir la consulta.
+        """
+        while True:
+            version = self.version(device_id)
+            cached = self._get(key, version)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            flight = self._inflight.get((key, version))
+            if flight is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(flight)
+            except _LeaderCancelled:
+                continue
+
+        self.misses += 1
+        flight = asyncio.get_running_loop().create_future()
+        # Evita el aviso de excepción no recuperada si nadie más esperaba
+        flight.add_done_callback(lambda f: f.exception())
+        self._inflight[(key, version)] = flight
+        try:
+            content, headers = await compute()
+            response = CachedResponse(content, headers)
+            self._put(key, version, response)
+            flight.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            flight.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop((key, version), None)
+
+    def respond(self, response: CachedResponse, if_none_match: Optional[str]) -> Response:
+        result = response.to_response(if_none_match)
+        if result.status_code == 304:
+            self.not_modified += 1
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "version": self.version(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "not_modified": self.not_modified,
+            "ttl_seconds": self.ttl,
+        }
+
+
+# Instancia global
+metrics_response_cache = MetricsResponseCache(
+    ttl=float(os.getenv("METRICS_CACHE_TTL", "5")),
+    max_entries=int(os.getenv("METRICS_CACHE_MAX_ENTRIES", "500")),
+    max_body_bytes=int(os.getenv("METRICS_CACHE_MAX_BODY_BYTES", str(1024 * 1024)))
+)
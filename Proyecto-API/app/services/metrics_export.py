@@ -0,0 +1,181 @@
+"""
+Exportación masiva del historial de métricas en streaming (CSV, NDJSON, Parquet).
+
+Las filas se leen con un cursor del lado del servidor (stream_results) en
+lotes de tamaño fijo y se serializan lote a lote, sin crear objetos ORM ni
+pydantic: la memoria usada es la misma exporte mil filas o cien millones.
+El orden es (created_at, id), así que una descarga interrumpida se reanuda
+pasando como `cursor` la columna `cursor` de la última fila recibida.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Any, Iterator, List, Optional, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlmodel import Session
+
+from app.core.database.database import engine
+from app.core.pagination import apply_keyset, encode_cursor
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_stats import apply_filters
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # dependencia opcional, solo para format=parquet
+    pyarrow = None
+
+EXPORT_FORMATS = ("csv", "ndjson", "parquet")
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_COLUMNS = (
+    "id", "device_id", "device_name", "device_ip", "device_subnet", "device_mac",
+    "temperature", "rpm", "oil_pressure", "vibration", "load_percentage",
+    "status", "event", "timestamp", "datetime", "created_at",
+)
+_ID = EXPORT_COLUMNS.index("id")
+_CREATED_AT = EXPORT_COLUMNS.index("created_at")
+
+
+def check_format(export_format: str):
+    if export_format == "parquet" and pyarrow is None:
+        raise HTTPException(status_code=400, detail="Exportar a Parquet requiere instalar pyarrow")
+
+
+def iter_batches(
+    start: Optional[datetime],
+    end: Optional[datetime],
+    device_id: Optional[str],
+    cursor: Optional[str],
+    batch_size: int
+) -> Iterator[Sequence[Any]]:
+    """Lotes de filas (tuplas en el orden de EXPORT_COLUMNS) leídos con cursor de servidor"""
+    columns = [getattr(MotorMetrics, name) for name in EXPORT_COLUMNS]
+    statement = apply_filters(select(*columns), start, end, device_id)
+    statement = apply_keyset(statement, MotorMetrics, cursor)
+
+    with Session(engine) as session:
+        connection = session.connection(
+            execution_options={"stream_results": True, "yield_per": batch_size}
+        )
+        result = connection.execute(statement)
+        for partition in result.partitions(batch_size):
+            yield partition
+
+
+def _row_cursor(row: Sequence[Any]) -> str:
+    return encode_cursor(row[_CREATED_AT], row[_ID])
+
+
+def _header(include_cursor: bool) -> List[str]:
+    return list(EXPORT_COLUMNS) + (["cursor"] if include_cursor else [])
+
+
+def stream_csv(batches: Iterator[Sequence[Any]], include_cursor: bool) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(_header(include_cursor))
+    for batch in batches:
+        for row in batch:
+            values = list(row)
+            values[_CREATED_AT] = row[_CREATED_AT].isoformat()
+            if include_cursor:
+                values.append(_row_cursor(row))
+            writer.writerow(values)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_ndjson(batches: Iterator[Sequence[Any]], include_cursor: bool) -> Iterator[str]:
+    for batch in batches:
+        lines = []
+        for row in batch:
+            item = dict(zip(EXPORT_COLUMNS, row))
+            item["created_at"] = row[_CREATED_AT].isoformat()
+            if include_cursor:
+                item["cursor"] = _row_cursor(row)
+            lines.append(json.dumps(item))
+        lines.append("")
+        yield "\n".join(lines)
+
+
+class _ChunkSink:
+    """Fichero de solo escritura que acumula los bytes hasta que se recogen"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema(include_cursor: bool):
+    fields = [
+        ("id", pyarrow.int64()),
+        ("device_id", pyarrow.string()),
+        ("device_name", pyarrow.string()),
+        ("device_ip", pyarrow.string()),
+        ("device_subnet", pyarrow.string()),
+        ("device_mac", pyarrow.string()),
+        ("temperature", pyarrow.float64()),
+        ("rpm", pyarrow.float64()),
+        ("oil_pressure", pyarrow.float64()),
+        ("vibration", pyarrow.float64()),
+        ("load_percentage", pyarrow.float64()),
+        ("status", pyarrow.string()),
+        ("event", pyarrow.string()),
+        ("timestamp", pyarrow.float64()),
+        ("datetime", pyarrow.string()),
+        ("created_at", pyarrow.timestamp("us")),
+    ]
+    if include_cursor:
+        fields.append(("cursor", pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+def stream_parquet(batches: Iterator[Sequence[Any]], include_cursor: bool) -> Iterator[bytes]:
+    """Un row group por lote; cada row group se envía en cuanto se escribe"""
+    schema = _parquet_schema(include_cursor)
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for batch in batches:
+            columns = [list(column) for column in zip(*batch)]
+            if include_cursor:
+                columns.append([_row_cursor(row) for row in batch])
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+STREAMERS = {"csv": stream_csv, "ndjson": stream_ndjson, "parquet": stream_parquet}
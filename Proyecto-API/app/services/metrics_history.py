@@ -0,0 +1,187 @@
+"""
+Historial de métricas agregado por intervalos de tiempo (buckets)
+y submuestreo LTTB (Largest-Triangle-Three-Buckets) para gráficas.
+"""
+import math
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import BigInteger, cast, extract, func, select
+
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_stats import apply_filters
+
+# Número máximo de buckets que puede devolver una consulta
+MAX_BUCKETS = 10000
+# Buckets precalculados en SQL por cada punto final en modo LTTB
+LTTB_OVERSAMPLE = 4
+
+_BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_BUCKET_RE = re.compile(r"^(\d+)([smhd])$")
+
+
+def parse_bucket(bucket: str) -> int:
+    """Convierte '10s', '1m', '1h', '1d' en segundos"""
+    match = _BUCKET_RE.match(bucket.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Bucket no válido. Usa un entero seguido de s, m, h o d (ej. 10s, 1m, 1h)"
+        )
+    return int(match.group(1)) * _BUCKET_UNITS[match.group(2)]
+
+
+def bucket_expression(dialect_name: str, bucket_seconds: int):
+    """Inicio del bucket (epoch en segundos) de cada fila"""
+    epoch = extract("epoch", MotorMetrics.created_at)
+    if dialect_name == "postgresql":
+        return func.floor(epoch / bucket_seconds) * bucket_seconds
+    # En SQLite el CAST trunca (epochs positivos)
+    return cast(epoch / bucket_seconds, BigInteger) * bucket_seconds
+
+
+def build_bucket_query(
+    dialect_name: str,
+    bucket_seconds: int,
+    fields: Sequence[str],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    device_id: Optional[str] = None
+):
+    """min/avg/max por bucket y dispositivo, calculado en la base de datos"""
+    bucket = bucket_expression(dialect_name, bucket_seconds).label("bucket")
+    columns = [MotorMetrics.device_id, bucket, func.count().label("count")]
+    for field in fields:
+        column = getattr(MotorMetrics, field)
+        columns.extend([
+            func.min(column).label(f"{field}_min"),
+            func.avg(column).label(f"{field}_avg"),
+            func.max(column).label(f"{field}_max"),
+        ])
+
+    statement = select(*columns)
+    statement = apply_filters(statement, start, end, device_id)
+    return statement.group_by(MotorMetrics.device_id, bucket).order_by(MotorMetrics.device_id, bucket)
+
+
+def check_bucket_count(start: datetime, end: datetime, bucket_seconds: int):
+    """Rechazo previo: intervalos de tiempo del rango (por dispositivo)"""
+    if (end - start).total_seconds() / bucket_seconds > MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El rango pedido genera más de {MAX_BUCKETS} buckets; usa un bucket mayor"
+        )
+
+
+def limit_buckets(statement):
+    """
+    Sin device_id hay un bucket por intervalo y dispositivo: se pide una
+    fila más de MAX_BUCKETS para detectar si el resultado se pasa
+    """
+    return statement.limit(MAX_BUCKETS + 1)
+
+
+def check_bucket_rows(rows: Sequence[Any]):
+    if len(rows) > MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"El rango pedido genera más de {MAX_BUCKETS} buckets entre todos los "
+                "dispositivos; usa un bucket mayor o filtra por device_id"
+            )
+        )
+
+
+def _epoch_to_datetime(epoch: Any) -> datetime:
+    return datetime.fromtimestamp(float(epoch), tz=timezone.utc).replace(tzinfo=None)
+
+
+def rows_to_buckets(rows: Sequence[Any], fields: Sequence[str]) -> List[Dict[str, Any]]:
+    """Convierte las filas agregadas en la lista de buckets de la respuesta"""
+    buckets = []
+    for row in rows:
+        data = row._mapping
+        item = {
+            "device_id": data["device_id"],
+            "start": _epoch_to_datetime(data["bucket"]),
+            "count": data["count"],
+        }
+        for field in fields:
+            item[field] = {
+                "min": data[f"{field}_min"],
+                "avg": data[f"{field}_avg"],
+                "max": data[f"{field}_max"],
+            }
+        buckets.append(item)
+    return buckets
+
+
+def lttb_bucket_seconds(start: datetime, end: datetime, max_points: int) -> int:
+    """Ancho de bucket para que SQL devuelva ~max_points * LTTB_OVERSAMPLE puntos"""
+    span = (end - start).total_seconds()
+    return max(1, math.ceil(span / (max_points * LTTB_OVERSAMPLE)))
+
+
+def lttb(points: Sequence[Tuple[float, float]], threshold: int) -> List[Tuple[float, float]]:
+    """
+    Largest-Triangle-Three-Buckets (Steinarsson, 2013).
+    Reduce una serie (x, y) ordenada por x a `threshold` puntos
+    conservando la forma visual (picos incluidos).
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # Media del siguiente bucket (tercer vértice del triángulo)
+        next_start = int(math.floor((i + 1) * every)) + 1
+        next_end = min(int(math.floor((i + 2) * every)) + 1, n)
+        next_len = next_end - next_start
+        avg_x = sum(p[0] for p in points[next_start:next_end]) / next_len
+        avg_y = sum(p[1] for p in points[next_start:next_end]) / next_len
+
+        # Punto del bucket actual que forma el triángulo de mayor área
+        range_start = int(math.floor(i * every)) + 1
+        range_end = int(math.floor((i + 1) * every)) + 1
+        ax, ay = points[a]
+        max_area = -1.0
+        max_index = range_start
+        for j in range(range_start, range_end):
+            area = abs(
+                (ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay)
+            )
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        sampled.append(points[max_index])
+        a = max_index
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def downsample_lttb(
+    rows: Sequence[Any],
+    fields: Sequence[str],
+    max_points: int
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Aplica LTTB a la media por bucket de cada métrica"""
+    series = {}
+    for field in fields:
+        points = [
+            (float(row._mapping["bucket"]), row._mapping[f"{field}_avg"])
+            for row in rows
+            if row._mapping[f"{field}_avg"] is not None
+        ]
+        series[field] = [
+            {"t": _epoch_to_datetime(x), "value": y}
+            for x, y in lttb(points, max_points)
+        ]
+    return series
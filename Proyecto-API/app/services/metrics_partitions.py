@@ -0,0 +1,514 @@
+"""
+Particionado por tiempo, retención y archivado de motor_metrics.
+
+En PostgreSQL la tabla se crea particionada por rango de created_at
+(una partición por día o por mes, más una partición DEFAULT para filas
+fuera de rango). Al arrancar se crean la partición por defecto y las del
+periodo actual y siguientes; un mantenimiento periódico:
+- crea por adelantado las particiones de los próximos periodos,
+- aplica la retención: cada partición caducada se archiva (opcional) en
+  un NDJSON comprimido con gzip y después se elimina con DROP TABLE,
+  sin DELETE fila a fila ni VACUUM posterior.
+
+En otros motores (SQLite) o si la tabla existente no está particionada,
+la retención archiva y borra por periodos con DELETE. Para convertir
+una tabla existente: `python -m app.services.metrics_partitions migrate`.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Index, PrimaryKeyConstraint, column, delete, func, select, table, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.core.database.database import create_db_and_tables, engine
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_cache import metrics_response_cache
+from app.services.metrics_export import EXPORT_COLUMNS, stream_ndjson
+
+logger = logging.getLogger(__name__)
+
+PARTITIONING_ENABLED = os.getenv("METRICS_PARTITIONING", "true").lower() == "true"
+PARTITION_INTERVAL = os.getenv("METRICS_PARTITION_INTERVAL", "day")
+# Periodos que se crean por adelantado
+PARTITION_PREMAKE = int(os.getenv("METRICS_PARTITION_PREMAKE", "7"))
+# 0 = conservar para siempre (por defecto: la retención se activa explícitamente)
+RETENTION_DAYS = int(os.getenv("METRICS_RETENTION_DAYS", "0"))
+ARCHIVE_ENABLED = os.getenv("METRICS_ARCHIVE_ENABLED", "true").lower() == "true"
+# Debe ser un volumen persistente y escribible (en Docker, /data/archive)
+ARCHIVE_DIR = os.getenv("METRICS_ARCHIVE_DIR", "database/archive")
+MAINTENANCE_INTERVAL = float(os.getenv("METRICS_MAINTENANCE_INTERVAL", "3600"))
+
+TABLE_NAME = MotorMetrics.__tablename__
+# Recoge las filas fuera de las particiones por periodo en lugar de hacer fallar el lote
+DEFAULT_PARTITION = f"{TABLE_NAME}_default"
+ARCHIVE_BATCH_SIZE = 5000
+# Clave del advisory lock: una sola réplica ejecuta el mantenimiento a la vez
+_ADVISORY_LOCK_KEY = 0x6D6D7061  # "mmpa"
+
+_PARTITION_RE = re.compile(rf"^{TABLE_NAME}_p(\d{{8}}|\d{{6}})$")
+_ARCHIVE_RE = re.compile(rf"^({TABLE_NAME}_p(?:\d{{8}}|\d{{6}}))(?:-(\d+))?\.ndjson\.gz$")
+
+
+# --- Periodos ---
+
+def period_start(moment: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.replace(day=1) if interval == "month" else start
+
+
+def next_period(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(start: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    return f"{TABLE_NAME}_p{start:%Y%m}" if interval == "month" else f"{TABLE_NAME}_p{start:%Y%m%d}"
+
+
+def parse_partition_name(name: str) -> Optional[Tuple[datetime, datetime]]:
+    """(inicio, fin) del periodo de una partición o archivo, o None"""
+    match = _PARTITION_RE.match(name)
+    if not match:
+        return None
+    digits = match.group(1)
+    if len(digits) == 6:
+        start = datetime.strptime(digits, "%Y%m")
+        return start, next_period(start, "month")
+    start = datetime.strptime(digits, "%Y%m%d")
+    return start, next_period(start, "day")
+
+
+def retention_cutoff(now: datetime) -> Optional[datetime]:
+    if RETENTION_DAYS <= 0:
+        return None
+    return now - timedelta(days=RETENTION_DAYS)
+
+
+# --- Esquema ---
+
+def prepare_partitioned_table():
+    """
+    Ajusta la definición de motor_metrics antes de create_all para crearla
+    particionada: la clave primaria y los índices únicos de una tabla
+    particionada deben incluir la columna de partición (created_at).
+    """
+    metrics_table = MotorMetrics.__table__
+    if metrics_table.dialect_options["postgresql"]["partition_by"]:
+        return
+    metrics_table.dialect_options["postgresql"]["partition_by"] = "RANGE (created_at)"
+
+    created_at = metrics_table.c.created_at
+    if not created_at.primary_key:
+        # Con clave compuesta hay que pedir explícitamente el autoincremento de id
+        metrics_table.c.id.autoincrement = True
+        created_at.nullable = False
+        created_at.primary_key = True
+        metrics_table.append_constraint(PrimaryKeyConstraint(metrics_table.c.id, created_at))
+
+    for index in list(metrics_table.indexes):
+        if index.unique and "created_at" not in index.columns:
+            metrics_table.indexes.discard(index)
+            Index(index.name, *index.columns, created_at, unique=True)
+
+
+def is_partitioned(connection: Connection) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+        {"table": TABLE_NAME}
+    ).scalar())
+
+
+def list_partitions(connection: Connection) -> List[str]:
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table) ORDER BY c.relname"
+    ), {"table": TABLE_NAME})
+    return [row[0] for row in rows]
+
+
+def _create_partition(connection: Connection, start: datetime, end: datetime, has_default: bool):
+    """
+    Crea la partición de [start, end). Si ya hay filas de ese periodo en la
+    partición por defecto, PostgreSQL no permite crearla: se mueven antes.
+    """
+    name = partition_name(start)
+    bounds = {"start": start, "end": end}
+    in_range = "created_at >= :start AND created_at < :end"
+    moved = has_default and connection.execute(
+        text(f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE {in_range})'), bounds
+    ).scalar()
+    if moved:
+        connection.execute(text(f'CREATE TEMP TABLE "_moved_{name}" (LIKE "{TABLE_NAME}")'))
+        connection.execute(text(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE {in_range} RETURNING *) '
+            f'INSERT INTO "_moved_{name}" SELECT * FROM moved'
+        ), bounds)
+    connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE_NAME}" '
+        f"FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')"
+    ))
+    if moved:
+        count = connection.execute(text(f'INSERT INTO "{TABLE_NAME}" SELECT * FROM "_moved_{name}"')).rowcount
+        connection.execute(text(f'DROP TABLE "_moved_{name}"'))
+        logger.info(f"📥 {count} filas movidas de {DEFAULT_PARTITION} a {name}")
+
+
+def ensure_partitions(connection: Connection, now: datetime) -> List[str]:
+    """
+    Crea la partición por defecto y las del periodo anterior, el actual y
+    PARTITION_PREMAKE siguientes
+    """
+    created = []
+    existing = set(list_partitions(connection))
+    if DEFAULT_PARTITION not in existing:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{TABLE_NAME}" DEFAULT'))
+        created.append(DEFAULT_PARTITION)
+    start = period_start(now - timedelta(days=1))
+    for _ in range(PARTITION_PREMAKE + 2):
+        end = next_period(start)
+        name = partition_name(start)
+        if name not in existing:
+            _create_partition(connection, start, end, has_default=True)
+            created.append(name)
+        start = end
+    return created
+
+
+def ensure_partitions_now() -> List[str]:
+    """Particiones necesarias para escribir ya, creadas de forma síncrona al arrancar"""
+    with engine.begin() as connection:
+        if not is_partitioned(connection):
+            return []
+        # Espera a otra réplica que esté arrancando o haciendo el mantenimiento
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+        created = ensure_partitions(connection, datetime.utcnow())
+    if created:
+        logger.info(f"🧱 Particiones creadas: {', '.join(created)}")
+    return created
+
+
+# --- Archivado ---
+
+def _row_table(name: str):
+    """Tabla ligera con las columnas de motor_metrics (para leer una partición)"""
+    return table(name, *[column(c.name, c.type) for c in MotorMetrics.__table__.columns])
+
+
+def _counting(batches: Iterator[Sequence[Any]], counter: List[int]) -> Iterator[Sequence[Any]]:
+    for batch in batches:
+        counter[0] += len(batch)
+        yield batch
+
+
+def _archive_path(name: str) -> str:
+    """Ruta libre para el archivo (no sobrescribe archivados previos del mismo periodo)"""
+    path = os.path.join(ARCHIVE_DIR, f"{name}.ndjson.gz")
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(ARCHIVE_DIR, f"{name}-{n}.ndjson.gz")
+        n += 1
+    return path
+
+
+def archive_rows(connection: Connection, source, name: str, start: datetime, end: datetime) -> int:
+    """Vuelca las filas de [start, end) de `source` a un NDJSON gzip; devuelve cuántas"""
+    statement = (
+        select(*[source.c[c] for c in EXPORT_COLUMNS])
+        .where(source.c.created_at >= start, source.c.created_at < end)
+        .order_by(source.c.created_at, source.c.id)
+    )
+    result = connection.execute(
+        statement.execution_options(stream_results=True, yield_per=ARCHIVE_BATCH_SIZE)
+    )
+
+    counter = [0]
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = _archive_path(name)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for chunk in stream_ndjson(_counting(result.partitions(ARCHIVE_BATCH_SIZE), counter), False):
+            f.write(chunk)
+    # Asegurar que el archivo está en disco antes de eliminar las filas
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+
+    if not counter[0]:
+        os.remove(tmp_path)
+        return 0
+    os.replace(tmp_path, path)
+    with open(f"{path[:-len('.ndjson.gz')]}.json", "w") as f:
+        json.dump({
+            "partition": name,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "rows": counter[0],
+            "archived_at": datetime.utcnow().isoformat(),
+        }, f)
+    logger.info(f"📦 {counter[0]} filas archivadas en {path}")
+    return counter[0]
+
+
+# --- Retención ---
+
+def archive_dir_writable() -> bool:
+    """Si se puede archivar en ARCHIVE_DIR (se crea si no existe)"""
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(ARCHIVE_DIR, os.W_OK)
+
+
+def _drop_expired_partitions(connection: Connection, cutoff: datetime) -> List[str]:
+    dropped = []
+    for name in list_partitions(connection):
+        if name == DEFAULT_PARTITION:
+            dropped.extend(_delete_expired_rows(connection, cutoff, _row_table(name)))
+            continue
+        bounds = parse_partition_name(name)
+        if bounds is None or bounds[1] > cutoff:
+            continue
+        if ARCHIVE_ENABLED:
+            archive_rows(connection, _row_table(name), name, *bounds)
+        connection.execute(text(f'ALTER TABLE "{TABLE_NAME}" DETACH PARTITION "{name}"'))
+        connection.execute(text(f'DROP TABLE "{name}"'))
+        connection.commit()
+        dropped.append(name)
+        logger.info(f"🗑️  Partición {name} eliminada por retención")
+    return dropped
+
+
+def _delete_expired_rows(connection: Connection, cutoff: datetime, source=None) -> List[str]:
+    """Retención sin particiones (o en la partición por defecto): archiva y borra periodo a periodo"""
+    source = MotorMetrics.__table__ if source is None else source
+    expired = []
+    while True:
+        oldest = connection.execute(select(func.min(source.c.created_at))).scalar()
+        if oldest is None:
+            break
+        start = period_start(oldest)
+        end = next_period(start)
+        if end > cutoff:
+            break
+        name = partition_name(start)
+        if ARCHIVE_ENABLED:
+            archive_rows(connection, source, name, start, end)
+        deleted = connection.execute(
+            delete(source).where(source.c.created_at >= start, source.c.created_at < end)
+        ).rowcount
+        connection.commit()
+        expired.append(name)
+        logger.info(f"🗑️  {deleted} filas de {name} eliminadas por retención ({source.name})")
+    return expired
+
+
+def run_maintenance(now: datetime = None) -> Dict[str, Any]:
+    """Crea particiones futuras y aplica la retención (una réplica a la vez)"""
+    now = now or datetime.utcnow()
+    summary: Dict[str, Any] = {"created": [], "expired": [], "partitioned": False}
+    cutoff = retention_cutoff(now)
+    if cutoff is not None and ARCHIVE_ENABLED and not archive_dir_writable():
+        # Nunca se eliminan datos que no se han podido archivar
+        logger.error(f"❌ {ARCHIVE_DIR} no es escribible: se omite la retención (monta un volumen en METRICS_ARCHIVE_DIR)")
+        summary["retention_skipped"] = f"{ARCHIVE_DIR} no es escribible"
+        cutoff = None
+
+    with engine.connect() as connection:
+        postgresql = connection.dialect.name == "postgresql"
+        if postgresql:
+            if not connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _ADVISORY_LOCK_KEY}).scalar():
+                logger.info("⏭️  Mantenimiento de particiones en curso en otra réplica")
+                return summary
+        try:
+            summary["partitioned"] = is_partitioned(connection)
+            if summary["partitioned"]:
+                summary["created"] = ensure_partitions(connection, now)
+                connection.commit()
+                if cutoff is not None:
+                    summary["expired"] = _drop_expired_partitions(connection, cutoff)
+            elif cutoff is not None:
+                summary["expired"] = _delete_expired_rows(connection, cutoff)
+        finally:
+            if postgresql:
+                connection.rollback()
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+                connection.commit()
+    if summary["expired"]:
+        metrics_response_cache.invalidate()
+    return summary
+
+
+class PartitionMaintainer:
+    """Hilo que ejecuta run_maintenance periódicamente"""
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-partitions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                run_maintenance()
+            except (SQLAlchemyError, OSError) as e:
+                logger.error(f"❌ Error en el mantenimiento de particiones: {e}")
+            if self._stop_event.wait(self.interval):
+                return
+
+
+# --- Archivos archivados ---
+
+def list_archives() -> List[Dict[str, Any]]:
+    """Particiones archivadas en ARCHIVE_DIR"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    archives = []
+    for filename in sorted(os.listdir(ARCHIVE_DIR)):
+        match = _ARCHIVE_RE.match(filename)
+        if not match:
+            continue
+        path = os.path.join(ARCHIVE_DIR, filename)
+        info = {"name": filename[:-len(".ndjson.gz")], "partition": match.group(1), "bytes": os.path.getsize(path)}
+        manifest = f"{path[:-len('.ndjson.gz')]}.json"
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                info.update(json.load(f))
+        else:
+            start, end = parse_partition_name(match.group(1))
+            info.update({"from": start.isoformat(), "to": end.isoformat(), "rows": None})
+        archives.append(info)
+    return archives
+
+
+def archive_file(name: str) -> Optional[str]:
+    """Ruta del archivo de una partición archivada (None si no existe o el nombre no es válido)"""
+    filename = f"{name}.ndjson.gz"
+    if not _ARCHIVE_RE.match(filename):
+        return None
+    path = os.path.join(ARCHIVE_DIR, filename)
+    return path if os.path.exists(path) else None
+
+
+def read_archive(
+    path: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    device_id: Optional[str] = None,
+    limit: Optional[int] = None
+) -> Iterator[str]:
+    """Líneas NDJSON de un archivo que cumplen los filtros (lectura en streaming)"""
+    emitted = 0
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if start is not None or end is not None or device_id is not None:
+                row = json.loads(line)
+                if device_id is not None and row["device_id"] != device_id:
+                    continue
+                created_at = datetime.fromisoformat(row["created_at"])
+                if (start is not None and created_at < start) or (end is not None and created_at >= end):
+                    continue
+            yield line if line.endswith("\n") else f"{line}\n"
+            emitted += 1
+            if limit is not None and emitted >= limit:
+                return
+
+
+# --- Migración ---
+
+def migrate_to_partitioned():
+    """
+    Convierte un motor_metrics existente (no particionado) en tabla particionada:
+    renombra la tabla antigua, crea la nueva con sus particiones, copia las
+    filas y elimina la antigua. Requiere parar la ingesta durante la migración.
+    """
+    legacy = f"{TABLE_NAME}_legacy"
+    with engine.begin() as connection:
+        if connection.dialect.name != "postgresql":
+            raise SystemExit("El particionado solo está disponible en PostgreSQL")
+        if is_partitioned(connection):
+            logger.info("✅ motor_metrics ya está particionada")
+            return
+        index_names = connection.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname NOT LIKE '%pkey'"
+        ), {"table": TABLE_NAME}).scalars().all()
+        connection.execute(text(f'ALTER TABLE "{TABLE_NAME}" RENAME TO "{legacy}"'))
+        connection.execute(text(f'ALTER SEQUENCE IF EXISTS "{TABLE_NAME}_id_seq" RENAME TO "{legacy}_id_seq"'))
+        connection.execute(text(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{TABLE_NAME}_pkey" TO "{legacy}_pkey"'))
+        for name in index_names:
+            connection.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+    create_db_and_tables()
+
+    with engine.begin() as connection:
+        bounds = connection.execute(text(f'SELECT min(created_at), max(created_at) FROM "{legacy}"')).one()
+        if bounds[0] is not None:
+            existing = set(list_partitions(connection))
+            start = period_start(bounds[0])
+            while start <= bounds[1]:
+                end = next_period(start)
+                if partition_name(start) not in existing:
+                    _create_partition(connection, start, end, has_default=DEFAULT_PARTITION in existing)
+                start = end
+        columns = ", ".join(f'"{c.name}"' for c in MotorMetrics.__table__.columns)
+        copied = connection.execute(text(
+            f'INSERT INTO "{TABLE_NAME}" ({columns}) SELECT {columns} FROM "{legacy}" ON CONFLICT DO NOTHING'
+        )).rowcount
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{TABLE_NAME}', 'id'), "
+            f'COALESCE((SELECT max(id) FROM "{TABLE_NAME}"), 1))'
+        ))
+        connection.execute(text(f'DROP TABLE "{legacy}"'))
+    logger.info(f"✅ motor_metrics migrada a tabla particionada ({copied} filas)")
+
+
+# Instancia global
+partition_maintainer = PartitionMaintainer()
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Particiones, retención y archivado de métricas")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("maintain", help="Crea particiones futuras y aplica la retención")
+    subparsers.add_parser("migrate", help="Convierte motor_metrics en tabla particionada (PostgreSQL)")
+    subparsers.add_parser("list", help="Lista particiones y archivos archivados")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "maintain":
+        create_db_and_tables()
+        print(json.dumps(run_maintenance(), indent=2))
+    elif args.command == "migrate":
+        migrate_to_partitioned()
+    elif args.command == "list":
+        with engine.connect() as connection:
+            partitions = list_partitions(connection) if is_partitioned(connection) else []
+        print(json.dumps({"partitions": partitions, "archives": list_archives()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
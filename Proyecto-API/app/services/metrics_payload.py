@@ -0,0 +1,156 @@
+"""
+Decodificación validada de los payloads MQTT del motor.
+
+- JSON: se valida con el núcleo compilado de pydantic (validate_json),
+  que parsea y comprueba tipos en una sola pasada; un campo ausente o
+  con un tipo incorrecto rechaza el mensaje en lugar de guardarse como 0.0.
+- Binario: layout fijo con `struct` para dispositivos de alta frecuencia,
+  publicado en un topic paralelo. Solo lleva la telemetría; los metadatos
+  del dispositivo (nombre, IP, MAC) se toman de su último mensaje JSON.
+
+Layout binario (little-endian, 31 bytes + device_id):
+    B  versión (1)
+    d  timestamp (epoch, segundos)
+    5f temperature, rpm, oil_pressure, vibration, load_percentage
+    B  status (índice en BINARY_STATUS, 255 = desconocido)
+    B  longitud de device_id, seguido de device_id en UTF-8
+"""
+import re
+import struct
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+from app.services.metrics_stats import STATUS_VALUES
+
+BINARY_VERSION = 1
+BINARY_STATUS = STATUS_VALUES
+_BINARY_UNKNOWN_STATUS = 255
+_BINARY_HEADER = struct.Struct("<BdfffffBB")
+# Campos que el formato binario no transporta
+_BINARY_METADATA = ("device_name", "device_ip", "device_subnet", "device_mac", "datetime")
+# Localiza device_id en un JSON sin parsearlo entero
+_JSON_DEVICE_ID = re.compile(rb'"device_id"\s*:\s*"([^"\\]*)"')
+# 10000-01-01: el mayor epoch que admite datetime
+MAX_TIMESTAMP = 253402300800.0
+
+
+class PayloadError(ValueError):
+    """Payload MQTT con formato o valores no válidos"""
+
+
+class MotorPayload(BaseModel):
+    """Payload de métricas del motor"""
+    # strict: no se convierten cadenas a números; extra: se ignoran campos desconocidos
+    model_config = ConfigDict(strict=True, extra="ignore", allow_inf_nan=False, frozen=True)
+
+    device_id: str = Field(min_length=1, max_length=64)
+    device_name: str = Field("Unknown Motor", max_length=255)
+    device_ip: str = Field("", max_length=64)
+    device_subnet: str = Field("", max_length=64)
+    device_mac: str = Field("", max_length=64)
+    temperature: float
+    rpm: float
+    oil_pressure: float
+    vibration: float
+    load_percentage: float
+    status: str = Field("unknown", max_length=32)
+    event: Optional[str] = Field(None, max_length=255)
+    # Acotado al rango de datetime: de él se deriva created_at
+    timestamp: Optional[float] = Field(None, ge=0, lt=MAX_TIMESTAMP)
+    datetime: str = Field("", max_length=64)
+
+
+def decode_json(raw: bytes) -> MotorPayload:
+    """Parsea y valida un payload JSON"""
+    try:
+        return MotorPayload.model_validate_json(raw)
+    except ValidationError as e:
+        raise PayloadError(_summarize(e)) from None
+
+
+def encode_binary(payload: MotorPayload) -> bytes:
+    """Codifica un payload en el formato binario compacto"""
+    device_id = payload.device_id.encode()
+    status = (
+        BINARY_STATUS.index(payload.status)
+        if payload.status in BINARY_STATUS else _BINARY_UNKNOWN_STATUS
+    )
+    return _BINARY_HEADER.pack(
+        BINARY_VERSION,
+        payload.timestamp or 0.0,
+        payload.temperature,
+        payload.rpm,
+        payload.oil_pressure,
+        payload.vibration,
+        payload.load_percentage,
+        status,
+        len(device_id),
+    ) + device_id
+
+
+def peek_binary_device_id(raw: bytes) -> Optional[str]:
+    """device_id de un payload binario sin decodificarlo entero (None si no es válido)"""
+    if len(raw) < _BINARY_HEADER.size:
+        return None
+    try:
+        return raw[_BINARY_HEADER.size:].decode()
+    except UnicodeDecodeError:
+        return None
+
+
+def peek_json_device_id(raw: bytes) -> Optional[str]:
+    """device_id de un payload JSON sin validarlo (None si no se encuentra)"""
+    match = _JSON_DEVICE_ID.search(raw)
+    if match is None:
+        return None
+    try:
+        return match.group(1).decode()
+    except UnicodeDecodeError:
+        return None
+
+
+def decode_binary(raw: bytes, defaults: Optional[dict] = None) -> MotorPayload:
+    """
+    Decodifica un payload binario.
+    `defaults` aporta los metadatos del dispositivo que el formato no incluye.
+    """
+    if len(raw) < _BINARY_HEADER.size:
+        raise PayloadError("Payload binario demasiado corto")
+    (
+        version, timestamp, temperature, rpm, oil_pressure, vibration,
+        load_percentage, status, id_length
+    ) = _BINARY_HEADER.unpack_from(raw)
+    if version != BINARY_VERSION:
+        raise PayloadError(f"Versión de payload binario no soportada: {version}")
+    if len(raw) != _BINARY_HEADER.size + id_length:
+        raise PayloadError("Longitud de device_id inconsistente")
+
+    try:
+        device_id = raw[_BINARY_HEADER.size:].decode()
+    except UnicodeDecodeError:
+        raise PayloadError("device_id no es UTF-8 válido") from None
+
+    values = {key: defaults[key] for key in _BINARY_METADATA if key in defaults} if defaults else {}
+    values.update(
+        device_id=device_id,
+        temperature=temperature,
+        rpm=rpm,
+        oil_pressure=oil_pressure,
+        vibration=vibration,
+        load_percentage=load_percentage,
+        status=BINARY_STATUS[status] if status < len(BINARY_STATUS) else "unknown",
+        timestamp=timestamp or None,
+    )
+    try:
+        return MotorPayload.model_validate(values)
+    except ValidationError as e:
+        raise PayloadError(_summarize(e)) from None
+
+
+def _summarize(error: ValidationError) -> str:
+    """Resumen corto de los errores (sin volcar el payload completo al log)"""
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in item['loc']) or 'payload'}: {item['msg']}"
+        for item in error.errors(include_url=False, include_input=False)[:3]
+    )
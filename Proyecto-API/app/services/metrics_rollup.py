@@ -0,0 +1,447 @@
+"""
+Mantenimiento y consulta de los rollups de métricas (1 minuto / 1 hora).
+
+- La ingesta MQTT actualiza los rollups en la misma transacción que cada lote.
+- Una marca de cobertura (motor_metrics_rollup_state) indica desde qué
+  created_at están completos: al activar la ingesta sobre un histórico ya
+  existente empieza en la hora siguiente, y `rebuild_rollups` la adelanta
+  al regenerarlos desde las filas crudas (backfill):
+      python -m app.services.metrics_rollup rebuild --from 2025-01-01T00:00:00
+- Las consultas sobre ventanas largas leen de aquí solo si la marca cubre
+  el inicio de la ventana; si no, se leen las filas crudas.
+"""
+import argparse
+import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+from sqlalchemy import BigInteger, cast, delete, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from app.core.database.database import engine, create_db_and_tables
+from app.models.motor_metrics import MotorMetrics
+from app.models.motor_metrics_rollup import (
+    MotorMetricsRollupBase,
+    MotorMetricsRollup1h,
+    MotorMetricsRollup1m,
+    MotorMetricsRollupState,
+)
+from app.services.metrics_history import bucket_expression
+from app.services.metrics_stats import (
+    METRIC_FIELDS,
+    STATUS_VALUES,
+    apply_filters,
+    percentile_key,
+    sample_stddev,
+)
+
+logger = logging.getLogger(__name__)
+
+# (segundos, tabla) de menor a mayor granularidad
+ROLLUP_TABLES: Tuple[Tuple[int, Type[MotorMetricsRollupBase]], ...] = (
+    (60, MotorMetricsRollup1m),
+    (3600, MotorMetricsRollup1h),
+)
+
+# A partir de esta ventana, stats/historial leen de los rollups
+ROLLUP_MIN_WINDOW = float(os.getenv("METRICS_ROLLUP_MIN_WINDOW", "21600"))  # 6 h
+# A partir de esta ventana se usa el rollup horario en lugar del de minuto
+ROLLUP_HOURLY_MIN_WINDOW = float(os.getenv("METRICS_ROLLUP_HOURLY_MIN_WINDOW", "172800"))  # 2 días
+
+ROLLUP_STATE_NAME = "rollups"
+# Marca de cobertura cuando los rollups cubren todo el histórico
+EPOCH = datetime(1970, 1, 1)
+
+
+def _epoch(value: datetime) -> float:
+    """Epoch de un datetime naive en UTC (como created_at)"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _to_datetime(epoch: float) -> datetime:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+
+def _empty_aggregate() -> Dict[str, Any]:
+    agg: Dict[str, Any] = {"count": 0}
+    for field in METRIC_FIELDS:
+        agg[f"{field}_sum"] = 0.0
+        agg[f"{field}_min"] = None
+        agg[f"{field}_max"] = None
+        agg[f"{field}_sumsq"] = 0.0
+    for status in STATUS_VALUES:
+        agg[f"status_{status}"] = 0
+    return agg
+
+
+def _merge_min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _merge_max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def aggregate_rows(rows: Iterable[Dict[str, Any]], bucket_seconds: int) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """Agrega un lote de filas crudas por (device_id, bucket)"""
+    aggregates: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    for row in rows:
+        created_at = row["created_at"]
+        bucket = int(_epoch(created_at) // bucket_seconds) * bucket_seconds
+        key = (row["device_id"], bucket)
+        agg = aggregates.get(key)
+        if agg is None:
+            agg = aggregates[key] = _empty_aggregate()
+            agg["device_id"], agg["bucket"] = key
+
+        agg["count"] += 1
+        for field in METRIC_FIELDS:
+            value = row.get(field)
+            if value is None:
+                continue
+            agg[f"{field}_sum"] += value
+            agg[f"{field}_sumsq"] += value * value
+            agg[f"{field}_min"] = _merge_min(agg[f"{field}_min"], value)
+            agg[f"{field}_max"] = _merge_max(agg[f"{field}_max"], value)
+        status = row.get("status")
+        if status in STATUS_VALUES:
+            agg[f"status_{status}"] += 1
+    return aggregates
+
+
+def _upsert_statement(dialect_name: str, table: Type[MotorMetricsRollupBase], values: List[Dict[str, Any]]):
+    """INSERT ... ON CONFLICT (device_id, bucket) DO UPDATE sumando los agregados"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        least, greatest = func.least, func.greatest
+    elif dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        # En SQLite min()/max() con dos argumentos son escalares
+        least, greatest = func.min, func.max
+    else:
+        return None
+
+    stmt = dialect_insert(table).values(values)
+    excluded = stmt.excluded
+    columns = table.__table__.c
+
+    updates = {"count": columns.count + excluded.count}
+    for field in METRIC_FIELDS:
+        updates[f"{field}_sum"] = columns[f"{field}_sum"] + excluded[f"{field}_sum"]
+        updates[f"{field}_sumsq"] = columns[f"{field}_sumsq"] + excluded[f"{field}_sumsq"]
+        updates[f"{field}_min"] = func.coalesce(
+            least(columns[f"{field}_min"], excluded[f"{field}_min"]),
+            columns[f"{field}_min"], excluded[f"{field}_min"]
+        )
+        updates[f"{field}_max"] = func.coalesce(
+            greatest(columns[f"{field}_max"], excluded[f"{field}_max"]),
+            columns[f"{field}_max"], excluded[f"{field}_max"]
+        )
+    for status in STATUS_VALUES:
+        updates[f"status_{status}"] = columns[f"status_{status}"] + excluded[f"status_{status}"]
+
+    return stmt.on_conflict_do_update(index_elements=["device_id", "bucket"], set_=updates)
+
+
+def apply_rollups(session: Session, rows: List[Dict[str, Any]]):
+    """
+    Hook transaccional del escritor por lotes: suma las filas recién
+    insertadas a los rollups de 1 minuto y 1 hora antes del commit del lote.
+    """
+    dialect_name = session.get_bind().dialect.name
+    for bucket_seconds, table in ROLLUP_TABLES:
+        values = sorted(
+            aggregate_rows(rows, bucket_seconds).values(),
+            key=lambda agg: (agg["device_id"], agg["bucket"])
+        )
+        stmt = _upsert_statement(dialect_name, table, values)
+        if stmt is None:
+            logger.warning(f"⚠️  Rollups no soportados en {dialect_name}")
+            return
+        session.execute(stmt)
+
+
+def rollup_complete_from(session: Session) -> Optional[datetime]:
+    """Desde qué created_at están completos los rollups (None si no hay marca)"""
+    state = session.get(MotorMetricsRollupState, ROLLUP_STATE_NAME)
+    return state.complete_from if state is not None else None
+
+
+def init_rollup_watermark(margin: float = 0.0):
+    """
+    Fija la marca de cobertura la primera vez que arranca la ingesta.
+    Sin histórico los rollups lo cubren todo; con histórico solo desde la
+    hora siguiente a ahora + `margin` (desviación de reloj admitida en
+    created_at), hasta que un `rebuild` la adelante.
+    """
+    with Session(engine) as session:
+        if rollup_complete_from(session) is not None:
+            return
+        has_rows = session.execute(select(MotorMetrics.id).limit(1)).first() is not None
+        complete_from = (
+            _to_datetime(math.ceil((time.time() + margin) / 3600) * 3600) if has_rows else EPOCH
+        )
+        session.add(MotorMetricsRollupState(name=ROLLUP_STATE_NAME, complete_from=complete_from))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Otra réplica la ha fijado a la vez
+            session.rollback()
+            return
+    if has_rows:
+        logger.warning(
+            f"⚠️  Rollups completos solo desde {complete_from}; ejecuta "
+            f"'python -m app.services.metrics_rollup rebuild' para cubrir el histórico"
+        )
+
+
+def _extend_watermark(session: Session, start: Optional[datetime], end: Optional[datetime]):
+    """Adelanta la marca de cobertura tras regenerar [start, end)"""
+    state = session.get(MotorMetricsRollupState, ROLLUP_STATE_NAME)
+    rebuilt_from = start or EPOCH
+    if state is None:
+        # Sin marca solo se puede fijar si se ha regenerado hasta el final
+        if end is None:
+            session.add(MotorMetricsRollupState(name=ROLLUP_STATE_NAME, complete_from=rebuilt_from))
+    elif rebuilt_from < state.complete_from and (end is None or end >= state.complete_from):
+        state.complete_from = rebuilt_from
+
+
+def rebuild_rollups(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Regenera los rollups desde motor_metrics en [start, end).
+    Los límites se alinean a la hora para no dejar buckets parciales.
+    """
+    if start is not None:
+        start = _to_datetime(math.floor(_epoch(start) / 3600) * 3600)
+    if end is not None:
+        end = _to_datetime(math.ceil(_epoch(end) / 3600) * 3600)
+
+    with Session(engine) as session:
+        dialect_name = session.get_bind().dialect.name
+        for bucket_seconds, table in ROLLUP_TABLES:
+            delete_stmt = delete(table)
+            if start is not None:
+                delete_stmt = delete_stmt.where(table.bucket >= int(_epoch(start)))
+            if end is not None:
+                delete_stmt = delete_stmt.where(table.bucket < int(_epoch(end)))
+            session.execute(delete_stmt)
+
+            bucket = cast(bucket_expression(dialect_name, bucket_seconds), BigInteger)
+            columns = [MotorMetrics.device_id, bucket, func.count()]
+            names = ["device_id", "bucket", "count"]
+            for field in METRIC_FIELDS:
+                column = getattr(MotorMetrics, field)
+                columns.extend([
+                    func.coalesce(func.sum(column), 0.0),
+                    func.min(column),
+                    func.max(column),
+                    func.coalesce(func.sum(column * column), 0.0),
+                ])
+                names.extend([f"{field}_sum", f"{field}_min", f"{field}_max", f"{field}_sumsq"])
+            for status in STATUS_VALUES:
+                columns.append(func.count().filter(MotorMetrics.status == status))
+                names.append(f"status_{status}")
+
+            source = apply_filters(select(*columns), start, end, None)
+            source = source.group_by(MotorMetrics.device_id, bucket)
+            session.execute(insert(table).from_select(names, source))
+        _extend_watermark(session, start, end)
+        session.commit()
+    logger.info(f"🔁 Rollups regenerados ({start or 'inicio'} → {end or 'fin'})")
+
+
+def rollup_window(start: datetime, end: datetime) -> bool:
+    """Si la ventana es lo bastante larga para leer de los rollups"""
+    return (end - start).total_seconds() >= ROLLUP_MIN_WINDOW
+
+
+def choose_rollup(
+    start: datetime,
+    end: datetime,
+    complete_from: Optional[datetime]
+) -> Optional[Tuple[int, Type[MotorMetricsRollupBase]]]:
+    """Rollup adecuado para la ventana, o None si conviene (o hay que) leer filas crudas"""
+    if complete_from is None or start < complete_from or not rollup_window(start, end):
+        return None
+    span = (end - start).total_seconds()
+    if span >= ROLLUP_HOURLY_MIN_WINDOW:
+        return ROLLUP_TABLES[1]
+    return ROLLUP_TABLES[0]
+
+
+def _finalize_stats(agg: Dict[str, Any], fields: Sequence[str], percentiles: Sequence[float]) -> Dict[str, Any]:
+    """Convierte un agregado sumable en la respuesta de /metrics/stats"""
+    count = agg["count"] or 0
+    result: Dict[str, Any] = {}
+    for field in fields:
+        mean = agg[f"{field}_sum"] / count if count else None
+        stats = {
+            "avg": mean,
+            "min": agg[f"{field}_min"],
+            "max": agg[f"{field}_max"],
+            "stddev": sample_stddev(count, mean, agg[f"{field}_sumsq"]),
+        }
+        # Los percentiles no se pueden derivar de los rollups
+        for p in percentiles:
+            stats[percentile_key(p)] = None
+        result[field] = stats
+    result["total_records"] = count
+    result["status_distribution"] = {
+        status: agg[f"status_{status}"] for status in STATUS_VALUES
+    }
+    return result
+
+
+def rollup_stats(
+    session: Session,
+    bucket_seconds: int,
+    table: Type[MotorMetricsRollupBase],
+    fields: Sequence[str],
+    percentiles: Sequence[float],
+    start: datetime,
+    end: datetime,
+    device_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Stats exactas (salvo percentiles) combinando los buckets completos del
+    rollup con las filas crudas de los bordes no alineados de la ventana.
+    """
+    aligned_start = math.ceil(_epoch(start) / bucket_seconds) * bucket_seconds
+    aligned_end = math.floor(_epoch(end) / bucket_seconds) * bucket_seconds
+    agg = _empty_aggregate()
+
+    if aligned_start < aligned_end:
+        columns = [func.coalesce(func.sum(table.count), 0)]
+        names = ["count"]
+        for field in METRIC_FIELDS:
+            columns.extend([
+                func.coalesce(func.sum(getattr(table, f"{field}_sum")), 0.0),
+                func.min(getattr(table, f"{field}_min")),
+                func.max(getattr(table, f"{field}_max")),
+                func.coalesce(func.sum(getattr(table, f"{field}_sumsq")), 0.0),
+            ])
+            names.extend([f"{field}_sum", f"{field}_min", f"{field}_max", f"{field}_sumsq"])
+        for status in STATUS_VALUES:
+            columns.append(func.coalesce(func.sum(getattr(table, f"status_{status}")), 0))
+            names.append(f"status_{status}")
+
+        statement = select(*columns).where(
+            table.bucket >= aligned_start, table.bucket < aligned_end
+        )
+        if device_id is not None:
+            statement = statement.where(table.device_id == device_id)
+        agg.update(zip(names, session.exec(statement).one()))
+        edges = or_(
+            MotorMetrics.created_at < _to_datetime(aligned_start),
+            MotorMetrics.created_at >= _to_datetime(aligned_end),
+        )
+    else:
+        edges = None
+
+    # Filas crudas de los bordes (o de toda la ventana si no hay buckets completos)
+    columns = [func.count()]
+    names = ["count"]
+    for field in METRIC_FIELDS:
+        column = getattr(MotorMetrics, field)
+        columns.extend([
+            func.coalesce(func.sum(column), 0.0),
+            func.min(column),
+            func.max(column),
+            func.coalesce(func.sum(column * column), 0.0),
+        ])
+        names.extend([f"{field}_sum", f"{field}_min", f"{field}_max", f"{field}_sumsq"])
+    for status in STATUS_VALUES:
+        columns.append(func.count().filter(MotorMetrics.status == status))
+        names.append(f"status_{status}")
+
+    statement = apply_filters(select(*columns), start, end, device_id)
+    if edges is not None:
+        statement = statement.where(edges)
+    edge = dict(zip(names, session.exec(statement).one()))
+
+    agg["count"] += edge["count"]
+    for field in METRIC_FIELDS:
+        agg[f"{field}_sum"] += edge[f"{field}_sum"]
+        agg[f"{field}_sumsq"] += edge[f"{field}_sumsq"]
+        agg[f"{field}_min"] = _merge_min(agg[f"{field}_min"], edge[f"{field}_min"])
+        agg[f"{field}_max"] = _merge_max(agg[f"{field}_max"], edge[f"{field}_max"])
+    for status in STATUS_VALUES:
+        agg[f"status_{status}"] += edge[f"status_{status}"]
+
+    return _finalize_stats(agg, fields, percentiles)
+
+
+def build_rollup_bucket_query(
+    table: Type[MotorMetricsRollupBase],
+    rollup_seconds: int,
+    bucket_seconds: int,
+    fields: Sequence[str],
+    start: datetime,
+    end: datetime,
+    device_id: Optional[str] = None
+):
+    """
+    Equivalente a build_bucket_query leyendo del rollup.
+    `bucket_seconds` debe ser múltiplo de `rollup_seconds`; los extremos de la
+    ventana se redondean a la granularidad del rollup.
+    """
+    if bucket_seconds == rollup_seconds:
+        bucket = table.bucket
+    else:
+        bucket = table.bucket // bucket_seconds * bucket_seconds
+    bucket = bucket.label("bucket")
+    count = func.sum(table.count)
+
+    columns = [table.device_id, bucket, count.label("count")]
+    for field in fields:
+        columns.extend([
+            func.min(getattr(table, f"{field}_min")).label(f"{field}_min"),
+            (func.sum(getattr(table, f"{field}_sum")) / count).label(f"{field}_avg"),
+            func.max(getattr(table, f"{field}_max")).label(f"{field}_max"),
+        ])
+
+    statement = select(*columns).where(
+        table.bucket >= int(_epoch(start)) // rollup_seconds * rollup_seconds,
+        table.bucket < int(_epoch(end)),
+    )
+    if device_id is not None:
+        statement = statement.where(table.device_id == device_id)
+    return statement.group_by(table.device_id, bucket).order_by(table.device_id, bucket)
+
+
+def choose_rollup_for_buckets(
+    start: datetime,
+    end: datetime,
+    bucket_seconds: int,
+    complete_from: Optional[datetime]
+) -> Optional[Tuple[int, Type[MotorMetricsRollupBase]]]:
+    """Rollup más grueso cuya granularidad divide al bucket pedido (si cubre la ventana)"""
+    if complete_from is None or start < complete_from or not rollup_window(start, end):
+        return None
+    for rollup_seconds, table in reversed(ROLLUP_TABLES):
+        if bucket_seconds % rollup_seconds == 0:
+            return rollup_seconds, table
+    return None
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Mantenimiento de rollups de métricas")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="Regenera los rollups desde motor_metrics")
+    rebuild.add_argument("--from", dest="start", type=datetime.fromisoformat, default=None)
+    rebuild.add_argument("--to", dest="end", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "rebuild":
+        create_db_and_tables()
+        rebuild_rollups(args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
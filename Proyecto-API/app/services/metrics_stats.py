@@ -0,0 +1,130 @@
+"""
+Agregación de métricas del motor calculada en la base de datos.
+Una sola consulta devuelve avg/min/max/stddev/percentiles y la
+distribución de estados sobre una ventana de tiempo arbitraria.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import func, select
+
+from app.models.motor_metrics import MotorMetrics
+
+# Métricas numéricas agregables
+METRIC_FIELDS = ("temperature", "rpm", "oil_pressure", "vibration", "load_percentage")
+STATUS_VALUES = ("running", "warning", "error")
+DEFAULT_PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def validate_fields(fields: Optional[Sequence[str]]) -> List[str]:
+    """Valida la lista de métricas pedida (por defecto todas)"""
+    if not fields:
+        return list(METRIC_FIELDS)
+    unknown = [f for f in fields if f not in METRIC_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Métricas no válidas: {', '.join(unknown)}. Válidas: {', '.join(METRIC_FIELDS)}"
+        )
+    return list(dict.fromkeys(fields))
+
+
+def validate_percentiles(percentiles: Optional[Sequence[float]]) -> List[float]:
+    if percentiles is None:
+        return list(DEFAULT_PERCENTILES)
+    if any(not 0 <= p <= 1 for p in percentiles):
+        raise HTTPException(status_code=400, detail="Los percentiles deben estar entre 0 y 1")
+    return list(percentiles)
+
+
+def apply_filters(statement, start: Optional[datetime], end: Optional[datetime], device_id: Optional[str]):
+    """Añade los filtros de ventana temporal y dispositivo"""
+    if start is not None:
+        statement = statement.where(MotorMetrics.created_at >= start)
+    if end is not None:
+        statement = statement.where(MotorMetrics.created_at < end)
+    if device_id is not None:
+        statement = statement.where(MotorMetrics.device_id == device_id)
+    return statement
+
+
+def build_stats_query(
+    dialect_name: str,
+    fields: Sequence[str],
+    percentiles: Sequence[float],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    device_id: Optional[str] = None
+):
+    """
+    Construye la consulta de agregación.
+    Los percentiles exactos (percentile_cont) solo están disponibles en PostgreSQL.
+    """
+    columns = [func.count().label("total_records")]
+    for status in STATUS_VALUES:
+        columns.append(
+            func.count().filter(MotorMetrics.status == status).label(f"status_{status}")
+        )
+
+    for field in fields:
+        column = getattr(MotorMetrics, field)
+        columns.extend([
+            func.avg(column).label(f"{field}_avg"),
+            func.min(column).label(f"{field}_min"),
+            func.max(column).label(f"{field}_max"),
+        ])
+        if dialect_name == "postgresql":
+            columns.append(func.stddev_samp(column).label(f"{field}_stddev"))
+            for i, p in enumerate(percentiles):
+                columns.append(
+                    func.percentile_cont(p).within_group(column).label(f"{field}_p{i}")
+                )
+        else:
+            # Sin stddev nativo: se deriva de la suma de cuadrados
+            columns.append(func.sum(column * column).label(f"{field}_sumsq"))
+
+    return apply_filters(select(*columns), start, end, device_id)
+
+
+def sample_stddev(count: int, mean: Optional[float], sum_squares: Optional[float]) -> Optional[float]:
+    """Desviación típica muestral a partir de n, media y suma de cuadrados"""
+    if not count or count < 2 or mean is None or sum_squares is None:
+        return None
+    variance = (sum_squares - count * mean * mean) / (count - 1)
+    return max(variance, 0.0) ** 0.5
+
+
+def percentile_key(p: float) -> str:
+    """Nombre del percentil en la respuesta (0.95 -> "p95")"""
+    return f"p{round(p * 100, 2):g}"
+
+
+def row_to_stats(row: Any, fields: Sequence[str], percentiles: Sequence[float]) -> Dict[str, Any]:
+    """Convierte la fila agregada en la respuesta de /metrics/stats"""
+    data = row._mapping
+    result: Dict[str, Any] = {}
+
+    for field in fields:
+        stats = {
+            "avg": data[f"{field}_avg"],
+            "min": data[f"{field}_min"],
+            "max": data[f"{field}_max"],
+        }
+        if f"{field}_stddev" in data:
+            stats["stddev"] = data[f"{field}_stddev"]
+            for i, p in enumerate(percentiles):
+                stats[percentile_key(p)] = data[f"{field}_p{i}"]
+        else:
+            stats["stddev"] = sample_stddev(
+                data["total_records"], data[f"{field}_avg"], data[f"{field}_sumsq"]
+            )
+            for p in percentiles:
+                stats[percentile_key(p)] = None
+        result[field] = stats
+
+    result["total_records"] = data["total_records"]
+    result["status_distribution"] = {
+        status: data[f"status_{status}"] for status in STATUS_VALUES
+    }
+    return result
@@ -0,0 +1,210 @@
+"""
+Almacén en memoria de las métricas recientes de cada dispositivo.
+
+Cada dispositivo tiene un buffer circular de tamaño fijo con arrays
+numéricos preasignados (`array('d')`), uno por métrica, en lugar de
+una lista de diccionarios: la memoria por dispositivo es constante
+(~8 bytes por valor) y la última lectura se obtiene en O(1).
+
+El device_id llega en el payload y no es de fiar: como mucho se guardan
+`max_devices` dispositivos y, al llegar uno nuevo con el almacén lleno,
+se descarta el que lleva más tiempo sin enviar lecturas (LRU).
+"""
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.services.metrics_stats import METRIC_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceRingBuffer:
+    """Buffer circular de las últimas `capacity` muestras de un dispositivo"""
+
+    __slots__ = ("capacity", "timestamps", "values", "head", "size", "latest")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = {field: array("d", bytes(8 * capacity)) for field in METRIC_FIELDS}
+        self.head = 0  # siguiente posición a escribir
+        self.size = 0
+        self.latest: Optional[Dict[str, Any]] = None
+
+    def clear(self):
+        """Vacía el buffer para reutilizarlo con otro dispositivo"""
+        self.head = 0
+        self.size = 0
+        self.latest = None
+
+    def append(self, received_at: float, payload: Dict[str, Any]):
+        i = self.head
+        self.timestamps[i] = received_at
+        for field, column in self.values.items():
+            value = payload.get(field)
+            column[i] = float(value) if isinstance(value, (int, float)) else math.nan
+        self.head = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.latest = payload
+
+    def _physical(self, logical: int) -> int:
+        """Posición en el array de la muestra lógica (0 = la más antigua)"""
+        return (self.head - self.size + logical) % self.capacity
+
+    def _first_since(self, since: float) -> int:
+        """Primera muestra lógica con timestamp >= since (búsqueda binaria)"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._physical(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, column: array, start: int) -> array:
+        """Copia contigua de las muestras lógicas [start, size)"""
+        begin = self._physical(start)
+        count = self.size - start
+        if begin + count <= self.capacity:
+            return column[begin:begin + count]
+        return column[begin:] + column[:begin + count - self.capacity]
+
+    def window(self, since: float, fields: Sequence[str]) -> Dict[str, array]:
+        """Timestamps y valores de las muestras recibidas desde `since`"""
+        start = self._first_since(since)
+        result = {"t": self._slice(self.timestamps, start)}
+        for field in fields:
+            result[field] = self._slice(self.values[field], start)
+        return result
+
+
+def summarize(values: array) -> Dict[str, Optional[float]]:
+    """count/avg/min/max de una serie ignorando huecos (NaN)"""
+    present = [v for v in values if not math.isnan(v)]
+    if not present:
+        return {"count": 0, "avg": None, "min": None, "max": None}
+    return {
+        "count": len(present),
+        "avg": math.fsum(present) / len(present),
+        "min": min(present),
+        "max": max(present),
+    }
+
+
+class MetricsStore:
+    """Última lectura y ventana reciente por device_id, sin tocar la base de datos"""
+
+    def __init__(self, capacity: int = None, max_devices: int = None):
+        # Por defecto: 1 hora a 1 muestra/s por dispositivo
+        self.capacity = capacity or int(os.getenv("METRICS_STORE_CAPACITY", "3600"))
+        self.max_devices = max_devices or int(os.getenv("METRICS_STORE_MAX_DEVICES", "1000"))
+        # Ordenado del menos al más recientemente actualizado
+        self._devices: "OrderedDict[str, DeviceRingBuffer]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._latest: Optional[Dict[str, Any]] = None
+        self.evicted_devices = 0
+        self.duplicates = 0
+
+    def add(self, payload: Dict[str, Any], received_at: float = None) -> bool:
+        """
+        Registra una lectura (llamado desde el hilo MQTT).
+        Devuelve False si repite el timestamp de la última lectura del
+        dispositivo (reentrega QoS 1 o el mismo mensaje por varios topics).
+        """
+        device_id = payload.get("device_id", "unknown")
+        received_at = received_at if received_at is not None else time.time()
+        timestamp = payload.get("timestamp")
+        with self._lock:
+            buffer = self._devices.get(device_id)
+            if buffer is None:
+                if len(self._devices) >= self.max_devices:
+                    # Se reutiliza el buffer del dispositivo inactivo hace más tiempo
+                    evicted_id, buffer = self._devices.popitem(last=False)
+                    buffer.clear()
+                    self.evicted_devices += 1
+                    if self.evicted_devices == 1:
+                        logger.warning(
+                            f"⚠️  Límite de dispositivos en memoria alcanzado ({self.max_devices}), "
+                            f"se descartan los inactivos (primero {evicted_id})"
+                        )
+                else:
+                    buffer = DeviceRingBuffer(self.capacity)
+                self._devices[device_id] = buffer
+            elif timestamp is not None and buffer.latest.get("timestamp") == timestamp:
+                self.duplicates += 1
+                return False
+            else:
+                self._devices.move_to_end(device_id)
+            buffer.append(received_at, payload)
+            self._latest = payload
+        return True
+
+    def latest(self, device_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Última lectura de un dispositivo, o la última recibida de toda la flota"""
+        if device_id is None:
+            return self._latest
+        buffer = self._devices.get(device_id)
+        return buffer.latest if buffer else None
+
+    def latest_all(self) -> Dict[str, Dict[str, Any]]:
+        """Última lectura de cada dispositivo"""
+        with self._lock:
+            return {device_id: buffer.latest for device_id, buffer in self._devices.items()}
+
+    def devices(self) -> List[str]:
+        with self._lock:
+            return sorted(self._devices)
+
+    def recent(
+        self,
+        device_id: str,
+        seconds: float,
+        fields: Sequence[str] = METRIC_FIELDS,
+        now: float = None
+    ) -> Optional[Dict[str, Any]]:
+        """Serie y resumen de los últimos `seconds` segundos de un dispositivo"""
+        since = (now if now is not None else time.time()) - seconds
+        with self._lock:
+            buffer = self._devices.get(device_id)
+            if buffer is None:
+                return None
+            window = buffer.window(since, fields)
+
+        timestamps = window.pop("t")
+        return {
+            "device_id": device_id,
+            "count": len(timestamps),
+            "timestamps": timestamps.tolist(),
+            "series": {
+                field: [None if math.isnan(v) else v for v in values]
+                for field, values in window.items()
+            },
+            "summary": {field: summarize(values) for field, values in window.items()},
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            devices = len(self._devices)
+            samples = sum(buffer.size for buffer in self._devices.values())
+        return {
+            "devices": devices,
+            "samples": samples,
+            "capacity_per_device": self.capacity,
+            "max_devices": self.max_devices,
+            "evicted_devices": self.evicted_devices,
+            "duplicates": self.duplicates,
+            # Timestamps + una columna por métrica, 8 bytes por valor
+            "bytes_allocated": devices * self.capacity * 8 * (len(METRIC_FIELDS) + 1),
+        }
+
+
+# Instancia global
+metrics_store = MetricsStore()
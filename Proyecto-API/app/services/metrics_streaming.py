@@ -0,0 +1,515 @@
+"""
+Estadísticas incrementales de la telemetría del motor.
+
+Se alimenta mensaje a mensaje desde MQTTService.on_message y mantiene,
+por dispositivo y métrica:
+- media/varianza en una pasada (Welford), min/max y EWMA,
+- cuantiles aproximados con el algoritmo P² (Jain & Chlamtac, 1985),
+  que usa 5 marcadores por cuantil en lugar de guardar las muestras,
+- una ventana fija (tumbling) y una deslizante formada por paneles.
+
+Además marca anomalías (umbral fijo o z-score) al recibir cada valor.
+Leer las estadísticas cuesta lo mismo sea cual sea el volumen de datos,
+y el estado se guarda en un snapshot JSON para no perder las ventanas
+al reiniciar.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.services.metrics_stats import DEFAULT_PERCENTILES, METRIC_FIELDS, percentile_key
+
+logger = logging.getLogger(__name__)
+
+
+class RunningStats:
+    """count/media/varianza (Welford) y min/max"""
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    def merge(self, other: "RunningStats"):
+        """Combina dos acumuladores (Chan et al.)"""
+        if not other.count:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.mean += delta * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def stddev(self) -> Optional[float]:
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2,
+                "min": self.min if self.count else None,
+                "max": self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RunningStats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats.m2 = data["m2"]
+        stats.min = data["min"] if data["min"] is not None else math.inf
+        stats.max = data["max"] if data["max"] is not None else -math.inf
+        return stats
+
+
+class P2Quantile:
+    """Estimador P² de un cuantil con memoria constante (5 marcadores)"""
+
+    __slots__ = ("p", "q", "n", "np", "dn")
+
+    def __init__(self, p: float):
+        self.p = p
+        self.q: List[float] = []  # alturas de los marcadores (o primeras muestras)
+        self.n = [0, 1, 2, 3, 4]  # posiciones reales
+        self.np = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]  # posiciones deseadas
+        self.dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def update(self, x: float):
+        q = self.q
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        n = self.n
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        # Ajustar los marcadores intermedios
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = candidate
+                n[i] += d
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q, n = self.q, self.n
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> Optional[float]:
+        if not self.q:
+            return None
+        if len(self.q) < 5:
+            # Pocas muestras: cuantil exacto (interpolación lineal)
+            position = self.p * (len(self.q) - 1)
+            lower = int(position)
+            upper = min(lower + 1, len(self.q) - 1)
+            return self.q[lower] + (self.q[upper] - self.q[lower]) * (position - lower)
+        return self.q[2]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"p": self.p, "q": self.q, "n": self.n, "np": self.np}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "P2Quantile":
+        estimator = cls(data["p"])
+        estimator.q = list(data["q"])
+        estimator.n = list(data["n"])
+        estimator.np = list(data["np"])
+        return estimator
+
+
+class WindowStats:
+    """Acumulador de una ventana (o panel): RunningStats + cuantiles P²"""
+
+    __slots__ = ("start", "stats", "quantiles")
+
+    def __init__(self, start: float, percentiles: Sequence[float]):
+        self.start = start
+        self.stats = RunningStats()
+        self.quantiles = [P2Quantile(p) for p in percentiles]
+
+    def update(self, x: float):
+        self.stats.update(x)
+        for estimator in self.quantiles:
+            estimator.update(x)
+
+    def summary(self) -> Dict[str, Any]:
+        result = _stats_summary(self.stats)
+        for estimator in self.quantiles:
+            result[percentile_key(estimator.p)] = estimator.value()
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "start": self.start,
+            "stats": self.stats.to_dict(),
+            "quantiles": [q.to_dict() for q in self.quantiles],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "WindowStats":
+        window = cls(data["start"], ())
+        window.stats = RunningStats.from_dict(data["stats"])
+        window.quantiles = [P2Quantile.from_dict(q) for q in data["quantiles"]]
+        return window
+
+
+def _stats_summary(stats: RunningStats) -> Dict[str, Any]:
+    return {
+        "count": stats.count,
+        "mean": stats.mean if stats.count else None,
+        "stddev": stats.stddev,
+        "min": stats.min if stats.count else None,
+        "max": stats.max if stats.count else None,
+    }
+
+
+class MetricStream:
+    """Estado incremental de una métrica de un dispositivo"""
+
+    def __init__(self, engine: "StreamingStatsEngine"):
+        self.engine = engine
+        self.total = RunningStats()
+        self.ewma: Optional[float] = None
+        self.last: Optional[float] = None
+        self.tumbling: Optional[WindowStats] = None
+        self.last_tumbling: Optional[Dict[str, Any]] = None
+        self.panes: deque = deque()
+
+    def update(self, x: float, now: float):
+        engine = self.engine
+        self.total.update(x)
+        self.last = x
+        self.ewma = x if self.ewma is None else engine.ewma_alpha * x + (1 - engine.ewma_alpha) * self.ewma
+
+        # Ventana fija: al cambiar de intervalo se congela la anterior
+        start = now - now % engine.tumbling_seconds
+        if self.tumbling is None or self.tumbling.start != start:
+            if self.tumbling is not None:
+                self.last_tumbling = {"start": self.tumbling.start, **self.tumbling.summary()}
+            self.tumbling = WindowStats(start, engine.percentiles)
+        self.tumbling.update(x)
+
+        # Ventana deslizante: paneles de pane_seconds, se descartan los caducados
+        pane_start = now - now % engine.pane_seconds
+        if not self.panes or self.panes[-1].start != pane_start:
+            self.panes.append(WindowStats(pane_start, engine.percentiles))
+        self.panes[-1].update(x)
+        self._expire(now)
+
+    def _expire(self, now: float):
+        horizon = now - self.engine.sliding_seconds
+        while self.panes and self.panes[0].start + self.engine.pane_seconds <= horizon:
+            self.panes.popleft()
+
+    def sliding(self, now: float) -> Dict[str, Any]:
+        """
+        Resumen de la ventana deslizante. Media/varianza/min/max son exactas
+        (se combinan los paneles); los cuantiles son la media ponderada de los
+        estimadores P² de cada panel.
+        """
+        self._expire(now)
+        merged = RunningStats()
+        for pane in self.panes:
+            merged.merge(pane.stats)
+        result = _stats_summary(merged)
+        for i, p in enumerate(self.engine.percentiles):
+            weighted = [
+                (pane.quantiles[i].value(), pane.stats.count)
+                for pane in self.panes if pane.stats.count
+            ]
+            result[percentile_key(p)] = (
+                sum(v * c for v, c in weighted) / merged.count if weighted else None
+            )
+        return result
+
+    def summary(self, now: float) -> Dict[str, Any]:
+        tumbling = None
+        if self.tumbling is not None and self.tumbling.start + self.engine.tumbling_seconds > now:
+            tumbling = {"start": self.tumbling.start, **self.tumbling.summary()}
+        return {
+            "last": self.last,
+            "ewma": self.ewma,
+            "total": _stats_summary(self.total),
+            "tumbling": tumbling,
+            "previous_tumbling": self.last_tumbling,
+            "sliding": self.sliding(now),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total": self.total.to_dict(),
+            "ewma": self.ewma,
+            "last": self.last,
+            "tumbling": self.tumbling.to_dict() if self.tumbling else None,
+            "last_tumbling": self.last_tumbling,
+            "panes": [pane.to_dict() for pane in self.panes],
+        }
+
+    @classmethod
+    def from_dict(cls, engine: "StreamingStatsEngine", data: Dict[str, Any]) -> "MetricStream":
+        stream = cls(engine)
+        stream.total = RunningStats.from_dict(data["total"])
+        stream.ewma = data["ewma"]
+        stream.last = data["last"]
+        stream.tumbling = WindowStats.from_dict(data["tumbling"]) if data["tumbling"] else None
+        stream.last_tumbling = data["last_tumbling"]
+        stream.panes = deque(WindowStats.from_dict(pane) for pane in data["panes"])
+        return stream
+
+
+def parse_thresholds(spec: str) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+    """
+    Umbrales fijos con formato 'metrica:min:max' separados por comas;
+    cualquiera de los límites puede ir vacío (ej. 'temperature::95,oil_pressure:1.5:').
+    """
+    thresholds = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        field, _, limits = item.partition(":")
+        low, _, high = limits.partition(":")
+        if field not in METRIC_FIELDS:
+            logger.warning(f"⚠️  Umbral ignorado para métrica desconocida: {field}")
+            continue
+        thresholds[field] = (float(low) if low else None, float(high) if high else None)
+    return thresholds
+
+
+class StreamingStatsEngine:
+    """Estadísticas incrementales por dispositivo y métrica, con detección de anomalías"""
+
+    def __init__(
+        self,
+        tumbling_seconds: float = None,
+        sliding_seconds: float = None,
+        panes: int = None,
+        ewma_alpha: float = None,
+        zscore: float = None,
+        zscore_min_samples: int = None,
+        thresholds: Dict[str, Tuple[Optional[float], Optional[float]]] = None,
+        percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+        snapshot_path: str = None,
+        snapshot_interval: float = None,
+        max_anomalies: int = 500
+    ):
+        self.tumbling_seconds = tumbling_seconds or float(os.getenv("STREAM_STATS_TUMBLING", "60"))
+        self.sliding_seconds = sliding_seconds or float(os.getenv("STREAM_STATS_SLIDING", "300"))
+        self.pane_seconds = self.sliding_seconds / (panes or int(os.getenv("STREAM_STATS_PANES", "10")))
+        self.ewma_alpha = ewma_alpha or float(os.getenv("STREAM_STATS_EWMA_ALPHA", "0.1"))
+        self.zscore = zscore or float(os.getenv("STREAM_STATS_ZSCORE", "4"))
+        self.zscore_min_samples = zscore_min_samples or int(os.getenv("STREAM_STATS_ZSCORE_MIN_SAMPLES", "30"))
+        self.thresholds = (
+            thresholds if thresholds is not None
+            else parse_thresholds(os.getenv("STREAM_STATS_THRESHOLDS", ""))
+        )
+        self.percentiles = tuple(percentiles)
+        # Debe estar en un volumen escribible (/data/stream en docker-compose); vacío = sin snapshots
+        self.snapshot_path = (
+            snapshot_path if snapshot_path is not None
+            else os.getenv("STREAM_STATS_SNAPSHOT_PATH", "database/stream_stats.json")
+        )
+        self.snapshot_interval = snapshot_interval or float(os.getenv("STREAM_STATS_SNAPSHOT_INTERVAL", "60"))
+
+        self._devices: Dict[str, Dict[str, MetricStream]] = {}
+        self._lock = threading.Lock()
+        self.anomalies: deque = deque(maxlen=max_anomalies)
+        self.anomaly_count = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def update(self, payload: Dict[str, Any], now: float = None) -> List[Dict[str, Any]]:
+        """Procesa un mensaje; devuelve las anomalías detectadas en él"""
+        now = now if now is not None else time.time()
+        device_id = payload.get("device_id", "unknown")
+        found = []
+        with self._lock:
+            streams = self._devices.setdefault(device_id, {})
+            for field in METRIC_FIELDS:
+                value = payload.get(field)
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                stream = streams.get(field)
+                if stream is None:
+                    stream = streams[field] = MetricStream(self)
+                # Se evalúa contra el estado previo, antes de incorporar el valor
+                anomaly = self._check(device_id, field, float(value), stream, now)
+                if anomaly:
+                    found.append(anomaly)
+                stream.update(float(value), now)
+            for anomaly in found:
+                self.anomalies.append(anomaly)
+            self.anomaly_count += len(found)
+        for anomaly in found:
+            logger.warning(
+                f"🚨 Anomalía en {device_id}: {anomaly['field']}={anomaly['value']} ({anomaly['reason']})"
+            )
+        return found
+
+    def _check(self, device_id: str, field: str, value: float, stream: MetricStream, now: float):
+        reason = None
+        low, high = self.thresholds.get(field, (None, None))
+        if low is not None and value < low:
+            reason = f"por debajo del umbral {low}"
+        elif high is not None and value > high:
+            reason = f"por encima del umbral {high}"
+        elif stream.total.count >= self.zscore_min_samples:
+            stddev = stream.total.stddev
+            if stddev:
+                z = (value - stream.total.mean) / stddev
+                if abs(z) >= self.zscore:
+                    reason = f"z-score {z:.2f}"
+        if reason is None:
+            return None
+        return {"device_id": device_id, "field": field, "value": value, "reason": reason, "at": now}
+
+    def get_stats(self, device_id: str, fields: Sequence[str] = METRIC_FIELDS, now: float = None) -> Optional[Dict[str, Any]]:
+        """Estadísticas actuales de un dispositivo (lectura en tiempo constante)"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            streams = self._devices.get(device_id)
+            if streams is None:
+                return None
+            return {
+                field: streams[field].summary(now)
+                for field in fields if field in streams
+            }
+
+    def devices(self) -> List[str]:
+        with self._lock:
+            return sorted(self._devices)
+
+    def recent_anomalies(self, device_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        with self._lock:
+            anomalies = list(self.anomalies)
+        if device_id is not None:
+            anomalies = [a for a in anomalies if a["device_id"] == device_id]
+        return anomalies[-limit:][::-1]
+
+    # --- Snapshot ---
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "version": 1,
+                "taken_at": time.time(),
+                "percentiles": list(self.percentiles),
+                "devices": {
+                    device_id: {field: stream.to_dict() for field, stream in streams.items()}
+                    for device_id, streams in self._devices.items()
+                },
+            }
+
+    def restore(self, data: Dict[str, Any]):
+        if data.get("version") != 1 or list(data.get("percentiles", ())) != list(self.percentiles):
+            logger.warning("⚠️  Snapshot de estadísticas incompatible, se ignora")
+            return
+        devices = {
+            device_id: {field: MetricStream.from_dict(self, state) for field, state in streams.items()}
+            for device_id, streams in data["devices"].items()
+        }
+        with self._lock:
+            self._devices = devices
+
+    def save_snapshot(self):
+        """Escribe el snapshot de forma atómica (fichero temporal + rename)"""
+        if not self.snapshot_path:
+            return
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.error(f"❌ Error guardando snapshot de estadísticas: {e}")
+
+    def snapshot_dir_writable(self) -> bool:
+        """Si se puede escribir el snapshot (el directorio se crea si no existe)"""
+        directory = os.path.dirname(self.snapshot_path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            return False
+        return os.access(directory, os.W_OK)
+
+    def load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                self.restore(json.load(f))
+            logger.info(f"📂 Estadísticas restauradas desde {self.snapshot_path}")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"❌ Error cargando snapshot de estadísticas: {e}")
+
+    def start(self):
+        """Restaura el snapshot y arranca el guardado periódico"""
+        self.load_snapshot()
+        if self.snapshot_path and not self.snapshot_dir_writable():
+            logger.warning(
+                f"⚠️  No se puede escribir en {os.path.dirname(self.snapshot_path) or '.'}: "
+                "snapshots de estadísticas desactivados (STREAM_STATS_SNAPSHOT_PATH)"
+            )
+            self.snapshot_path = ""
+        if not self.snapshot_path:
+            return
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="stream-stats-snapshot", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.save_snapshot()
+
+    def _run(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            self.save_snapshot()
+
+
+# Instancia global
+streaming_stats = StreamingStatsEngine()
@@ -0,0 +1,301 @@
+"""
+Escritor por lotes para la ingesta de métricas MQTT.
+
+El hilo de red de paho solo encola filas ya decodificadas; un hilo escritor
+las vuelca a la base de datos como INSERT multi-fila cuando se alcanza el
+tamaño de lote o el intervalo de volcado.
+
+Las inserciones son idempotentes sobre (device_id, timestamp): un mensaje
+reentregado por QoS 1 o recibido por varios topics no duplica filas.
+
+Un error transitorio (conexión, failover...) se reintenta con backoff
+exponencial; si la base de datos rechaza el lote por sus datos
+(IntegrityError / DataError) se parte en mitades hasta aislar las filas
+no válidas, y solo esas se descartan.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlmodel import Session
+
+from app.models.motor_metrics import MotorMetrics
+from app.core.database.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Ventana (segundos) usada para calcular filas/s
+RATE_WINDOW_SECONDS = 60.0
+# Espera máxima (segundos) entre reintentos de un lote
+MAX_RETRY_BACKOFF = 30.0
+
+
+class MetricsBatchWriter:
+    """Cola acotada + hilo escritor que inserta métricas por lotes"""
+
+    def __init__(
+        self,
+        flush_size: int = None,
+        flush_interval: float = None,
+        queue_size: int = None,
+        retries: int = None,
+        retry_backoff: float = None
+    ):
+        self.flush_size = flush_size or int(os.getenv("MQTT_INGEST_FLUSH_SIZE", "500"))
+        self.flush_interval = flush_interval or float(os.getenv("MQTT_INGEST_FLUSH_INTERVAL", "1.0"))
+        self.queue_size = queue_size or int(os.getenv("MQTT_INGEST_QUEUE_SIZE", "10000"))
+        # Reintentos de un lote ante errores transitorios y espera inicial (se duplica)
+        self.retries = retries if retries is not None else int(os.getenv("MQTT_INGEST_RETRIES", "3"))
+        self.retry_backoff = (
+            retry_backoff if retry_backoff is not None
+            else float(os.getenv("MQTT_INGEST_RETRY_BACKOFF", "0.5"))
+        )
+
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=self.queue_size)
+        self._listeners: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self._transaction_hooks: List[Callable[[Session, List[Dict[str, Any]]], None]] = []
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Contadores
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_failed = 0
+        self.rows_duplicated = 0
+        self.retries_done = 0
+        self.batches_split = 0
+        self.batches_written = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self._recent_flushes = deque()  # (instante, filas)
+
+    def add_listener(self, callback: Callable[[List[Dict[str, Any]]], None]):
+        """Registra un callback que recibe las filas nuevas de cada lote tras confirmarse en DB"""
+        self._listeners.append(callback)
+
+    def add_transaction_hook(self, callback: Callable[[Session, List[Dict[str, Any]]], None]):
+        """
+        Registra un callback que recibe (sesión, filas nuevas) dentro de la
+        transacción del lote, antes del commit: si falla, el lote no se guarda
+        """
+        self._transaction_hooks.append(callback)
+
+    def submit(self, row: Dict[str, Any]) -> bool:
+        """
+        Encola una fila sin bloquear al llamante.
+        Si la cola está llena la fila se descarta y se contabiliza.
+        """
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rows_dropped += 1
+            return False
+
+    def start(self):
+        """Arranca el hilo escritor"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"🗄️  Escritor por lotes iniciado (lote={self.flush_size}, "
+            f"intervalo={self.flush_interval}s, cola={self.queue_size})"
+        )
+
+    def stop(self, timeout: float = 10.0):
+        """Detiene el hilo escritor volcando lo pendiente"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _collect_batch(self) -> List[Dict[str, Any]]:
+        """Espera filas hasta llenar el lote o agotar el intervalo"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self.flush(batch)
+
+        # Vaciar lo que quede en la cola antes de salir
+        batch = self._drain()
+        while batch:
+            self.flush(batch)
+            batch = self._drain()
+
+    @staticmethod
+    def _insert_statement(dialect_name: str):
+        """INSERT ... ON CONFLICT DO NOTHING que devuelve las claves insertadas"""
+        if dialect_name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect_name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return None
+        # Sin columnas de conflicto explícitas: basta el índice único
+        # (device_id, timestamp) y no falla si aún no se ha podido crear
+        return dialect_insert(MotorMetrics).on_conflict_do_nothing().returning(
+            MotorMetrics.device_id, MotorMetrics.timestamp
+        )
+
+    def _insert(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Inserta el lote y devuelve solo las filas que no existían"""
+        with Session(engine) as session:
+            stmt = self._insert_statement(session.get_bind().dialect.name)
+            if stmt is None:
+                session.execute(insert(MotorMetrics), batch)
+                rows = batch
+            else:
+                inserted = {tuple(row) for row in session.execute(stmt, batch)}
+                rows = batch if len(inserted) == len(batch) else self._new_rows(batch, inserted)
+            if rows:
+                for hook in self._transaction_hooks:
+                    hook(session, rows)
+            session.commit()
+        return rows
+
+    def _new_rows(self, batch: List[Dict[str, Any]], inserted: set) -> List[Dict[str, Any]]:
+        # Una sola fila por clave (el lote puede traer la misma lectura dos veces)
+        rows = []
+        for row in batch:
+            key = self._row_key(row)
+            if key in inserted:
+                inserted.discard(key)
+                rows.append(row)
+        return rows
+
+    @staticmethod
+    def _row_key(row: Dict[str, Any]) -> Tuple[Optional[str], Optional[float]]:
+        return row.get("device_id"), row.get("timestamp")
+
+    def _insert_retrying(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """_insert con reintentos y backoff exponencial ante errores transitorios"""
+        delay = self.retry_backoff
+        attempt = 0
+        while True:
+            try:
+                return self._insert(batch)
+            except (IntegrityError, DataError):
+                # Error de los datos: reintentar el mismo lote no sirve
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries_done += 1
+                logger.warning(
+                    f"⚠️ Error guardando lote de {len(batch)} métricas, "
+                    f"reintento {attempt}/{self.retries} en {delay:.1f}s: {e}"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_BACKOFF)
+
+    def _write(self, batch: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Inserta el lote; si la DB rechaza sus datos lo parte en mitades hasta
+        aislar las filas no válidas. Devuelve (filas nuevas, filas fallidas).
+        """
+        try:
+            return self._insert_retrying(batch), 0
+        except (IntegrityError, DataError) as e:
+            if len(batch) == 1:
+                logger.error(f"❌ Métrica descartada {self._row_key(batch[0])}: {getattr(e, 'orig', e)}")
+                return [], 1
+            with self._lock:
+                self.batches_split += 1
+            middle = len(batch) // 2
+            left, left_failed = self._write(batch[:middle])
+            right, right_failed = self._write(batch[middle:])
+            return left + right, left_failed + right_failed
+        except Exception as e:
+            logger.error(f"❌ Error guardando lote de {len(batch)} métricas: {e}")
+            return [], len(batch)
+
+    def flush(self, batch: List[Dict[str, Any]]):
+        """Inserta un lote en una única transacción (INSERT multi-fila)"""
+        inserted, failed = self._write(batch)
+        if failed:
+            with self._lock:
+                self.rows_failed += failed
+        if failed == len(batch):
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self.rows_written += len(inserted)
+            self.rows_duplicated += len(batch) - len(inserted) - failed
+            self.batches_written += 1
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self._recent_flushes.append((now, len(inserted)))
+            while self._recent_flushes and now - self._recent_flushes[0][0] > RATE_WINDOW_SECONDS:
+                self._recent_flushes.popleft()
+        logger.debug(
+            f"💾 Lote de {len(inserted)} métricas guardado en DB "
+            f"({len(batch) - len(inserted) - failed} duplicadas, {failed} fallidas)"
+        )
+
+        if not inserted:
+            return
+        for callback in self._listeners:
+            try:
+                callback(inserted)
+            except Exception as e:
+                logger.error(f"❌ Error en listener de lote: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Contadores de la ingesta"""
+        now = time.monotonic()
+        with self._lock:
+            recent = [n for t, n in self._recent_flushes if now - t <= RATE_WINDOW_SECONDS]
+            return {
+                "rows_written": self.rows_written,
+                "rows_dropped": self.rows_dropped,
+                "rows_failed": self.rows_failed,
+                "rows_duplicated": self.rows_duplicated,
+                "retries": self.retries_done,
+                "batches_split": self.batches_split,
+                "batches_written": self.batches_written,
+                "rows_per_second": sum(recent) / RATE_WINDOW_SECONDS,
+                "last_batch_size": self.last_batch_size,
+                "max_batch_size": self.max_batch_size,
+                "avg_batch_size": (
+                    self.rows_written / self.batches_written if self.batches_written else 0.0
+                ),
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue_size,
+                "flush_size": self.flush_size,
+                "flush_interval": self.flush_interval,
+            }
@@ -0,0 +1,336 @@
+"""
+Desacopla el hilo de red de paho del procesado de los mensajes.
+
+El callback on_message solo encola el payload crudo en una cola acotada;
+un pool de hilos lo decodifica y procesa. Así un paso lento (JSON, DB...)
+no retrasa los keep-alive ni provoca desconexiones del broker.
+
+Cada worker tiene su propia cola y los mensajes se reparten por
+`hash(device_id) % workers`: los de un mismo dispositivo los procesa
+siempre el mismo hilo y en el orden de llegada.
+
+Cuando una cola está llena se aplica una política explícita:
+- block: el hilo de red espera (contrapresión hacia el broker vía TCP),
+- drop-oldest: se descarta el mensaje más antiguo de la cola,
+- spill: el mensaje se vuelca a un fichero en disco y se reinyecta
+  cuando la cola baja de la mitad.
+"""
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OVERLOAD_POLICIES = ("block", "drop-oldest", "spill")
+# Muestras de latencia usadas para las estadísticas
+LATENCY_SAMPLES = 1000
+
+# Registro en el fichero de spill: longitudes de source, topic y payload
+_SPILL_HEADER = struct.Struct(">HHI")
+
+# (instante de encolado, topic, payload, source)
+Item = Tuple[float, str, bytes, str]
+
+
+class MessageDispatcher:
+    """Colas acotadas + pool de workers que procesan mensajes MQTT crudos"""
+
+    def __init__(
+        self,
+        handler: Callable[[str, bytes, str], None],
+        workers: int = None,
+        queue_size: int = None,
+        policy: str = None,
+        spill_path: str = None,
+        spill_max_bytes: int = None,
+        routing_key: Callable[[str, bytes], Optional[str]] = None
+    ):
+        """
+        `routing_key(topic, payload)` devuelve el device_id del mensaje sin
+        decodificarlo; si no hay función o devuelve None se reparte por topic.
+        """
+        self.handler = handler
+        self.routing_key = routing_key
+        self.workers = workers or int(os.getenv("MQTT_WORKERS", "4"))
+        self.queue_size = queue_size or int(os.getenv("MQTT_QUEUE_SIZE", "10000"))
+        self.policy = policy or os.getenv("MQTT_OVERLOAD_POLICY", "drop-oldest")
+        if self.policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"MQTT_OVERLOAD_POLICY no válida: {self.policy} ({', '.join(OVERLOAD_POLICIES)})")
+        self.spill_path = spill_path or os.getenv("MQTT_SPILL_PATH", "database/mqtt_spill.bin")
+        self.spill_max_bytes = spill_max_bytes or int(os.getenv("MQTT_SPILL_MAX_BYTES", str(100 * 1024 * 1024)))
+
+        # queue_size es la capacidad total, repartida entre las colas de los workers
+        per_worker = max(1, self.queue_size // self.workers)
+        self.queues: "List[queue.Queue[Optional[Item]]]" = [
+            queue.Queue(maxsize=per_worker) for _ in range(self.workers)
+        ]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        self._spill_bytes = 0
+        # Con mensajes en disco los nuevos también van a disco, para no adelantarlos
+        self._spill_backlog = False
+        self._stop_event = threading.Event()
+
+        # Contadores
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self._wait_times = deque(maxlen=LATENCY_SAMPLES)
+        self._process_times = deque(maxlen=LATENCY_SAMPLES)
+
+    # --- Hilo de red ---
+
+    def _queue_for(self, topic: str, payload: bytes) -> "queue.Queue[Optional[Item]]":
+        """Cola del worker que atiende al dispositivo del mensaje"""
+        key = None
+        if self.routing_key is not None:
+            try:
+                key = self.routing_key(topic, payload)
+            except Exception:
+                key = None
+        return self.queues[hash(key or topic) % self.workers]
+
+    def submit(self, topic: str, payload: bytes, source: str = "ingest"):
+        """Encola un mensaje crudo (llamado desde el hilo de red de paho)"""
+        item = (time.monotonic(), topic, payload, source)
+        with self._lock:
+            self.received += 1
+        if self._spill_backlog:
+            self._spill(item)
+            return
+        target = self._queue_for(topic, payload)
+        try:
+            target.put_nowait(item)
+        except queue.Full:
+            self._overflow(target, item)
+            return
+        depth = target.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _overflow(self, target: "queue.Queue[Optional[Item]]", item: Item):
+        if self.policy == "block":
+            with self._lock:
+                self.blocked += 1
+            target.put(item)
+        elif self.policy == "drop-oldest":
+            while True:
+                try:
+                    target.get_nowait()
+                    target.task_done()
+                    with self._lock:
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+                try:
+                    target.put_nowait(item)
+                    return
+                except queue.Full:
+                    continue
+        else:
+            self._spill(item)
+
+    # --- Spill a disco ---
+
+    def _spill(self, item: Item):
+        _, topic, payload, source = item
+        source_bytes, topic_bytes = source.encode(), topic.encode()
+        record = _SPILL_HEADER.pack(len(source_bytes), len(topic_bytes), len(payload)) + source_bytes + topic_bytes + payload
+        with self._spill_lock:
+            if self._spill_bytes + len(record) > self.spill_max_bytes:
+                with self._lock:
+                    self.dropped += 1
+                return
+            try:
+                if self._spill_file is None:
+                    os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+                    self._spill_file = open(self.spill_path, "ab")
+                self._spill_file.write(record)
+                self._spill_bytes += len(record)
+                self._spill_backlog = True
+            except OSError as e:
+                logger.error(f"❌ Error escribiendo spill MQTT: {e}")
+                with self._lock:
+                    self.dropped += 1
+                return
+        with self._lock:
+            self.spilled += 1
+
+    def _replay_spill(self):
+        """Reinyecta en la cola los mensajes volcados a disco"""
+        with self._spill_lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            # Un .replay previo es una reinyección interrumpida: se retoma primero
+            replay_path = self._replay_path
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, replay_path)
+                self._spill_bytes = 0
+
+        count = 0
+        completed = False
+        with open(replay_path, "rb") as f:
+            while True:
+                header = f.read(_SPILL_HEADER.size)
+                if len(header) < _SPILL_HEADER.size:
+                    completed = True
+                    break
+                source_len, topic_len, payload_len = _SPILL_HEADER.unpack(header)
+                source = f.read(source_len).decode()
+                topic = f.read(topic_len).decode()
+                payload = f.read(payload_len)
+                if not self._put_until_stopped((time.monotonic(), topic, payload, source)):
+                    break
+                count += 1
+        # Si se detuvo a medias el fichero se conserva; la escritura es idempotente
+        if completed:
+            os.remove(replay_path)
+            with self._spill_lock:
+                # Lo volcado durante la reinyección se reinyecta en la siguiente vuelta
+                if self._spill_bytes == 0 and not os.path.exists(self.spill_path):
+                    self._spill_backlog = False
+        with self._lock:
+            self.replayed += count
+        logger.info(f"♻️  {count} mensajes MQTT reinyectados desde disco")
+
+    def _put_until_stopped(self, item: Item) -> bool:
+        target = self._queue_for(item[1], item[2])
+        while not self._stop_event.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @property
+    def _replay_path(self) -> str:
+        return f"{self.spill_path}.replay"
+
+    def _spill_pending(self) -> bool:
+        return (
+            self._spill_bytes > 0
+            or os.path.exists(self.spill_path)
+            or os.path.exists(self._replay_path)
+        )
+
+    def _replay_loop(self):
+        while not self._stop_event.wait(1.0):
+            if self._spill_pending() and self._depth() < self.queue_size // 2:
+                try:
+                    self._replay_spill()
+                except OSError as e:
+                    logger.error(f"❌ Error reinyectando spill MQTT: {e}")
+
+    # --- Workers ---
+
+    def _depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def _work(self, work_queue: "queue.Queue[Optional[Item]]"):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                work_queue.task_done()
+                return
+            enqueued_at, topic, payload, source = item
+            started = time.monotonic()
+            try:
+                self.handler(topic, payload, source)
+                ok = True
+            except Exception as e:
+                ok = False
+                logger.error(f"❌ Error procesando mensaje MQTT: {e}")
+            finished = time.monotonic()
+            with self._lock:
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self._wait_times.append(started - enqueued_at)
+                self._process_times.append(finished - started)
+            work_queue.task_done()
+
+    def start(self):
+        """Arranca el pool de workers (y la reinyección del spill)"""
+        if self._threads:
+            return
+        self._stop_event.clear()
+        # Lo que quedó en disco de una ejecución anterior va antes que lo nuevo
+        self._spill_backlog = self.policy == "spill" and self._spill_pending()
+        for i, work_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(work_queue,), name=f"mqtt-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.policy == "spill":
+            thread = threading.Thread(target=self._replay_loop, name="mqtt-spill-replay", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(
+            f"🧵 Pool MQTT iniciado (workers={self.workers}, cola={self.queue_size}, política={self.policy})"
+        )
+
+    def stop(self, timeout: float = 10.0):
+        """Procesa lo encolado y detiene los workers; el spill queda en disco"""
+        self._stop_event.set()
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._spill_lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+    # --- Métricas ---
+
+    @staticmethod
+    def _latency(samples) -> Dict[str, Optional[float]]:
+        if not samples:
+            return {"avg_ms": None, "p95_ms": None, "max_ms": None}
+        ordered = sorted(samples)
+        return {
+            "avg_ms": sum(ordered) / len(ordered) * 1000,
+            "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            wait_times = list(self._wait_times)
+            process_times = list(self._process_times)
+            stats = {
+                "workers": self.workers,
+                "policy": self.policy,
+                "queue_depth": self._depth(),
+                "worker_queue_depths": [q.qsize() for q in self.queues],
+                "queue_size": self.queue_size,
+                "max_queue_depth": self.max_depth,
+                "received": self.received,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "spilled": self.spilled,
+                "replayed": self.replayed,
+                "spill_bytes": self._spill_bytes,
+            }
+        stats["queue_wait"] = self._latency(wait_times)
+        stats["processing"] = self._latency(process_times)
+        return stats
@@ -1,18 +1,46 @@
 """
-Servicio MQTT para recibir métricas del motor
+Servicio MQTT para recibir métricas del motor.
+
+Escala horizontalmente: cada proceso usa un client_id único y la ingesta
+se suscribe con suscripciones compartidas ($share/<grupo>/...), de modo
+que el broker reparte los mensajes entre todos los workers/réplicas en
+lugar de entregarlos a todos. Las vistas en memoria (última lectura,
+estadísticas, /metrics/stream) necesitan todos los mensajes en cada
+proceso, así que se alimentan desde un segundo cliente no compartido.
 """
 import paho.mqtt.client as mqtt
-import json
 import logging
 import os
+import socket
 import ssl
 import threading
-from sqlmodel import Session
-from app.models.motor_metrics import MotorMetrics
-from app.core.database.database import engine
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+from app.services.metrics_writer import MetricsBatchWriter
+from app.services.mqtt_dispatcher import MessageDispatcher
+from app.services.metrics_payload import (
+    MotorPayload,
+    PayloadError,
+    decode_binary,
+    decode_json,
+    peek_binary_device_id,
+    peek_json_device_id
+)
+from app.services.metrics_rollup import apply_rollups, init_rollup_watermark
+from app.services.metrics_broadcast import metrics_broadcaster
+from app.services.metrics_cache import metrics_response_cache
+from app.services.metrics_store import metrics_store
+from app.services.metrics_streaming import streaming_stats
+from app.services.metrics_partitions import partition_maintainer
 
 logger = logging.getLogger(__name__)
 
+# Desviación (s) esperada entre el reloj del dispositivo y el del servidor
+# (margen de la marca de cobertura de los rollups)
+MAX_CLOCK_SKEW = float(os.getenv("MQTT_MAX_CLOCK_SKEW", "3600"))
+
 class MQTTService:
     def __init__(self):
         self.broker_host = os.getenv("MQTT_BROKER_HOST", "kalimotxo_container_mqtt")
@@ -20,74 +48,171 @@ class MQTTService:
         self.use_tls = os.getenv("MQTT_USE_TLS", "true").lower() == "true"
         self.ca_cert = os.getenv("MQTT_CA_CERT", "/app/certs/ca.crt")
         
-        self.client = mqtt.Client(client_id="api_subscriber")
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        self.client_id_prefix = os.getenv("MQTT_CLIENT_ID_PREFIX", "api_subscriber")
+        # Por defecto solo el topic global: si se añaden topics que se solapan
+        # (p. ej. motor/metrics/device/+) las lecturas repetidas se descartan
+        self.topics = [
+            topic.strip()
+            for topic in os.getenv("MQTT_TOPICS", "motor/metrics/all").split(",")
+            if topic.strip()
+        ]
+        # Topics paralelos con el formato binario compacto (ver metrics_payload)
+        self.binary_topics = [
+            topic.strip()
+            for topic in os.getenv("MQTT_BINARY_TOPICS", "motor/metrics-bin/all").split(",")
+            if topic.strip()
+        ]
+        self.qos = int(os.getenv("MQTT_QOS", "1"))
+        # Grupo de suscripción compartida; vacío = suscripción normal (un solo consumidor)
+        self.shared_group = os.getenv("MQTT_SHARED_GROUP", "api")
+        self.live_enabled = os.getenv("MQTT_LIVE_ENABLED", "true").lower() == "true"
+        
+        self.client = self._create_client("ingest", self.on_connect, self.on_message)
+        # Con suscripción compartida este proceso solo recibe su parte:
+        # las vistas en vivo usan un cliente propio que lo recibe todo
+        self.live_client = None
+        if self.shared_group and self.live_enabled:
+            self.live_client = self._create_client("live", self.on_live_connect, self.on_live_message)
+        
+        # Mensajes del mismo dispositivo siempre al mismo worker: se procesan en orden
+        self.dispatcher = MessageDispatcher(self.process_message, routing_key=self._device_key)
+        self.writer = MetricsBatchWriter()
+        # Rollups en la misma transacción que las filas crudas: nunca se desincronizan
+        self.writer.add_transaction_hook(apply_rollups)
+        # Nuevas filas confirmadas: las respuestas cacheadas de /metrics quedan obsoletas
+        self.writer.add_listener(metrics_response_cache.on_rows)
+        self.running = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+    
+    def _create_client(self, role: str, on_connect, on_message) -> mqtt.Client:
+        # client_id único por proceso: dos workers con el mismo id se expulsan del broker
+        client_id = f"{self.client_id_prefix}-{role}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        client = mqtt.Client(client_id=client_id)
+        logger.info(f"🆔 Cliente MQTT {role}: {client_id}")
+        client.on_connect = on_connect
+        client.on_message = on_message
         
         if self.use_tls and os.path.exists(self.ca_cert):
             logger.info(f"Configurando TLS con CA: {self.ca_cert}")
-            self.client.tls_set(
+            client.tls_set(
                 ca_certs=self.ca_cert,
                 cert_reqs=ssl.CERT_REQUIRED,
                 tls_version=ssl.PROTOCOL_TLSv1_2
             )
-        
-        self.latest_metrics = None
-        self.running = False
+        return client
+    
+    def _subscriptions(self, shared: bool):
+        topics = self.topics + self.binary_topics
+        if shared and self.shared_group:
+            return [(f"$share/{self.shared_group}/{topic}", self.qos) for topic in topics]
+        return [(topic, self.qos) for topic in topics]
+    
+    def _subscribe(self, client, shared: bool):
+        subscriptions = self._subscriptions(shared)
+        client.subscribe(subscriptions)
+        logger.info(f"📡 Suscrito a {', '.join(topic for topic, _ in subscriptions)}")
     
     def on_connect(self, client, userdata, flags, rc):
-        """Callback de conexión"""
+        """Callback de conexión del cliente de ingesta"""
         if rc == 0:
             logger.info(f"✅ Conectado a MQTT: {self.broker_host}:{self.broker_port}")
-            client.subscribe("motor/metrics/all")
-            logger.info("📡 Suscrito a motor/metrics/all")
+            self._subscribe(client, shared=True)
         else:
             logger.error(f"❌ Error conectando a MQTT: {rc}")
     
+    def on_live_connect(self, client, userdata, flags, rc):
+        """Callback de conexión del cliente de vistas en vivo"""
+        if rc == 0:
+            self._subscribe(client, shared=False)
+        else:
+            logger.error(f"❌ Error conectando a MQTT (vivo): {rc}")
+    
     def on_message(self, client, userdata, msg):
-        """Callback de mensaje recibido"""
+        """Callback de mensaje recibido (ingesta): solo encola, el pool lo procesa"""
+        self.dispatcher.submit(msg.topic, msg.payload, "ingest")
+    
+    def on_live_message(self, client, userdata, msg):
+        """Callback de mensaje recibido (vistas en vivo): solo encola"""
+        self.dispatcher.submit(msg.topic, msg.payload, "live")
+    
+    def _is_binary(self, topic: str) -> bool:
+        return any(mqtt.topic_matches_sub(binary_topic, topic) for binary_topic in self.binary_topics)
+    
+    def _device_key(self, topic: str, raw: bytes) -> Optional[str]:
+        """device_id del mensaje sin decodificarlo (reparto entre workers)"""
+        if self._is_binary(topic):
+            return peek_binary_device_id(raw)
+        return peek_json_device_id(raw)
+    
+    def _decode(self, topic: str, raw: bytes) -> MotorPayload:
+        if self._is_binary(topic):
+            # Metadatos (nombre, IP, MAC) del último mensaje JSON del dispositivo
+            device_id = peek_binary_device_id(raw)
+            return decode_binary(raw, metrics_store.latest(device_id) if device_id else None)
+        return decode_json(raw)
+    
+    def process_message(self, topic: str, raw: bytes, source: str):
+        """Decodifica, valida y procesa un mensaje (en un worker del pool)"""
         try:
-            payload = json.loads(msg.payload.decode())
-            logger.debug(f"📊 Métricas recibidas: Temp={payload.get('temperature')}°C, RPM={payload.get('rpm')}")
-            
-            # Guardar última métrica en memoria
-            self.latest_metrics = payload
-            
-            # Guardar en base de datos
-            with Session(engine) as session:
-                metric = MotorMetrics(
-                    device_id=payload.get("device_id", "unknown"),
-                    device_name=payload.get("device_name", "Unknown Motor"),
-                    device_ip=payload.get("device_ip", ""),
-                    device_subnet=payload.get("device_subnet", ""),
-                    device_mac=payload.get("device_mac", ""),
-                    temperature=payload.get("temperature", 0.0),
-                    rpm=payload.get("rpm", 0.0),
-                    oil_pressure=payload.get("oil_pressure", 0.0),
-                    vibration=payload.get("vibration", 0.0),
-                    load_percentage=payload.get("load_percentage", 0.0),
-                    status=payload.get("status", "unknown"),
-                    event=payload.get("event"),
-                    timestamp=payload.get("timestamp", 0.0),
-                    datetime=payload.get("datetime", "")
-                )
-                session.add(metric)
-                session.commit()
-                logger.debug(f"💾 Métricas guardadas en DB (ID: {metric.id})")
+            payload = self._decode(topic, raw)
+        except PayloadError as e:
+            with self._lock:
+                self.rejected += 1
+            logger.warning(f"⚠️  Mensaje MQTT rechazado ({topic}): {e}")
+            return
+        logger.debug(f"📊 Métricas recibidas: Temp={payload.temperature}°C, RPM={payload.rpm}")
         
-        except Exception as e:
-            logger.error(f"❌ Error procesando mensaje MQTT: {e}")
+        if source == "live" or (self.live_client is None and self.live_enabled):
+            self._update_live_views(payload.model_dump())
+        
+        if source == "ingest":
+            # Encolar para el escritor por lotes
+            self.writer.submit(self._payload_to_row(payload))
+    
+    @staticmethod
+    def _update_live_views(payload: dict):
+        # Guardar en memoria (última lectura y ventana reciente por dispositivo).
+        # Una lectura repetida no vuelve a contar en las estadísticas ni se difunde
+        if not metrics_store.add(payload):
+            return
+        
+        # Estadísticas incrementales y detección de anomalías
+        streaming_stats.update(payload)
+        
+        # Difundir a los clientes de /metrics/stream
+        metrics_broadcaster.publish(payload)
+    
+    @staticmethod
+    def _payload_to_row(payload: MotorPayload) -> dict:
+        """Convierte un payload MQTT validado en una fila de motor_metrics"""
+        row = payload.model_dump()
+        now = time.time()
+        # Parte de la clave idempotente (device_id, timestamp)
+        row["timestamp"] = payload.timestamp or now
+        # created_at es la clave de partición y entra en el índice único: se deriva
+        # solo del timestamp del dispositivo para que una reentrega caiga en la misma
+        # fila. Con el reloj desviado la fila acaba en la partición por defecto
+        row["created_at"] = datetime.utcfromtimestamp(row["timestamp"])
+        return row
     
     def start(self):
         """Inicia el cliente MQTT"""
         try:
             logger.info(f"🚀 Iniciando servicio MQTT...")
-            self.client.connect(self.broker_host, self.broker_port, 60)
+            # Particiones futuras y retención (las necesarias ya se crean al arrancar)
+            partition_maintainer.start()
+            init_rollup_watermark(margin=MAX_CLOCK_SKEW)
+            self.writer.start()
+            self.dispatcher.start()
+            streaming_stats.start()
             self.running = True
             
-            # Ejecutar en thread separado
-            thread = threading.Thread(target=self.client.loop_forever, daemon=True)
-            thread.start()
+            # Ejecutar cada cliente en su thread
+            for client in self._clients():
+                client.connect(self.broker_host, self.broker_port, 60)
+                thread = threading.Thread(target=client.loop_forever, daemon=True)
+                thread.start()
             
             logger.info("✅ Servicio MQTT iniciado")
         except Exception as e:
@@ -96,13 +221,29 @@ class MQTTService:
     def stop(self):
         """Detiene el cliente MQTT"""
         self.running = False
-        self.client.loop_stop()
-        self.client.disconnect()
+        for client in self._clients():
+            client.loop_stop()
+            client.disconnect()
+        self.dispatcher.stop()
+        self.writer.stop()
+        streaming_stats.stop()
+        partition_maintainer.stop()
         logger.info("⏹️  Servicio MQTT detenido")
     
-    def get_latest_metrics(self):
-        """Obtiene las últimas métricas"""
-        return self.latest_metrics
+    def _clients(self):
+        return [client for client in (self.client, self.live_client) if client is not None]
+    
+    def get_latest_metrics(self, device_id: str = None):
+        """Obtiene las últimas métricas (de un dispositivo o de toda la flota)"""
+        return metrics_store.latest(device_id)
+    
+    def get_ingest_stats(self):
+        """Obtiene los contadores del pool de procesado y del escritor por lotes"""
+        return {
+            **self.writer.get_stats(),
+            "messages_rejected": self.rejected,
+            "dispatcher": self.dispatcher.get_stats()
+        }
 
 # Instancia global
 mqtt_service = MQTTService()
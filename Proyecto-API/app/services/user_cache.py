@@ -0,0 +1,187 @@
+"""
+Caché en proceso de los usuarios locales (tabla users) indexada por keycloak_id.
+Evita consultar la base de datos en cada petición autenticada.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, TYPE_CHECKING
+
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from app.models.user import User
+
+if TYPE_CHECKING:
+    from app.core.auth.base import UserInfo
+
+
+class LocalUser(BaseModel):
+    """Copia ligera (inmutable) de una fila de users"""
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+    id: int
+    keycloak_id: str
+    username: str
+    email: Optional[str] = None
+    is_active: bool = True
+    profile_completed: bool = False
+    created_at: Optional[datetime] = None
+
+
+class LocalUserCache:
+    """Caché LRU con TTL de keycloak_id -> LocalUser"""
+
+    def __init__(self, ttl: float = 60.0, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple[LocalUser, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, keycloak_id: str) -> Optional[LocalUser]:
+        with self._lock:
+            entry = self._entries.get(keycloak_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[keycloak_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(keycloak_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user: LocalUser):
+        with self._lock:
+            self._entries[user.keycloak_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.keycloak_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keycloak_id: str):
+        with self._lock:
+            self._entries.pop(keycloak_id, None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def _upsert_statement(dialect_name: str, values: dict):
+    """INSERT ... ON CONFLICT (keycloak_id) que devuelve siempre la fila"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+
+    stmt = insert(User).values(**values)
+    # Actualizar a sí mismo para que RETURNING devuelva la fila existente
+    return stmt.on_conflict_do_update(
+        index_elements=[User.keycloak_id],
+        set_={"keycloak_id": stmt.excluded.keycloak_id}
+    ).returning(User)
+
+
+def upsert_local_user(session: Session, user_info: "UserInfo") -> LocalUser:
+    """
+    Obtiene o crea el usuario local de forma atómica.
+    Dos peticiones concurrentes del mismo usuario nunca crean filas duplicadas.
+    """
+    values = {
+        "keycloak_id": user_info.user_id,
+        "username": user_info.username,
+        "email": user_info.email,
+        "is_active": user_info.is_active,
+        "profile_completed": False,
+        "created_at": datetime.utcnow()
+    }
+
+    stmt = _upsert_statement(session.get_bind().dialect.name, values)
+    if stmt is not None:
+        user = session.execute(select(User).from_statement(stmt)).scalar_one()
+        session.commit()
+    else:
+        # Motores sin ON CONFLICT: insertar y releer si otro lo creó antes
+        try:
+            user = User(**values)
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+        except IntegrityError:
+            session.rollback()
+            user = session.exec(
+                select(User).where(User.keycloak_id == user_info.user_id)
+            ).one()
+
+    local_user = LocalUser.model_validate(user)
+    local_user_cache.put(local_user)
+    return local_user
+
+
+def insert_local_users(session: Session, users: List["UserInfo"]) -> int:
+    """
+    Alta en bloque de usuarios locales (un INSERT multi-fila).
+    Los que ya existen (mismo keycloak_id) se ignoran; devuelve las filas nuevas.
+    """
+    if not users:
+        return 0
+    now = datetime.utcnow()
+    rows = [
+        {
+            "keycloak_id": user_info.user_id,
+            "username": user_info.username,
+            "email": user_info.email,
+            "is_active": user_info.is_active,
+            "profile_completed": False,
+            "created_at": now
+        }
+        for user_info in users
+    ]
+
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for user_info in users:
+            upsert_local_user(session, user_info)
+        return len(users)
+
+    stmt = insert(User).values(rows).on_conflict_do_nothing(
+        index_elements=[User.keycloak_id]
+    ).returning(User.id)
+    inserted = len(session.execute(stmt).all())
+    session.commit()
+    return inserted
+
+
+def load_local_user(session: Session, user_info: "UserInfo") -> LocalUser:
+    """Lee el usuario local de la DB (creándolo si falta) y lo guarda en caché"""
+    user = session.exec(
+        select(User).where(User.keycloak_id == user_info.user_id)
+    ).first()
+    if user is None:
+        return upsert_local_user(session, user_info)
+
+    local_user = LocalUser.model_validate(user)
+    local_user_cache.put(local_user)
+    return local_user
+
+
+# Instancia global
+local_user_cache = LocalUserCache(
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+    max_size=int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+)
@@ -0,0 +1,217 @@
+"""
+Alta masiva de usuarios (CSV o JSON) en el proveedor de identidad.
+
+Las filas se procesan con una ventana fija de llamadas concurrentes al
+proveedor (USER_IMPORT_CONCURRENCY), todas con el mismo token de
+administrador cacheado. Los usuarios locales se insertan en lotes con un
+INSERT multi-fila, y el resultado de cada fila se devuelve en NDJSON según
+se completa, junto con líneas de progreso.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError, field_validator
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.core.auth.base import AsyncIdentityProvider, UserInfo
+from app.core.database.database import engine
+from app.services.user_cache import insert_local_users
+
+logger = logging.getLogger(__name__)
+
+USER_IMPORT_CONCURRENCY = int(os.getenv("USER_IMPORT_CONCURRENCY", "8"))
+USER_IMPORT_MAX_ROWS = int(os.getenv("USER_IMPORT_MAX_ROWS", "10000"))
+# Usuarios locales por INSERT
+USER_IMPORT_DB_BATCH = int(os.getenv("USER_IMPORT_DB_BATCH", "200"))
+
+IMPORT_FORMATS = ("csv", "json")
+
+
+class ImportUser(BaseModel):
+    """Fila de la importación; `roles` admite lista o texto separado por ';'"""
+    username: str
+    email: str
+    password: str
+    first_name: str = ""
+    last_name: str = ""
+    roles: List[str] = []
+
+    @field_validator("username", "email", "password")
+    @classmethod
+    def _not_empty(cls, value: str) -> str:
+        if not value.strip():
+            raise ValueError("no puede estar vacío")
+        return value
+
+    @field_validator("roles", mode="before")
+    @classmethod
+    def _split_roles(cls, value):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [role.strip() for role in value.split(";") if role.strip()]
+        return value
+
+
+def parse_rows(body: bytes, import_format: str) -> List[Dict[str, Any]]:
+    """Filas crudas del CSV (con cabecera) o del array JSON; 400 si no se puede leer"""
+    try:
+        text = body.decode("utf-8-sig")
+        if import_format == "csv":
+            rows = [
+                {key.strip(): value for key, value in row.items() if key and value not in (None, "")}
+                for row in csv.DictReader(io.StringIO(text))
+            ]
+        else:
+            rows = json.loads(text)
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise ValueError("se esperaba un array JSON de objetos")
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"No se pudo leer el fichero: {e}")
+
+    if not rows:
+        raise HTTPException(status_code=400, detail="El fichero no contiene usuarios")
+    if len(rows) > USER_IMPORT_MAX_ROWS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Como mucho {USER_IMPORT_MAX_ROWS} usuarios por importación"
+        )
+    return rows
+
+
+def _insert_batch(users: List[UserInfo]) -> int:
+    with Session(engine) as session:
+        return insert_local_users(session, users)
+
+
+async def _provision(
+    provider: AsyncIdentityProvider,
+    row_number: int,
+    raw: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Optional[UserInfo]]:
+    """Alta de una fila en el proveedor: (resultado, usuario creado o None)"""
+    result: Dict[str, Any] = {"type": "row", "row": row_number, "username": raw.get("username")}
+    try:
+        user = ImportUser.model_validate(raw)
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+        return {**result, "status": "invalid", "error": errors}, None
+
+    try:
+        user_info = await provider.create_user(
+            username=user.username,
+            email=user.email,
+            password=user.password,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+    except HTTPException as e:
+        status = "exists" if e.status_code == 409 else "error"
+        return {**result, "status": status, "error": e.detail}, None
+    except Exception as e:
+        logger.error(f"❌ Error importando el usuario {user.username}: {e}")
+        return {**result, "status": "error", "error": str(e)}, None
+
+    result.update(status="created", user_id=user_info.user_id)
+    failed_roles = []
+    for role in user.roles:
+        try:
+            if not await provider.assign_role(user_info.user_id, role):
+                failed_roles.append(role)
+        except Exception as e:
+            # 404 del rol, pero también errores HTTP/de red del proveedor: la fila sigue adelante
+            if not isinstance(e, HTTPException):
+                logger.error(f"❌ Error asignando el rol {role} a {user.username}: {e}")
+            failed_roles.append(role)
+    if user.roles:
+        result["roles"] = [role for role in user.roles if role not in failed_roles]
+        user_info = user_info.model_copy(update={"roles": result["roles"]})
+    if failed_roles:
+        result["error"] = f"Roles no asignados: {', '.join(failed_roles)}"
+    return result, user_info
+
+
+async def import_users(
+    provider: AsyncIdentityProvider,
+    rows: List[Dict[str, Any]],
+    concurrency: int = USER_IMPORT_CONCURRENCY,
+    db_batch_size: int = USER_IMPORT_DB_BATCH
+) -> AsyncIterator[str]:
+    """
+    Procesa las filas con `concurrency` altas en vuelo y emite NDJSON:
+    una línea "row" por fila (en orden de finalización), una "progress"
+    por cada lote guardado en la DB local y un "summary" al final.
+    """
+    total = len(rows)
+    pending: "asyncio.Queue[Tuple[int, Dict[str, Any]]]" = asyncio.Queue()
+    for row_number, raw in enumerate(rows, start=1):
+        pending.put_nowait((row_number, raw))
+    results: "asyncio.Queue[Tuple[Dict[str, Any], Optional[UserInfo]]]" = asyncio.Queue()
+
+    async def worker():
+        while True:
+            try:
+                row_number, raw = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                result = await _provision(provider, row_number, raw)
+            except Exception as e:
+                # Cada fila debe producir un resultado o el stream no terminaría nunca
+                logger.error(f"❌ Error inesperado importando la fila {row_number}: {e}")
+                result = ({
+                    "type": "row",
+                    "row": row_number,
+                    "username": raw.get("username"),
+                    "status": "error",
+                    "error": str(e)
+                }, None)
+            await results.put(result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, total)))]
+    counts = {"created": 0, "exists": 0, "invalid": 0, "error": 0}
+    processed = 0
+    local_inserted = 0
+    batch: List[UserInfo] = []
+
+    def progress() -> str:
+        return json.dumps({
+            "type": "progress",
+            "processed": processed,
+            "total": total,
+            "local_inserted": local_inserted,
+            **counts
+        }) + "\n"
+
+    try:
+        while processed < total:
+            result, user_info = await results.get()
+            processed += 1
+            counts[result["status"]] += 1
+            yield json.dumps(result) + "\n"
+
+            if user_info is not None:
+                batch.append(user_info)
+            if len(batch) >= db_batch_size or (processed == total and batch):
+                try:
+                    local_inserted += await run_in_threadpool(_insert_batch, batch)
+                except Exception as e:
+                    # Los usuarios ya existen en el proveedor: se crearán en local en su primer login
+                    logger.error(f"❌ Error guardando {len(batch)} usuarios importados: {e}")
+                    yield json.dumps({"type": "error", "error": f"DB local: {e}", "users": len(batch)}) + "\n"
+                batch = []
+                yield progress()
+            elif processed % db_batch_size == 0:
+                yield progress()
+    finally:
+        for task in workers:
+            task.cancel()
+
+    yield json.dumps({"type": "summary", "total": total, "local_inserted": local_inserted, **counts}) + "\n"
@@ -0,0 +1,79 @@
+"""
+Benchmark de decodificación de payloads MQTT del motor.
+
+Compara el decodificador anterior (json.loads + payload.get con valores
+por defecto), el JSON validado (pydantic validate_json) y el formato
+binario compacto.
+
+Uso:
+    python scripts/bench_payload_decode.py [--messages 100000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.metrics_payload import MotorPayload, decode_binary, decode_json, encode_binary  # noqa: E402
+
+FIELDS = ("temperature", "rpm", "oil_pressure", "vibration", "load_percentage")
+
+
+def make_payloads(count: int):
+    rng = random.Random(42)
+    payloads = []
+    for i in range(count):
+        payloads.append({
+            "device_id": f"motor-{i % 50:02d}",
+            "device_name": f"Motor {i % 50}",
+            "device_ip": f"10.0.0.{i % 50}",
+            "device_subnet": "255.255.255.0",
+            "device_mac": "b8:27:eb:00:00:01",
+            "temperature": round(rng.uniform(60, 95), 2),
+            "rpm": round(rng.uniform(1200, 1800), 1),
+            "oil_pressure": round(rng.uniform(2, 4), 2),
+            "vibration": round(rng.uniform(0, 1), 3),
+            "load_percentage": round(rng.uniform(20, 90), 1),
+            "status": rng.choice(("running", "warning", "error")),
+            "event": None,
+            "timestamp": 1700000000.0 + i,
+            "datetime": "2023-11-14T22:13:20",
+        })
+    return payloads
+
+
+def legacy_decode(raw: bytes) -> dict:
+    payload = json.loads(raw.decode())
+    return {field: payload.get(field, 0.0) for field in FIELDS}
+
+
+def bench(name: str, decode, messages) -> None:
+    start = time.perf_counter()
+    for raw in messages:
+        decode(raw)
+    elapsed = time.perf_counter() - start
+    size = sum(len(raw) for raw in messages) / len(messages)
+    print(f"{name:<28} {len(messages) / elapsed:>12,.0f} msg/s {elapsed * 1e6 / len(messages):>8.2f} µs/msg {size:>7.1f} B/msg")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de decodificación de payloads MQTT")
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.messages)
+    json_messages = [json.dumps(p).encode() for p in payloads]
+    binary_messages = [encode_binary(MotorPayload.model_validate(p)) for p in payloads]
+    metadata = {"device_name": "Motor", "device_ip": "10.0.0.1"}
+
+    print(f"{args.messages:,} mensajes")
+    bench("json.loads + get (anterior)", legacy_decode, json_messages)
+    bench("JSON validado (pydantic)", decode_json, json_messages)
+    bench("binario (struct)", lambda raw: decode_binary(raw, metadata), binary_messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import app.core.database.database as database
+from app.core.database.database import PoolWaitStats, ReplicaRouter, read_session, to_async_url
+
+
+def test_to_async_url_swaps_driver():
+    assert to_async_url("postgresql://u:p@db:5432/app") == "postgresql+asyncpg://u:p@db:5432/app"
+    assert to_async_url("postgresql+psycopg2://u:p@db/app") == "postgresql+asyncpg://u:p@db/app"
+    assert to_async_url("sqlite:///./database/app.db") == "sqlite+aiosqlite:///./database/app.db"
+    with pytest.raises(ValueError):
+        to_async_url("mysql://u:p@db/app")
+
+
+def test_pool_wait_stats():
+    stats = PoolWaitStats(samples=100)
+    assert stats.get_stats()["avg_ms"] is None
+    for i in range(1, 101):
+        stats.record(i / 1000)
+    result = stats.get_stats()
+    assert result["checkouts"] == 100
+    assert result["max_ms"] == pytest.approx(100)
+    assert result["p95_ms"] == pytest.approx(96)
+
+
+class _FakeLagRouter(ReplicaRouter):
+    def __init__(self, lags, **kwargs):
+        super().__init__(**kwargs)
+        self._lags = iter(lags)
+
+    async def _measure_lag(self, replica):
+        return next(self._lags)
+
+
+def test_replica_router_falls_back_on_lag_and_errors():
+    router = _FakeLagRouter([1.0, 30.0, None, 0.5], max_lag=5, check_interval=0)
+
+    async def decisions():
+        return [await router.use_replica(None) for _ in range(4)]
+
+    assert asyncio.run(decisions()) == [True, False, False, True]
+    stats = router.get_stats()
+    assert stats["replica_reads"] == 2
+    assert stats["primary_fallback_reads"] == 2
+
+
+def test_replica_router_caches_lag_between_checks():
+    router = _FakeLagRouter([1.0], max_lag=5, check_interval=60)
+
+    async def decisions():
+        return [await router.use_replica(None) for _ in range(3)]
+
+    # Una sola medición dentro del intervalo
+    assert asyncio.run(decisions()) == [True, True, True]
+
+
+class _HangingReplicaRouter(ReplicaRouter):
+    async def _query_lag(self, replica):
+        await asyncio.sleep(10)
+        return 0.0
+
+
+def test_replica_probe_times_out():
+    router = _HangingReplicaRouter(max_lag=5, check_interval=0, timeout=0.01)
+
+    async def decide():
+        return await asyncio.wait_for(router.use_replica(None), 1)
+
+    assert asyncio.run(decide()) is False
+    assert router.get_stats()["lag_s"] is None
+
+
+class _FakeSession:
+    def __init__(self, name):
+        self.name = name
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_read_session_falls_back_to_primary(monkeypatch):
+    router = _FakeLagRouter([0.0], max_lag=5, check_interval=60, timeout=0.05)
+
+    async def open_session(async_engine, wait_stats):
+        if async_engine == "replica":
+            raise ConnectionRefusedError("réplica caída")
+        return _FakeSession(async_engine)
+
+    monkeypatch.setattr(database, "replica_router", router)
+    monkeypatch.setattr(database, "get_async_replica_engine", lambda: "replica")
+    monkeypatch.setattr(database, "get_async_engine", lambda: "primary")
+    monkeypatch.setattr(database, "_open_session", open_session)
+
+    async def read():
+        names = []
+        for _ in range(2):
+            async with read_session() as session:
+                names.append(session.name)
+        return names
+
+    assert asyncio.run(read()) == ["primary", "primary"]
+    stats = router.get_stats()
+    assert stats["healthy"] is False
+    assert stats["replica_reads"] == 0
+    assert stats["primary_fallback_reads"] == 2
@@ -0,0 +1,51 @@
+from app.core.auth.jwks import JWKSKeyStore
+
+
+def _jwks(*kids):
+    return {"keys": [{"kid": k, "kty": "RSA", "use": "sig", "n": "n", "e": "AQAB"} for k in kids]}
+
+
+class FakeFetcher:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        response = self.responses[min(self.calls, len(self.responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_keys_are_cached_by_kid():
+    fetch = FakeFetcher([_jwks("a", "b")])
+    store = JWKSKeyStore(fetch, background_refresh=False)
+    assert store.get_key("a")["kid"] == "a"
+    assert store.get_key("b")["kid"] == "b"
+    assert fetch.calls == 1
+
+
+def test_unknown_kid_forces_single_refetch():
+    fetch = FakeFetcher([_jwks("a"), _jwks("a", "rotated")])
+    store = JWKSKeyStore(fetch, min_refetch_interval=0, background_refresh=False)
+    store.get_key("a")
+    assert store.get_key("rotated")["kid"] == "rotated"
+    assert fetch.calls == 2
+
+
+def test_unknown_kid_refetch_is_rate_limited():
+    fetch = FakeFetcher([_jwks("a")])
+    store = JWKSKeyStore(fetch, min_refetch_interval=60, background_refresh=False)
+    store.get_key("a")
+    assert store.get_key("missing") is None
+    assert store.get_key("missing") is None
+    assert fetch.calls == 1
+
+
+def test_stale_keys_served_when_provider_down():
+    fetch = FakeFetcher([_jwks("a"), ConnectionError("down")])
+    store = JWKSKeyStore(fetch, ttl=0, min_refetch_interval=0, background_refresh=False)
+    store.get_key("a")
+    assert not store.refresh()
+    assert store.get_key("a")["kid"] == "a"
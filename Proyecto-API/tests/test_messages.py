@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import app.models.indexes  # noqa: F401 (índice owner_id de los mensajes)
+from app.core.auth import get_current_user_with_db
+from app.core.database.database import get_session
+from app.models.user import Message, User
+from app.routers.messages.messages import router
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(id=1, keycloak_id="kc-1", username="ana"))
+        session.add(User(id=2, keycloak_id="kc-2", username="luis"))
+        session.commit()
+    return engine
+
+
+def _client(engine, user_id):
+    app = FastAPI()
+    app.include_router(router, prefix="/messages")
+
+    def session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = session_override
+    app.dependency_overrides[get_current_user_with_db] = lambda: {
+        "db_user": SimpleNamespace(id=user_id), "user_id": user_id
+    }
+    return TestClient(app)
+
+
+def test_delete_only_removes_own_messages(engine):
+    ana, luis = _client(engine, 1), _client(engine, 2)
+    message_id = ana.post("/messages/", json={"content": "hola"}).json()["id"]
+
+    # Un mensaje ajeno no se distingue de uno que no existe
+    assert luis.delete(f"/messages/{message_id}").status_code == 404
+    with Session(engine) as session:
+        assert session.get(Message, message_id) is not None
+
+    assert ana.delete(f"/messages/{message_id}").status_code == 204
+    assert ana.delete(f"/messages/{message_id}").status_code == 404
+    with Session(engine) as session:
+        assert session.get(Message, message_id) is None
+
+
+def test_listing_pages_by_id_without_other_users_messages(engine):
+    ana, luis = _client(engine, 1), _client(engine, 2)
+    own = [ana.post("/messages/", json={"content": f"m{i}"}).json()["id"] for i in range(5)]
+    luis.post("/messages/", json={"content": "ajeno"})
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = ana.get("/messages/", params=params)
+        assert response.status_code == 200
+        pages.append([message["id"] for message in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert pages == [own[::-1][0:2], own[::-1][2:4], own[::-1][4:]]
+
+
+def test_listing_uses_the_owner_index(engine):
+    with Session(engine) as session:
+        statement = select(Message).where(Message.owner_id == 1).order_by(Message.id.desc()).limit(50)
+        compiled = statement.compile(engine, compile_kwargs={"literal_binds": True})
+        plan = " ".join(str(row) for row in session.execute(text(f"EXPLAIN QUERY PLAN {compiled}")))
+    assert "ix_message_owner_id_id" in plan
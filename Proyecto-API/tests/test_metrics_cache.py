@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.services.metrics_cache import MetricsResponseCache, etag_matches, normalize_key
+
+KEY = normalize_key("stats", {"device_id": "d1", "fields": ["rpm"]})
+
+
+def test_hit_until_new_rows_for_the_device():
+    cache = MetricsResponseCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {"n": len(calls)}, {"X-Total-Count": "1"}
+
+    async def run():
+        first = await cache.get_or_compute(KEY, "d1", compute)
+        second = await cache.get_or_compute(KEY, "d1", compute)
+        assert second is first
+        cache.on_rows([{"device_id": "d2"}])
+        assert await cache.get_or_compute(KEY, "d1", compute) is first
+        cache.on_rows([{"device_id": "d1"}])
+        third = await cache.get_or_compute(KEY, "d1", compute)
+        assert third.etag != first.etag
+        return third
+
+    response = asyncio.run(run())
+    assert len(calls) == 2
+    assert response.headers["X-Total-Count"] == "1"
+
+
+def test_concurrent_requests_share_one_computation():
+    cache = MetricsResponseCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"ok": True}, {}
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute(KEY, "d1", compute) for _ in range(10)])
+
+    responses = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r is responses[0] for r in responses)
+    assert cache.get_stats()["coalesced"] == 9
+
+
+def test_errors_are_shared_and_not_cached():
+    cache = MetricsResponseCache(ttl=60)
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=404, detail="No hay datos disponibles")
+
+    async def run():
+        return await asyncio.gather(
+            *[cache.get_or_compute(KEY, "d1", compute) for _ in range(3)],
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, HTTPException) for r in results)
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_not_modified_when_etag_matches():
+    cache = MetricsResponseCache(ttl=60)
+
+    async def compute():
+        return {"ok": True}, {}
+
+    cached = asyncio.run(cache.get_or_compute(KEY, None, compute))
+    assert cache.respond(cached, None).status_code == 200
+    response = cache.respond(cached, f'W/"other", {cached.etag}')
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["ETag"] == cached.etag
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False), ('"a"', True), ('W/"a"', True), ('"b", "a"', True), ("*", True), ('"b"', False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, '"a"') is expected
+
+
+def test_cached_stats_do_not_open_a_read_session(monkeypatch):
+    from contextlib import asynccontextmanager
+
+    import app.routers.metrics.metrics as metrics_router
+
+    opened = []
+
+    @asynccontextmanager
+    async def fake_read_session():
+        opened.append(1)
+        yield object()
+
+    async def fake_stats(session, *args):
+        return {"total_records": 1}
+
+    monkeypatch.setattr(metrics_router, "read_session", fake_read_session)
+    monkeypatch.setattr(metrics_router, "_metrics_stats", fake_stats)
+    monkeypatch.setattr(metrics_router, "metrics_response_cache", MetricsResponseCache(ttl=60))
+
+    async def run():
+        responses = []
+        for if_none_match in (None, None, "*"):
+            responses.append(await metrics_router.get_metrics_stats(
+                from_=None, to=None, device_id="d1", fields=None, percentiles=None,
+                source="auto", if_none_match=if_none_match, current_user={}
+            ))
+        return responses
+
+    first, second, not_modified = asyncio.run(run())
+    # Solo el primer cálculo pide una conexión; el acierto y el 304 no
+    assert len(opened) == 1
+    assert first.body == second.body
+    assert not_modified.status_code == 304
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+import app.services.metrics_export as metrics_export
+from app.core.auth import get_current_user
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_export import check_format, iter_batches, stream_csv, stream_ndjson
+
+START = datetime(2025, 3, 1)
+
+
+@pytest.fixture(autouse=True)
+def engine(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    rows = [
+        {
+            "device_id": f"motor-{i % 3}",
+            "rpm": 1000.0 + i,
+            "status": "running",
+            "timestamp": float(i),
+            # Varias filas por instante: el desempate es el id
+            "created_at": START + timedelta(seconds=i // 4),
+        }
+        for i in range(50)
+    ]
+    with Session(engine) as session:
+        session.execute(insert(MotorMetrics), rows)
+        session.commit()
+    monkeypatch.setattr(metrics_export, "engine", engine)
+    return engine
+
+
+def _csv_rows(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def _export_csv(cursor=None, device_id=None, batch_size=7):
+    batches = iter_batches(None, None, device_id, cursor, batch_size)
+    return _csv_rows("".join(stream_csv(batches, include_cursor=True)))
+
+
+def test_interrupted_csv_export_resumes_without_gaps_or_duplicates():
+    full = _export_csv()
+    assert len(full) == 50
+    assert [int(row["id"]) for row in full] == sorted(int(row["id"]) for row in full)
+
+    # La descarga se corta a mitad de un lote: se reanuda con el cursor de la última fila
+    received = full[:18]
+    resumed = _export_csv(cursor=received[-1]["cursor"])
+    assert [row["id"] for row in received + resumed] == [row["id"] for row in full]
+
+
+def test_ndjson_resume_keeps_the_filters():
+    batches = iter_batches(None, None, "motor-1", None, 5)
+    lines = [json.loads(line) for line in "".join(stream_ndjson(batches, include_cursor=True)).splitlines()]
+    assert {line["device_id"] for line in lines} == {"motor-1"}
+
+    batches = iter_batches(None, None, "motor-1", lines[4]["cursor"], 5)
+    resumed = [json.loads(line) for line in "".join(stream_ndjson(batches, include_cursor=True)).splitlines()]
+    assert [line["id"] for line in resumed] == [line["id"] for line in lines[5:]]
+
+
+def test_export_endpoint_rejects_bad_cursor_before_streaming():
+    from app.routers.metrics.metrics import router
+
+    app = FastAPI()
+    app.include_router(router, prefix="/metrics")
+    app.dependency_overrides[get_current_user] = lambda: {}
+    client = TestClient(app)
+
+    assert client.get("/metrics/export", params={"cursor": "roto"}).status_code == 400
+    response = client.get("/metrics/export", params={"format": "ndjson", "include_cursor": "false"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    first = json.loads(response.text.splitlines()[0])
+    assert "cursor" not in first and first["created_at"] == START.isoformat()
+
+
+def test_parquet_requires_pyarrow(monkeypatch):
+    monkeypatch.setattr(metrics_export, "pyarrow", None)
+    with pytest.raises(HTTPException) as error:
+        check_format("parquet")
+    assert error.value.status_code == 400
+    check_format("csv")
@@ -0,0 +1,80 @@
+import math
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+import app.services.metrics_history as metrics_history
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_history import (
+    build_bucket_query,
+    check_bucket_count,
+    check_bucket_rows,
+    limit_buckets,
+    lttb,
+    parse_bucket,
+)
+
+
+def test_parse_bucket():
+    assert parse_bucket("10s") == 10
+    assert parse_bucket("1m") == 60
+    assert parse_bucket("1h") == 3600
+    assert parse_bucket("2d") == 172800
+
+
+@pytest.mark.parametrize("bucket", ["", "0s", "1w", "m1", "-5m"])
+def test_parse_bucket_rejects_invalid(bucket):
+    with pytest.raises(HTTPException):
+        parse_bucket(bucket)
+
+
+def test_lttb_keeps_endpoints_and_threshold():
+    points = [(float(i), math.sin(i / 10)) for i in range(1000)]
+    sampled = lttb(points, 50)
+    assert len(sampled) == 50
+    assert sampled[0] == points[0]
+    assert sampled[-1] == points[-1]
+    assert [p[0] for p in sampled] == sorted(p[0] for p in sampled)
+
+
+def test_lttb_keeps_spike():
+    points = [(float(i), 0.0) for i in range(500)]
+    points[250] = (250.0, 100.0)
+    assert (250.0, 100.0) in lttb(points, 20)
+
+
+def test_lttb_returns_input_when_below_threshold():
+    points = [(0.0, 1.0), (1.0, 2.0)]
+    assert lttb(points, 10) == points
+
+
+def test_bucket_cap_counts_every_device(monkeypatch):
+    monkeypatch.setattr(metrics_history, "MAX_BUCKETS", 10)
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    start = datetime(2025, 3, 1)
+    end = start + timedelta(hours=4)
+    rows = [
+        {"device_id": f"m{device}", "timestamp": float(minute), "created_at": start + timedelta(minutes=minute)}
+        for device in range(3)
+        for minute in range(0, 240, 30)
+    ]
+
+    with Session(engine) as session:
+        session.execute(insert(MotorMetrics), rows)
+        # 4 intervalos de una hora: pasa el rechazo previo
+        check_bucket_count(start, end, 3600)
+
+        one_device = build_bucket_query("sqlite", 3600, ["rpm"], start, end, "m1")
+        check_bucket_rows(session.execute(limit_buckets(one_device)).all())
+
+        # Sin device_id son 4 intervalos x 3 dispositivos = 12 filas
+        all_devices = session.execute(limit_buckets(build_bucket_query("sqlite", 3600, ["rpm"], start, end))).all()
+        assert len(all_devices) == 11
+        with pytest.raises(HTTPException) as error:
+            check_bucket_rows(all_devices)
+        assert error.value.status_code == 400
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from app.services import metrics_partitions
+from app.services.metrics_partitions import next_period, parse_partition_name, partition_name, period_start
+
+
+def test_daily_periods():
+    start = period_start(datetime(2025, 3, 31, 17, 45), "day")
+    assert start == datetime(2025, 3, 31)
+    assert next_period(start, "day") == datetime(2025, 4, 1)
+    assert partition_name(start, "day") == "motor_metrics_p20250331"
+
+
+def test_monthly_periods():
+    start = period_start(datetime(2024, 12, 15, 8), "month")
+    assert start == datetime(2024, 12, 1)
+    assert next_period(start, "month") == datetime(2025, 1, 1)
+    assert next_period(datetime(2024, 1, 1), "month") == datetime(2024, 2, 1)
+    assert partition_name(start, "month") == "motor_metrics_p202412"
+
+
+def test_parse_partition_name():
+    assert parse_partition_name("motor_metrics_p20250331") == (datetime(2025, 3, 31), datetime(2025, 4, 1))
+    assert parse_partition_name("motor_metrics_p202412") == (datetime(2024, 12, 1), datetime(2025, 1, 1))
+    assert parse_partition_name("motor_metrics_legacy") is None
+    assert parse_partition_name("../motor_metrics_p20250331") is None
+
+
+def test_retention_is_skipped_when_archive_dir_is_not_writable(tmp_path, monkeypatch):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(metrics_partitions, "RETENTION_DAYS", 30)
+    monkeypatch.setattr(metrics_partitions, "ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(metrics_partitions, "ARCHIVE_DIR", str(blocker / "archive"))
+    deleted = []
+    monkeypatch.setattr(metrics_partitions, "_delete_expired_rows", lambda *args: deleted.append(args) or [])
+
+    summary = metrics_partitions.run_maintenance(datetime(2025, 6, 1))
+    assert "retention_skipped" in summary
+    assert summary["expired"] == [] and not deleted
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from app.services.metrics_payload import (
+    MotorPayload,
+    PayloadError,
+    decode_binary,
+    decode_json,
+    encode_binary,
+    peek_binary_device_id,
+    peek_json_device_id,
+)
+
+PAYLOAD = {
+    "device_id": "motor-01",
+    "device_name": "Motor 1",
+    "device_ip": "10.0.0.5",
+    "temperature": 78.5,
+    "rpm": 1500,
+    "oil_pressure": 3.2,
+    "vibration": 0.4,
+    "load_percentage": 65.0,
+    "status": "running",
+    "timestamp": 1700000000.25,
+    "firmware": "1.2.3",
+}
+
+
+def test_decode_json_valid():
+    payload = decode_json(json.dumps(PAYLOAD).encode())
+    assert payload.device_id == "motor-01"
+    assert payload.rpm == 1500.0
+    assert payload.device_subnet == ""
+
+
+@pytest.mark.parametrize("change", [
+    {"temperature": "78.5"},   # cadena en lugar de número
+    {"rpm": None},
+    {"device_id": ""},
+    {"vibration": float("nan")},
+    {"timestamp": 1e13},       # fuera del rango de datetime
+])
+def test_decode_json_rejects_bad_fields(change):
+    with pytest.raises(PayloadError):
+        decode_json(json.dumps({**PAYLOAD, **change}).encode())
+
+
+def test_decode_json_rejects_missing_metric_and_garbage():
+    missing = {k: v for k, v in PAYLOAD.items() if k != "oil_pressure"}
+    with pytest.raises(PayloadError, match="oil_pressure"):
+        decode_json(json.dumps(missing).encode())
+    with pytest.raises(PayloadError):
+        decode_json(b"{not json")
+
+
+def test_binary_round_trip_keeps_metadata_from_defaults():
+    original = MotorPayload.model_validate(PAYLOAD)
+    raw = encode_binary(original)
+    assert len(raw) < len(json.dumps(PAYLOAD))
+
+    decoded = decode_binary(raw, {"device_name": "Motor 1", "device_ip": "10.0.0.5"})
+    assert decoded.device_id == original.device_id
+    assert decoded.timestamp == original.timestamp
+    assert decoded.status == "running"
+    assert decoded.device_ip == "10.0.0.5"
+    # float32 en el formato binario
+    assert decoded.temperature == pytest.approx(original.temperature, rel=1e-6)
+
+
+def test_decode_binary_rejects_malformed():
+    raw = encode_binary(MotorPayload.model_validate(PAYLOAD))
+    with pytest.raises(PayloadError):
+        decode_binary(raw[:10])
+    with pytest.raises(PayloadError):
+        decode_binary(raw + b"x")
+    with pytest.raises(PayloadError):
+        decode_binary(b"\x02" + raw[1:])
+
+
+def test_peek_device_id_without_decoding():
+    assert peek_json_device_id(json.dumps(PAYLOAD).encode()) == "motor-01"
+    assert peek_json_device_id(b'{"rpm": 1}') is None
+    raw = encode_binary(MotorPayload(**PAYLOAD))
+    assert peek_binary_device_id(raw) == "motor-01"
@@ -0,0 +1,105 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.models.motor_metrics import MotorMetrics
+from app.models.motor_metrics_rollup import MotorMetricsRollupState
+from app.services.metrics_rollup import (
+    EPOCH,
+    ROLLUP_STATE_NAME,
+    ROLLUP_TABLES,
+    _extend_watermark,
+    apply_rollups,
+    choose_rollup,
+    rollup_stats,
+)
+from app.services.metrics_stats import METRIC_FIELDS, build_stats_query, row_to_stats
+
+START = datetime(2025, 3, 1)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    rng = random.Random(7)
+    rows = []
+    for i in range(2000):
+        rows.append({
+            "device_id": f"motor-{i % 3}",
+            "temperature": rng.uniform(40, 90),
+            "rpm": rng.uniform(800, 3000),
+            "oil_pressure": rng.uniform(1, 5),
+            "vibration": rng.uniform(0, 2),
+            "load_percentage": rng.uniform(0, 100),
+            "status": rng.choice(["running", "warning", "error"]),
+            "timestamp": float(i),
+            # Una lectura cada ~43 s durante un día, sin alinear a minutos
+            "created_at": START + timedelta(seconds=i * 43.2 + 7),
+        })
+    with Session(engine) as session:
+        session.execute(insert(MotorMetrics), rows)
+        for i in range(0, len(rows), 300):
+            apply_rollups(session, rows[i:i + 300])
+        session.commit()
+        yield session
+
+
+def _raw_stats(session, start, end, device_id=None):
+    statement = build_stats_query("sqlite", METRIC_FIELDS, [], start=start, end=end, device_id=device_id)
+    return row_to_stats(session.exec(statement).one(), METRIC_FIELDS, [])
+
+
+@pytest.mark.parametrize("bucket_seconds, table", ROLLUP_TABLES)
+@pytest.mark.parametrize("start, end, device_id", [
+    (START + timedelta(minutes=7, seconds=13), START + timedelta(hours=20, minutes=3, seconds=5), None),
+    (START + timedelta(hours=1), START + timedelta(hours=9), "motor-1"),
+    # Sin buckets completos: solo bordes
+    (START + timedelta(seconds=10), START + timedelta(seconds=50), None),
+])
+def test_edges_plus_rollup_match_raw_stats(session, bucket_seconds, table, start, end, device_id):
+    merged = rollup_stats(session, bucket_seconds, table, METRIC_FIELDS, [], start, end, device_id)
+    raw = _raw_stats(session, start, end, device_id)
+    assert merged["total_records"] == raw["total_records"]
+    assert merged["status_distribution"] == raw["status_distribution"]
+    for field in METRIC_FIELDS:
+        for stat in ("avg", "min", "max", "stddev"):
+            assert merged[field][stat] == pytest.approx(raw[field][stat], rel=1e-9), (field, stat)
+
+
+def test_rollup_stats_use_the_same_percentile_keys_as_raw_stats(session):
+    bucket_seconds, table = ROLLUP_TABLES[0]
+    percentiles = [0.5, 0.95, 0.999]
+    end = START + timedelta(hours=3)
+    merged = rollup_stats(session, bucket_seconds, table, ["rpm"], percentiles, START, end)
+    statement = build_stats_query("sqlite", ["rpm"], percentiles, start=START, end=end)
+    raw = row_to_stats(session.exec(statement).one(), ["rpm"], percentiles)
+    assert merged["rpm"].keys() == raw["rpm"].keys()
+    assert merged["rpm"]["p99.9"] is None
+
+
+def test_rollups_only_used_once_the_watermark_covers_start():
+    start, end = datetime(2025, 3, 1), datetime(2025, 3, 2)
+    assert choose_rollup(start, end, None) is None
+    assert choose_rollup(start, end, datetime(2025, 3, 1, 6)) is None
+    assert choose_rollup(start, end, EPOCH) == ROLLUP_TABLES[0]
+    # Ventana corta: siempre filas crudas
+    assert choose_rollup(start, start + timedelta(hours=1), EPOCH) is None
+
+
+def test_rebuild_extends_the_watermark(session):
+    session.add(MotorMetricsRollupState(name=ROLLUP_STATE_NAME, complete_from=datetime(2025, 3, 10)))
+    session.commit()
+    state = session.get(MotorMetricsRollupState, ROLLUP_STATE_NAME)
+
+    # Un backfill que no llega a la marca deja un hueco: no la mueve
+    _extend_watermark(session, datetime(2025, 3, 1), datetime(2025, 3, 5))
+    assert state.complete_from == datetime(2025, 3, 10)
+    _extend_watermark(session, datetime(2025, 3, 1), None)
+    assert state.complete_from == datetime(2025, 3, 1)
+    _extend_watermark(session, None, datetime(2025, 3, 1))
+    assert state.complete_from == EPOCH
@@ -0,0 +1,101 @@
+import random
+import statistics
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_stats import (
+    build_stats_query,
+    percentile_key,
+    row_to_stats,
+    validate_fields,
+    validate_percentiles,
+)
+
+START = datetime(2025, 3, 1)
+
+
+@pytest.fixture
+def session_rows():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    rng = random.Random(3)
+    rows = [
+        {
+            "device_id": f"motor-{i % 2}",
+            "temperature": rng.uniform(40, 90),
+            "rpm": rng.uniform(800, 3000),
+            "status": rng.choice(["running", "warning", "error", "unknown"]),
+            "timestamp": float(i),
+            "created_at": START + timedelta(minutes=i),
+        }
+        for i in range(300)
+    ]
+    with Session(engine) as session:
+        session.execute(insert(MotorMetrics), rows)
+        session.commit()
+        yield session, rows
+
+
+def _stats(session, **filters):
+    statement = build_stats_query("sqlite", ["temperature", "rpm"], [0.5, 0.95], **filters)
+    return row_to_stats(session.exec(statement).one(), ["temperature", "rpm"], [0.5, 0.95])
+
+
+def test_stats_match_python_over_a_filtered_window(session_rows):
+    session, rows = session_rows
+    start, end = START + timedelta(minutes=50), START + timedelta(minutes=200)
+    stats = _stats(session, start=start, end=end, device_id="motor-1")
+
+    # Ventana [start, end) y un solo dispositivo
+    expected = [
+        row for row in rows
+        if start <= row["created_at"] < end and row["device_id"] == "motor-1"
+    ]
+    assert stats["total_records"] == len(expected)
+    for field in ("temperature", "rpm"):
+        values = [row[field] for row in expected]
+        assert stats[field]["avg"] == pytest.approx(statistics.fmean(values))
+        assert stats[field]["min"] == pytest.approx(min(values))
+        assert stats[field]["max"] == pytest.approx(max(values))
+        assert stats[field]["stddev"] == pytest.approx(statistics.stdev(values))
+        # Sin percentile_cont fuera de PostgreSQL
+        assert stats[field]["p50"] is None and stats[field]["p95"] is None
+    assert stats["status_distribution"] == {
+        status: sum(row["status"] == status for row in expected)
+        for status in ("running", "warning", "error")
+    }
+
+
+def test_empty_window_has_no_values(session_rows):
+    session, _ = session_rows
+    stats = _stats(session, start=START - timedelta(days=2), end=START - timedelta(days=1))
+    assert stats["total_records"] == 0
+    assert stats["temperature"] == {"avg": None, "min": None, "max": None, "stddev": None, "p50": None, "p95": None}
+
+
+def test_postgresql_query_computes_percentiles_in_one_pass():
+    statement = build_stats_query("postgresql", ["rpm"], [0.5, 0.99], start=START)
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert "stddev_samp(motor_metrics.rpm)" in sql
+    assert sql.count("percentile_cont(") == 2
+    assert "WITHIN GROUP (ORDER BY motor_metrics.rpm)" in sql
+    assert "FILTER (WHERE motor_metrics.status" in sql
+    assert "GROUP BY" not in sql
+
+
+def test_validation_and_percentile_names():
+    assert validate_fields(None)[0] == "temperature"
+    assert validate_fields(["rpm", "rpm", "vibration"]) == ["rpm", "vibration"]
+    with pytest.raises(HTTPException):
+        validate_fields(["rpm", "presion"])
+    assert validate_percentiles(None) == [0.5, 0.95, 0.99]
+    with pytest.raises(HTTPException):
+        validate_percentiles([1.5])
+    assert [percentile_key(p) for p in (0.5, 0.95, 0.999)] == ["p50", "p95", "p99.9"]
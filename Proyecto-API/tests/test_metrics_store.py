@@ -0,0 +1,75 @@
+from app.services.metrics_store import MetricsStore
+
+
+def _payload(device_id, temperature, **extra):
+    return {"device_id": device_id, "temperature": temperature, **extra}
+
+
+def test_latest_per_device():
+    store = MetricsStore(capacity=10, max_devices=10)
+    store.add(_payload("m1", 70.0), received_at=1.0)
+    store.add(_payload("m2", 80.0), received_at=2.0)
+
+    assert store.latest("m1")["temperature"] == 70.0
+    assert store.latest("m2")["temperature"] == 80.0
+    assert store.latest()["device_id"] == "m2"
+    assert store.latest("m3") is None
+    assert set(store.latest_all()) == {"m1", "m2"}
+
+
+def test_ring_buffer_wraps_and_windows():
+    store = MetricsStore(capacity=5, max_devices=10)
+    for i in range(12):
+        store.add(_payload("m1", float(i)), received_at=100.0 + i)
+
+    # Solo quedan las 5 más recientes (7..11)
+    recent = store.recent("m1", seconds=60, fields=["temperature"], now=111.0)
+    assert recent["timestamps"] == [107.0, 108.0, 109.0, 110.0, 111.0]
+    assert recent["series"]["temperature"] == [7.0, 8.0, 9.0, 10.0, 11.0]
+
+    recent = store.recent("m1", seconds=2, fields=["temperature"], now=111.0)
+    assert recent["series"]["temperature"] == [9.0, 10.0, 11.0]
+    assert recent["summary"]["temperature"] == {"count": 3, "avg": 10.0, "min": 9.0, "max": 11.0}
+
+
+def test_missing_values_are_gaps():
+    store = MetricsStore(capacity=5, max_devices=10)
+    store.add({"device_id": "m1", "rpm": 1500}, received_at=1.0)
+
+    recent = store.recent("m1", seconds=10, fields=["temperature", "rpm"], now=2.0)
+    assert recent["series"]["temperature"] == [None]
+    assert recent["summary"]["temperature"]["count"] == 0
+    assert recent["series"]["rpm"] == [1500.0]
+
+
+def test_max_devices_evicts_least_recently_updated():
+    store = MetricsStore(capacity=5, max_devices=2)
+    store.add(_payload("m1", 1.0), received_at=1.0)
+    store.add(_payload("m2", 2.0), received_at=2.0)
+    store.add(_payload("m1", 3.0), received_at=3.0)
+    # m2 es el que lleva más tiempo sin lecturas
+    store.add(_payload("m3", 4.0), received_at=4.0)
+
+    assert store.devices() == ["m1", "m3"]
+    assert store.latest("m2") is None
+    assert store.get_stats()["evicted_devices"] == 1
+    # El buffer reutilizado no conserva muestras del dispositivo descartado
+    recent = store.recent("m3", seconds=60, fields=["temperature"], now=4.0)
+    assert recent["series"]["temperature"] == [4.0]
+
+    # Una ráfaga de device_id nuevos no hace crecer la memoria
+    for i in range(100):
+        store.add(_payload(f"bogus-{i}", 0.0), received_at=5.0)
+    assert store.get_stats()["devices"] == 2
+
+
+def test_repeated_reading_is_not_added_twice():
+    store = MetricsStore(capacity=5, max_devices=10)
+    assert store.add(_payload("m1", 70.0, timestamp=10.0), received_at=1.0)
+    # El mismo mensaje por otro topic (o reentregado por QoS 1)
+    assert not store.add(_payload("m1", 70.0, timestamp=10.0), received_at=1.1)
+    assert store.add(_payload("m1", 71.0, timestamp=11.0), received_at=2.0)
+    assert store.add(_payload("m2", 70.0, timestamp=10.0), received_at=2.0)
+
+    assert store.recent("m1", seconds=60, fields=["temperature"], now=2.0)["count"] == 2
+    assert store.get_stats()["duplicates"] == 1
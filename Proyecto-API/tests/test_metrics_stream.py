@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+
+import app.routers.metrics.metrics as metrics_router
+from app.core.auth import get_async_auth_provider
+from app.core.auth.base import UserInfo
+from app.services.metrics_broadcast import MetricsBroadcaster
+
+
+class FakeProvider:
+    async def decode_token(self, token):
+        # Sin exp: el token nunca caduca y no cierra el socket por sí solo
+        return UserInfo(user_id="kc-1", username="ana", raw_data={})
+
+
+@pytest.fixture
+def broadcaster(monkeypatch):
+    broadcaster = MetricsBroadcaster(buffer_size=10, max_subscribers=1)
+    monkeypatch.setattr(metrics_router, "metrics_broadcaster", broadcaster)
+    monkeypatch.setattr(metrics_router, "STREAM_HEARTBEAT", 0.05)
+    return broadcaster
+
+
+def _app():
+    app = FastAPI()
+    app.include_router(metrics_router.router, prefix="/metrics")
+    app.dependency_overrides[get_async_auth_provider] = lambda: FakeProvider()
+    return app
+
+
+async def _idle_client_leaves(app, broadcaster):
+    # Conversación ASGI a mano: el servidor no cancela la app al desconectar
+    incoming, sent = asyncio.Queue(), []
+    scope = {
+        "type": "websocket", "path": "/metrics/stream/ws", "raw_path": b"/metrics/stream/ws",
+        "query_string": b"token=t&device_id=motor-1", "headers": [], "subprotocols": [],
+    }
+
+    async def send(message):
+        sent.append(message)
+
+    await incoming.put({"type": "websocket.connect"})
+    session = asyncio.create_task(app(scope, incoming.get, send))
+    while not sent:
+        await asyncio.sleep(0.01)
+    assert sent[0]["type"] == "websocket.accept"
+    assert broadcaster.get_stats()["subscribers"] == 1
+
+    # Varios heartbeats sin mensajes y el cliente se va
+    await asyncio.sleep(0.2)
+    await incoming.put({"type": "websocket.disconnect", "code": 1001})
+    await asyncio.wait_for(session, timeout=2)
+
+
+def test_ws_client_leaving_while_idle_releases_its_subscription(broadcaster):
+    asyncio.run(_idle_client_leaves(_app(), broadcaster))
+    assert broadcaster.get_stats()["subscribers"] == 0
+    # El hueco queda libre para otro cliente (max_subscribers=1)
+    asyncio.run(_idle_client_leaves(_app(), broadcaster))
+    assert broadcaster.get_stats()["subscribers"] == 0
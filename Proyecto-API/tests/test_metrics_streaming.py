@@ -0,0 +1,116 @@
+import random
+import statistics
+
+import pytest
+
+from app.services.metrics_streaming import P2Quantile, RunningStats, StreamingStatsEngine
+
+
+def _engine(tmp_path=None, **kwargs):
+    defaults = dict(
+        tumbling_seconds=60, sliding_seconds=300, panes=5, ewma_alpha=0.5,
+        zscore=4, zscore_min_samples=30, thresholds={},
+        snapshot_path=str(tmp_path / "stats.json") if tmp_path else None,
+    )
+    defaults.update(kwargs)
+    return StreamingStatsEngine(**defaults)
+
+
+def test_running_stats_matches_statistics_and_merges():
+    rng = random.Random(1)
+    values = [rng.gauss(80, 5) for _ in range(1000)]
+
+    stats = RunningStats()
+    for v in values:
+        stats.update(v)
+    assert stats.mean == pytest.approx(statistics.mean(values))
+    assert stats.stddev == pytest.approx(statistics.stdev(values))
+
+    left, right = RunningStats(), RunningStats()
+    for v in values[:300]:
+        left.update(v)
+    for v in values[300:]:
+        right.update(v)
+    left.merge(right)
+    assert left.count == 1000
+    assert left.mean == pytest.approx(stats.mean)
+    assert left.stddev == pytest.approx(stats.stddev)
+    assert (left.min, left.max) == (min(values), max(values))
+
+
+@pytest.mark.parametrize("p", [0.5, 0.95, 0.99])
+def test_p2_quantile_approximates_exact(p):
+    rng = random.Random(2)
+    values = [rng.uniform(0, 100) for _ in range(20000)]
+    estimator = P2Quantile(p)
+    for v in values:
+        estimator.update(v)
+    exact = statistics.quantiles(values, n=1000)[int(p * 1000) - 1]
+    assert estimator.value() == pytest.approx(exact, abs=1.5)
+
+
+def test_windows_tumble_and_slide():
+    engine = _engine()
+    for t in range(600):
+        engine.update({"device_id": "m1", "temperature": float(t)}, now=1000.0 + t)
+
+    stats = engine.get_stats("m1", ["temperature"], now=1599.0)["temperature"]
+    assert stats["last"] == 599.0
+    assert stats["total"]["count"] == 600
+    # Ventana fija actual: [1560, 1620)
+    assert stats["tumbling"]["count"] == 40
+    assert stats["previous_tumbling"]["count"] == 60
+    # Ventana deslizante de 300 s con paneles de 60 s
+    assert 300 <= stats["sliding"]["count"] <= 360
+    assert stats["sliding"]["max"] == 599.0
+
+    # Sin datos nuevos, la ventana deslizante se vacía
+    later = engine.get_stats("m1", ["temperature"], now=2500.0)["temperature"]
+    assert later["sliding"]["count"] == 0
+    assert later["tumbling"] is None
+
+
+def test_zscore_and_threshold_anomalies():
+    engine = _engine(thresholds={"oil_pressure": (1.5, None)})
+    rng = random.Random(3)
+    for t in range(100):
+        found = engine.update({"device_id": "m1", "temperature": rng.gauss(80, 1)}, now=float(t))
+        assert found == []
+
+    found = engine.update({"device_id": "m1", "temperature": 120.0, "oil_pressure": 1.0}, now=100.0)
+    assert {a["field"] for a in found} == {"temperature", "oil_pressure"}
+    assert engine.recent_anomalies("m1")[0]["device_id"] == "m1"
+
+
+def test_snapshot_round_trip(tmp_path):
+    engine = _engine(tmp_path)
+    for t in range(200):
+        engine.update({"device_id": "m1", "rpm": 1500.0 + t % 7}, now=1000.0 + t)
+    engine.save_snapshot()
+
+    restored = _engine(tmp_path)
+    restored.load_snapshot()
+    now = 1199.0
+    assert restored.get_stats("m1", now=now) == engine.get_stats("m1", now=now)
+
+    # El estado restaurado sigue actualizándose igual que el original
+    engine.update({"device_id": "m1", "rpm": 1600.0}, now=1200.0)
+    restored.update({"device_id": "m1", "rpm": 1600.0}, now=1200.0)
+    assert restored.get_stats("m1", now=1200.0) == engine.get_stats("m1", now=1200.0)
+
+
+def test_snapshots_are_disabled_when_the_directory_is_not_writable(tmp_path):
+    # Un fichero donde debería estar el directorio: no se puede crear
+    (tmp_path / "readonly").write_text("")
+    engine = _engine(snapshot_path=str(tmp_path / "readonly" / "stats.json"))
+    engine.start()
+    assert engine.snapshot_path == ""
+    assert engine._thread is None
+    engine.update({"device_id": "m1", "rpm": 1500.0}, now=1000.0)
+    engine.stop()
+
+    writable = _engine(tmp_path)
+    writable.start()
+    writable.update({"device_id": "m1", "rpm": 1500.0}, now=1000.0)
+    writable.stop()
+    assert (tmp_path / "stats.json").exists()
@@ -0,0 +1,148 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+import app.models.indexes  # noqa: F401 (índice único de la ingesta idempotente)
+import app.services.metrics_writer as metrics_writer
+import app.services.mqtt_service as mqtt_service
+from app.models.motor_metrics import MotorMetrics
+from app.services.metrics_payload import MotorPayload
+from app.services.metrics_writer import MetricsBatchWriter
+from app.services.mqtt_service import MQTTService
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(metrics_writer, "engine", engine)
+    return engine
+
+
+def _row(device_id, timestamp):
+    return {
+        "device_id": device_id, "device_name": "Motor", "temperature": 70.0, "rpm": 1500.0,
+        "oil_pressure": 3.0, "vibration": 0.5, "load_percentage": 50.0,
+        "status": "running", "timestamp": float(timestamp),
+    }
+
+
+def _count(engine):
+    with Session(engine) as session:
+        return session.execute(select(func.count()).select_from(MotorMetrics)).scalar()
+
+
+def test_duplicates_are_ignored_and_listeners_get_new_rows(engine):
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=0)
+    received = []
+    writer.add_listener(received.extend)
+
+    writer.flush([_row("m1", 1), _row("m1", 2), _row("m1", 1)])
+    writer.flush([_row("m1", 2), _row("m2", 2)])
+
+    assert _count(engine) == 3
+    assert [(r["device_id"], r["timestamp"]) for r in received] == [("m1", 1.0), ("m1", 2.0), ("m2", 2.0)]
+    stats = writer.get_stats()
+    assert stats["rows_written"] == 3
+    assert stats["rows_duplicated"] == 2
+    assert stats["rows_failed"] == 0
+
+
+def test_invalid_rows_are_isolated_by_splitting_the_batch(engine):
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=0)
+    batch = [_row(f"m{i}", i) for i in range(8)]
+    # device_id es NOT NULL: la DB rechaza el lote entero
+    batch[5]["device_id"] = None
+
+    writer.flush(batch)
+
+    assert _count(engine) == 7
+    stats = writer.get_stats()
+    assert stats["rows_written"] == 7
+    assert stats["rows_failed"] == 1
+    assert stats["batches_split"] >= 1
+
+
+def test_transient_errors_are_retried(engine, monkeypatch):
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=3, retry_backoff=0.001)
+    insert = writer._insert
+    failures = iter([True, True])
+
+    def flaky_insert(batch):
+        if next(failures, False):
+            raise OperationalError("INSERT", {}, Exception("server closed the connection"))
+        return insert(batch)
+
+    monkeypatch.setattr(writer, "_insert", flaky_insert)
+    writer.flush([_row("m1", 1), _row("m1", 2)])
+
+    assert _count(engine) == 2
+    stats = writer.get_stats()
+    assert stats["retries"] == 2
+    assert stats["rows_written"] == 2
+
+
+def test_batch_fails_after_exhausting_retries(engine, monkeypatch):
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=2, retry_backoff=0.001)
+    calls = []
+
+    def broken_insert(batch):
+        calls.append(len(batch))
+        raise OperationalError("INSERT", {}, Exception("database is down"))
+
+    monkeypatch.setattr(writer, "_insert", broken_insert)
+    writer.flush([_row("m1", 1), _row("m1", 2)])
+
+    # Un error transitorio no parte el lote: se reintenta entero
+    assert calls == [2, 2, 2]
+    assert writer.get_stats()["rows_failed"] == 2
+
+
+def test_transaction_hook_failure_keeps_the_batch_out(engine):
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=0)
+
+    def hook(session, rows):
+        raise RuntimeError("rollup no disponible")
+
+    writer.add_transaction_hook(hook)
+    writer.flush([_row("m1", 1)])
+
+    assert _count(engine) == 0
+    assert writer.get_stats()["rows_failed"] == 1
+
+
+def test_writer_thread_flushes_pending_rows_on_stop(engine):
+    writer = MetricsBatchWriter(flush_size=3, flush_interval=0.05, retries=0)
+    writer.start()
+    for i in range(10):
+        assert writer.submit(_row("m1", i))
+    writer.stop()
+
+    assert _count(engine) == 10
+    assert writer.get_stats()["queue_depth"] == 0
+
+
+def test_redelivery_from_a_skewed_clock_hits_the_same_row(engine, monkeypatch):
+    # Con particionado el índice único incluye created_at, como en PostgreSQL
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ux_motor_metrics_device_timestamp"))
+        connection.execute(text(
+            "CREATE UNIQUE INDEX ux_motor_metrics_device_timestamp "
+            "ON motor_metrics (device_id, timestamp, created_at)"
+        ))
+    payload = MotorPayload.model_validate({**_row("m1", 0), "timestamp": 1_000_000_000.0})
+    writer = MetricsBatchWriter(flush_size=10, flush_interval=0.1, retries=0)
+
+    # Reloj del dispositivo años atrasado; la reentrega QoS 1 llega minutos después
+    for received_at in (1_700_000_000.0, 1_700_000_300.0):
+        monkeypatch.setattr(mqtt_service.time, "time", lambda: received_at)
+        writer.flush([MQTTService._payload_to_row(payload)])
+
+    assert _count(engine) == 1
+    with Session(engine) as session:
+        assert session.execute(select(MotorMetrics.created_at)).scalar() == datetime.utcfromtimestamp(1_000_000_000)
+    assert writer.get_stats()["rows_duplicated"] == 1
@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+
+import pytest
+
+from app.services.mqtt_dispatcher import MessageDispatcher
+
+
+def test_workers_process_all_messages():
+    seen = []
+    lock = threading.Lock()
+
+    def handler(topic, payload, source):
+        if payload == b"boom":
+            raise ValueError("payload no válido")
+        with lock:
+            seen.append((topic, payload, source))
+
+    dispatcher = MessageDispatcher(handler, workers=3, queue_size=100, policy="block")
+    dispatcher.start()
+    for i in range(50):
+        dispatcher.submit("motor/metrics/all", str(i).encode())
+    dispatcher.submit("motor/metrics/all", b"boom")
+    dispatcher.stop()
+
+    assert len(seen) == 50
+    stats = dispatcher.get_stats()
+    assert stats["processed"] == 50
+    assert stats["failed"] == 1
+    assert stats["processing"]["avg_ms"] is not None
+
+
+def test_messages_of_a_device_are_processed_in_order():
+    seen = {}
+    lock = threading.Lock()
+
+    def handler(topic, payload, source):
+        device_id, sequence = payload.decode().split(":")
+        # Tiempos de proceso variables: sin reparto por dispositivo se desordenarían
+        time.sleep(random.random() / 1000)
+        with lock:
+            seen.setdefault(device_id, []).append(int(sequence))
+
+    dispatcher = MessageDispatcher(
+        handler, workers=4, queue_size=1000, policy="block",
+        routing_key=lambda topic, payload: payload.split(b":")[0].decode(),
+    )
+    dispatcher.start()
+    for sequence in range(50):
+        for device in range(8):
+            dispatcher.submit("motor/metrics/all", f"m{device}:{sequence}".encode())
+    dispatcher.stop()
+
+    assert len(seen) == 8
+    assert all(sequences == list(range(50)) for sequences in seen.values())
+    assert len(dispatcher.get_stats()["worker_queue_depths"]) == 4
+
+
+def test_routing_falls_back_to_topic():
+    def broken_key(topic, payload):
+        raise ValueError("payload ilegible")
+
+    dispatcher = MessageDispatcher(lambda t, p, s: None, workers=4, queue_size=100, routing_key=broken_key)
+    assert dispatcher._queue_for("motor/metrics/device/m1", b"x") is dispatcher._queue_for("motor/metrics/device/m1", b"y")
+
+
+def test_drop_oldest_keeps_newest():
+    seen = []
+    dispatcher = MessageDispatcher(lambda t, p, s: seen.append(p), workers=1, queue_size=3, policy="drop-oldest")
+    # Sin workers arrancados la cola se llena
+    for i in range(5):
+        dispatcher.submit("t", bytes([i]))
+    assert dispatcher.get_stats()["dropped"] == 2
+
+    dispatcher.start()
+    dispatcher.stop()
+    assert seen == [bytes([2]), bytes([3]), bytes([4])]
+
+
+def test_spill_to_disk_and_replay(tmp_path):
+    seen = []
+    dispatcher = MessageDispatcher(
+        lambda t, p, s: seen.append((t, p, s)), workers=1, queue_size=2,
+        policy="spill", spill_path=str(tmp_path / "spill.bin"),
+    )
+    for i in range(5):
+        dispatcher.submit(f"motor/metrics/device/m{i}", bytes([i]), "live" if i % 2 else "ingest")
+    assert dispatcher.get_stats()["spilled"] == 3
+
+    dispatcher.start()
+    dispatcher._replay_spill()
+    dispatcher.stop()
+
+    assert sorted(seen) == sorted(
+        (f"motor/metrics/device/m{i}", bytes([i]), "live" if i % 2 else "ingest") for i in range(5)
+    )
+    assert dispatcher.get_stats()["replayed"] == 3
+    assert not (tmp_path / "spill.bin").exists()
+
+
+def test_new_messages_wait_behind_the_spill(tmp_path):
+    seen = []
+    dispatcher = MessageDispatcher(
+        lambda t, p, s: seen.append(p), workers=1, queue_size=2,
+        policy="spill", spill_path=str(tmp_path / "spill.bin"),
+    )
+    for i in range(3):
+        dispatcher.submit("t", bytes([i]))
+    # La cola vuelve a tener hueco, pero hay mensajes anteriores en disco
+    dispatcher.queues[0].get_nowait()
+    dispatcher.queues[0].task_done()
+    dispatcher.submit("t", bytes([3]))
+    assert dispatcher.get_stats()["spilled"] == 2
+
+    dispatcher.start()
+    dispatcher._replay_spill()
+    dispatcher.stop()
+    assert seen == [bytes([1]), bytes([2]), bytes([3])]
+
+
+def test_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        MessageDispatcher(lambda t, p, s: None, policy="ignore")
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+
+from app.core.pagination import apply_keyset, decode_cursor, encode_cursor, next_cursor
+from app.models.motor_metrics import MotorMetrics
+
+START = datetime(2025, 3, 1)
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Row(Base):
+    """Tabla con created_at opcional, como la de usuarios anteriores a la columna"""
+    __tablename__ = "pagination_rows"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    created_at: Mapped[Optional[datetime]]
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(1, 15):
+            # Empates en created_at y filas sin fecha intercaladas por id
+            created_at = None if i % 4 == 0 else START + timedelta(minutes=i // 3)
+            session.add(Row(id=i, created_at=created_at))
+        session.commit()
+        yield session
+
+
+def _expected(session, descending):
+    rows = session.scalars(select(Row)).all()
+    dated = sorted((r for r in rows if r.created_at is not None), key=lambda r: (r.created_at, r.id))
+    undated = sorted((r for r in rows if r.created_at is None), key=lambda r: r.id)
+    order = dated + undated
+    return [r.id for r in (order[::-1] if descending else order)]
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_pages_cover_every_row_once_including_null_created_at(session, descending):
+    seen, cursor = [], None
+    while True:
+        statement = apply_keyset(select(Row), Row, cursor, descending=descending).limit(3)
+        rows = session.scalars(statement).all()
+        seen.extend(row.id for row in rows)
+        cursor = next_cursor(rows, 3)
+        if cursor is None:
+            break
+
+    assert seen == _expected(session, descending)
+
+
+def test_cursor_round_trip_and_invalid_cursors():
+    assert decode_cursor(encode_cursor(START, 7)) == (START, 7)
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+    for cursor in ("no-es-un-cursor", encode_cursor(START, 1)[:-3] + "!!!"):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
+
+
+def test_not_null_created_at_keeps_a_plain_range_condition():
+    statement = apply_keyset(select(MotorMetrics.id), MotorMetrics, encode_cursor(START, 5))
+    sql = str(statement.compile())
+    # Sin OR ... IS NULL la condición sigue siendo un rango sobre el índice
+    assert "IS NULL" not in sql and "NULLS" not in sql
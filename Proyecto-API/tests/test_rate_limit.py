@@ -0,0 +1,101 @@
+import pytest
+from fastapi import APIRouter, Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.rate_limit import (
+    MemoryRateLimitBackend,
+    RateLimitBackend,
+    RateLimiter,
+    RateLimitMiddleware,
+    client_key,
+    enforce_rate_limit,
+    parse_rules,
+    rate_limiter,
+)
+
+
+def test_rules_are_matched_by_longest_prefix():
+    rules = parse_rules("*:100/60, /auth:20/60, /auth/login:5/60")
+    limiter = RateLimiter(rules, MemoryRateLimitBackend())
+    assert limiter.match("/auth/login/json").prefix == "/auth/login"
+    assert limiter.match("/auth/register").prefix == "/auth"
+    assert limiter.match("/auth-admin").prefix == "*"
+    with pytest.raises(ValueError):
+        parse_rules("/auth/login:cinco/60")
+
+
+def test_bucket_refills_and_full_buckets_expire_lazily():
+    backend = MemoryRateLimitBackend(shards=1)
+    assert [backend.take_nowait("a", rate=1.0, burst=2, now=0.0)[0] for _ in range(3)] == [True, True, False]
+    allowed, retry_after = backend.take_nowait("a", rate=1.0, burst=2, now=0.5)
+    assert not allowed and retry_after == pytest.approx(0.5)
+    assert backend.take_nowait("a", rate=1.0, burst=2, now=1.0)[0]
+
+    # "a" vuelve a estar lleno en t=3: el siguiente acceso a otra clave lo borra
+    backend.take_nowait("b", rate=1.0, burst=2, now=10.0)
+    assert backend.get_stats()["keys"] == 1
+
+
+def test_backend_must_implement_take():
+    with pytest.raises(TypeError):
+        RateLimitBackend()
+
+
+def test_memory_is_bounded_per_shard():
+    backend = MemoryRateLimitBackend(shards=2, max_keys=4)
+    for i in range(50):
+        backend.take_nowait(f"ip:{i}", rate=0.001, burst=1, now=0.0)
+    assert backend.get_stats()["keys"] <= 4
+
+
+def test_client_key_prefers_verified_subject_then_ip():
+    scope = {"client": ("10.0.0.1", 1234), "headers": [(b"authorization", b"Bearer abc")]}
+    assert client_key(scope, lambda token: "user-1" if token == "abc" else None) == "sub:user-1"
+    assert client_key(scope, lambda token: None) == "ip:10.0.0.1"
+
+    forwarded = {"client": ("10.0.0.1", 1), "headers": [(b"x-forwarded-for", b"1.2.3.4, 5.6.7.8")]}
+    assert client_key(forwarded, None, trust_proxy=False) == "ip:10.0.0.1"
+    assert client_key(forwarded, None, trust_proxy=True) == "ip:5.6.7.8"
+
+
+def test_middleware_returns_429_with_retry_after():
+    app = FastAPI()
+
+    @app.post("/auth/login")
+    def login():
+        return {"ok": True}
+
+    @app.get("/metrics")
+    def metrics():
+        return {"ok": True}
+
+    limiter = RateLimiter(parse_rules("/auth/login:2/60,*:100/60"), MemoryRateLimitBackend())
+    app.add_middleware(RateLimitMiddleware, limiter=limiter, subject_lookup=None)
+    client = TestClient(app)
+
+    assert [client.post("/auth/login").status_code for _ in range(3)] == [200, 200, 429]
+    response = client.post("/auth/login")
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 30
+    # El presupuesto es por ruta
+    assert client.get("/metrics").status_code == 200
+
+
+def test_dependency_applies_the_limit_without_middleware():
+    router = APIRouter(dependencies=[Depends(enforce_rate_limit)])
+
+    @router.post("/register")
+    def register():
+        return {"ok": True}
+
+    app = FastAPI()
+    app.include_router(router, prefix="/auth")
+    client = TestClient(app)
+
+    backend = rate_limiter.backend
+    rate_limiter.backend = MemoryRateLimitBackend()
+    try:
+        statuses = [client.post("/auth/register").status_code for _ in range(10)]
+    finally:
+        rate_limiter.backend = backend
+    assert statuses.count(200) == 5 and statuses[-1] == 429
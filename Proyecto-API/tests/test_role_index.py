@@ -0,0 +1,141 @@
+import threading
+
+from app.core.auth.providers.keycloak import KeycloakProvider
+from app.core.auth.role_index import RoleIndex
+
+
+class FakeFetcher:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        response = self.responses[min(self.calls, len(self.responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_roles_for_a_page_use_one_fetch():
+    fetch = FakeFetcher([{"u1": ["Administrador"], "u2": ["Visor", "Moderador"]}])
+    index = RoleIndex(fetch, ttl=60)
+    assert index.get_roles(["u1", "u2", "u3"]) == {
+        "u1": ["Administrador"], "u2": ["Moderador", "Visor"], "u3": []
+    }
+    index.get_roles(["u1"])
+    assert fetch.calls == 1
+
+
+def test_updates_in_place_and_survive_a_concurrent_refresh():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_fetch():
+        started.set()
+        release.wait(5)
+        return {"u1": ["Visor"], "u2": ["Visor"]}
+
+    index = RoleIndex(slow_fetch, ttl=60)
+    worker = threading.Thread(target=index.refresh)
+    worker.start()
+    started.wait(5)
+    # Cambios hechos mientras la respuesta del proveedor va en vuelo
+    index.add("u1", "Administrador")
+    index.remove("u2", "Visor")
+    release.set()
+    worker.join(5)
+
+    assert index.get_roles(["u1", "u2"]) == {"u1": ["Administrador", "Visor"], "u2": []}
+    index.discard_user("u1")
+    assert index.get_roles(["u1"]) == {"u1": []}
+
+
+def test_failed_refresh_keeps_previous_index():
+    fetch = FakeFetcher([{"u1": ["Visor"]}, ConnectionError("keycloak caído")])
+    index = RoleIndex(fetch, ttl=60, retry_interval=60)
+    assert index.get_roles(["u1"])["u1"] == ["Visor"]
+    index.invalidate()
+    assert index.get_roles(["u1"])["u1"] == ["Visor"]
+    # Sin reintentos hasta retry_interval
+    index.get_roles(["u1"])
+    assert fetch.calls == 2
+    assert index.get_stats()["refresh_errors"] == 1
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+def test_keycloak_assign_role_updates_index(monkeypatch):
+    provider = KeycloakProvider("http://kc", "realm", "client", "secret")
+    calls = []
+
+    def admin_request(method, path, **kwargs):
+        calls.append((method, path))
+        if path == "/roles":
+            return FakeResponse(200, [{"name": "Visor"}, {"name": "offline_access"}, {"name": "default-roles-realm"}])
+        if path == "/roles/Visor/users":
+            return FakeResponse(200, [{"id": "u1"}, {"id": "u2"}])
+        if path == "/roles/Visor/groups":
+            return FakeResponse(200, [])
+        if path == "/roles/Administrador":
+            return FakeResponse(200, {"id": "r-admin", "name": "Administrador", "composite": False})
+        if path == "/users/u1/role-mappings/realm":
+            assert kwargs["json"] == [{"id": "r-admin", "name": "Administrador"}]
+            return FakeResponse(204)
+        raise AssertionError(path)
+
+    monkeypatch.setattr(provider, "_admin_request", admin_request)
+
+    assert provider.get_users_roles(["u1", "u2"]) == {"u1": ["Visor"], "u2": ["Visor"]}
+    assert provider.assign_role("u1", "Administrador") is True
+    assert provider.get_users_roles(["u1"]) == {"u1": ["Administrador", "Visor"]}
+    assert [path for _, path in calls].count("/roles/Visor/users") == 1
+    assert provider.remove_role("u1", "Administrador") is True
+    assert provider.get_users_roles(["u1"]) == {"u1": ["Visor"]}
+    # Retirar un rol reconstruye el índice (puede seguir llegando por un grupo)
+    assert [path for _, path in calls].count("/roles/Visor/users") == 2
+    # La representación del rol se pide una vez
+    assert [path for _, path in calls].count("/roles/Administrador") == 1
+
+
+def test_keycloak_index_expands_groups_subgroups_and_composites(monkeypatch):
+    provider = KeycloakProvider("http://kc", "realm", "client", "secret")
+    responses = {
+        "/roles": [
+            {"name": "Visor", "composite": False},
+            {"name": "Administrador", "composite": True},
+            {"name": "default-roles-realm", "composite": True},
+            {"name": "offline_access", "composite": False},
+        ],
+        "/roles/Administrador/composites/realm": [{"name": "Visor"}],
+        "/roles/default-roles-realm/composites/realm": [{"name": "offline_access"}],
+        "/roles/Visor/users": [{"id": "u1"}],
+        "/roles/Visor/groups": [{"id": "g-ops"}],
+        "/roles/Administrador/users": [{"id": "u2"}],
+        "/roles/Administrador/groups": [],
+        "/groups/g-ops/members": [{"id": "u3"}],
+        "/groups/g-ops/children": [{"id": "g-night"}],
+        "/groups/g-night/members": [{"id": "u4"}],
+        "/groups/g-night/children": [],
+    }
+    monkeypatch.setattr(provider, "_admin_request", lambda method, path, **kwargs: FakeResponse(200, responses[path]))
+
+    assert provider.get_users_roles(["u1", "u2", "u3", "u4", "u5"]) == {
+        "u1": ["Visor"],
+        # Visor concedido por el rol compuesto Administrador
+        "u2": ["Administrador", "Visor"],
+        # Miembros del grupo y de su subgrupo
+        "u3": ["Visor"],
+        "u4": ["Visor"],
+        "u5": [],
+    }
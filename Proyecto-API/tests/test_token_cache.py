@@ -0,0 +1,70 @@
+import time
+
+from app.core.auth.base import UserInfo
+from app.core.auth.token_cache import TokenCache
+
+
+def _user(user_id="u1"):
+    return UserInfo(user_id=user_id, username=user_id)
+
+
+def test_hit_until_exp_minus_skew():
+    cache = TokenCache(skew=30)
+    cache.put("tok", _user(), time.time() + 300)
+    assert cache.get("tok").user_id == "u1"
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_token_inside_skew_is_not_cached():
+    cache = TokenCache(skew=30)
+    cache.put("tok", _user(), time.time() + 10)
+    assert cache.get("tok") is None
+
+
+def test_lru_eviction():
+    cache = TokenCache(max_size=2, skew=0)
+    exp = time.time() + 300
+    cache.put("a", _user("a"), exp)
+    cache.put("b", _user("b"), exp)
+    cache.get("a")
+    cache.put("c", _user("c"), exp)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_invalidate_user():
+    cache = TokenCache(skew=0)
+    exp = time.time() + 300
+    cache.put("t1", _user("u1"), exp)
+    cache.put("t2", _user("u1"), exp)
+    cache.put("t3", _user("u2"), exp)
+    assert cache.invalidate_user("u1") == 2
+    assert cache.get("t1") is None and cache.get("t2") is None
+    assert cache.get("t3") is not None
+
+
+def test_revoked_user_rejects_tokens_issued_before():
+    cache = TokenCache(skew=0)
+    now = time.time()
+    cache.put("old", _user("u1"), now + 300, iat=now - 60)
+    assert cache.revoke_user("u1", at=now) == 1
+
+    # El mismo JWT sigue siendo válido: al re-verificarlo no vuelve a la caché
+    assert cache.get("old") is None
+    assert cache.is_revoked("u1", now - 60)
+    cache.put("old", _user("u1"), now + 300, iat=now - 60)
+    assert cache.get("old") is None
+
+    # Un token emitido después de la revocación sí vale
+    assert not cache.is_revoked("u1", now + 1)
+    cache.put("new", _user("u1"), now + 300, iat=now + 1)
+    assert cache.get("new") is not None
+    assert not cache.is_revoked("u2", now - 60)
+
+
+def test_revocations_expire_after_ttl():
+    cache = TokenCache(skew=0, revocation_ttl=60)
+    cache.revoke_user("u1", at=time.time() - 120)
+    assert not cache.is_revoked("u1", None)
+    assert cache.get_stats()["revoked_users"] == 0
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import app.services.user_cache as user_cache
+from app.core.auth.base import UserInfo
+from app.models.user import User
+from app.services.user_cache import (
+    LocalUserCache,
+    insert_local_users,
+    load_local_user,
+    upsert_local_user,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    cache = LocalUserCache(ttl=60, max_size=100)
+    monkeypatch.setattr(user_cache, "local_user_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def _info(user_id, username="ana"):
+    return UserInfo(user_id=user_id, username=username, email=f"{username}@example.com")
+
+
+def _count(session):
+    return session.exec(select(func.count()).select_from(User)).one()
+
+
+def test_upsert_creates_once_and_returns_the_existing_row(engine, cache):
+    with Session(engine) as session:
+        first = upsert_local_user(session, _info("kc-1"))
+        # Mismo keycloak_id con otros datos: se devuelve la fila existente
+        second = upsert_local_user(session, _info("kc-1", username="otro"))
+        assert second.id == first.id
+        assert second.username == "ana"
+        assert _count(session) == 1
+    assert cache.get("kc-1") == first
+
+
+def test_upsert_without_on_conflict_rereads_the_winner(engine, monkeypatch):
+    with Session(engine) as session:
+        existing = upsert_local_user(session, _info("kc-1"))
+    # Motor sin ON CONFLICT: el INSERT choca con el índice único y se relee
+    monkeypatch.setattr(user_cache, "_upsert_statement", lambda dialect_name, values: None)
+    with Session(engine) as session:
+        assert upsert_local_user(session, _info("kc-1")).id == existing.id
+        assert upsert_local_user(session, _info("kc-2", "luis")).username == "luis"
+        assert _count(session) == 2
+
+
+def test_concurrent_first_requests_create_a_single_row(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'users.db'}", connect_args={"timeout": 30})
+    SQLModel.metadata.create_all(engine)
+    barrier = threading.Barrier(8)
+    ids, errors = [], []
+
+    def first_request():
+        try:
+            barrier.wait(5)
+            with Session(engine) as session:
+                ids.append(upsert_local_user(session, _info("kc-1")).id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert errors == []
+    assert len(ids) == 8 and len(set(ids)) == 1
+    with Session(engine) as session:
+        assert _count(session) == 1
+
+
+def test_load_reads_existing_user_and_bulk_insert_skips_known_ones(engine, cache):
+    with Session(engine) as session:
+        created = upsert_local_user(session, _info("kc-1"))
+        cache.invalidate("kc-1")
+        assert load_local_user(session, _info("kc-1")) == created
+        assert cache.get("kc-1") == created
+
+        assert insert_local_users(session, [_info("kc-1"), _info("kc-2", "luis"), _info("kc-3", "eva")]) == 2
+        assert _count(session) == 3
+
+
+def test_cache_expires_and_is_bounded():
+    cache = LocalUserCache(ttl=0, max_size=2)
+    user = user_cache.LocalUser(id=1, keycloak_id="kc-1", username="ana")
+    cache.put(user)
+    assert cache.get("kc-1") is None
+
+    cache = LocalUserCache(ttl=60, max_size=2)
+    for i in range(3):
+        cache.put(user_cache.LocalUser(id=i, keycloak_id=f"kc-{i}", username=f"u{i}"))
+    assert cache.get("kc-0") is None
+    assert cache.get("kc-2").id == 2
+    assert cache.get_stats()["size"] == 2
@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.auth.base import UserInfo
+from app.services import user_import
+from app.services.user_import import import_users, parse_rows
+
+
+class FakeProvider:
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.roles = []
+
+    async def create_user(self, username, email, password, first_name="", last_name=""):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if username == "taken":
+                raise HTTPException(status_code=409, detail="El usuario o email ya existe")
+            return UserInfo(user_id=f"kc-{username}", username=username, email=email)
+        finally:
+            self.in_flight -= 1
+
+    async def assign_role(self, user_id, role):
+        if role == "Inexistente":
+            raise HTTPException(status_code=404, detail="El rol no existe")
+        self.roles.append((user_id, role))
+        return True
+
+
+def _run(provider, rows, monkeypatch, **kwargs):
+    batches = []
+    monkeypatch.setattr(user_import, "_insert_batch", lambda users: batches.append(users) or len(users))
+
+    async def collect():
+        return [json.loads(line) async for line in import_users(provider, rows, **kwargs)]
+
+    return asyncio.run(collect()), batches
+
+
+def test_import_reports_each_row_and_batches_local_inserts(monkeypatch):
+    rows = parse_rows(
+        b"username,email,password,roles\n"
+        b"op1,op1@plant.io,secret,Visor\n"
+        b"taken,t@plant.io,secret,\n"
+        b"op3,,secret,\n"
+        b"op4,op4@plant.io,secret,Visor;Inexistente\n"
+        b"op5,op5@plant.io,secret,\n",
+        "csv"
+    )
+    provider = FakeProvider()
+    lines, batches = _run(provider, rows, monkeypatch, concurrency=2, db_batch_size=2)
+
+    by_user = {line["username"]: line for line in lines if line["type"] == "row"}
+    assert by_user["op1"]["status"] == "created"
+    assert by_user["taken"]["status"] == "exists"
+    assert by_user["op3"]["status"] == "invalid"
+    assert by_user["op4"]["roles"] == ["Visor"]
+    assert "Inexistente" in by_user["op4"]["error"]
+    assert ("kc-op1", "Visor") in provider.roles
+
+    assert [len(batch) for batch in batches] == [2, 1]
+    summary = lines[-1]
+    assert summary == {
+        "type": "summary", "total": 5, "local_inserted": 3,
+        "created": 3, "exists": 1, "invalid": 1, "error": 0
+    }
+    assert any(line["type"] == "progress" for line in lines)
+    assert not any("password" in json.dumps(line) for line in lines)
+
+
+def test_import_concurrency_is_bounded(monkeypatch):
+    rows = [{"username": f"op{i}", "email": f"op{i}@plant.io", "password": "x"} for i in range(40)]
+    provider = FakeProvider()
+    lines, _ = _run(provider, rows, monkeypatch, concurrency=5)
+    assert provider.max_in_flight == 5
+    assert lines[-1]["created"] == 40
+
+
+@pytest.mark.parametrize("body, import_format", [
+    (b"", "csv"),
+    (b'{"username": "x"}', "json"),
+    (b"[not json", "json"),
+])
+def test_parse_rows_rejects_bad_input(body, import_format):
+    with pytest.raises(HTTPException) as exc:
+        parse_rows(body, import_format)
+    assert exc.value.status_code == 400
+
+
+def test_provider_errors_never_stall_the_stream(monkeypatch):
+    import requests
+
+    class BrokenRolesProvider(FakeProvider):
+        async def assign_role(self, user_id, role):
+            raise requests.HTTPError("403 Client Error: Forbidden")
+
+    original = user_import._provision
+
+    async def provision(provider, row_number, raw):
+        if raw["username"] == "boom":
+            raise RuntimeError("fallo inesperado")
+        return await original(provider, row_number, raw)
+
+    monkeypatch.setattr(user_import, "_provision", provision)
+    monkeypatch.setattr(user_import, "_insert_batch", lambda users: len(users))
+    rows = [
+        {"username": "op1", "email": "op1@plant.io", "password": "x", "roles": "Visor"},
+        {"username": "boom", "email": "b@plant.io", "password": "x"},
+        {"username": "op3", "email": "op3@plant.io", "password": "x", "roles": "Visor"},
+    ]
+
+    async def collect():
+        stream = import_users(BrokenRolesProvider(), rows, concurrency=2)
+        return [json.loads(line) async for line in stream]
+
+    lines = asyncio.run(asyncio.wait_for(collect(), timeout=5))
+    by_user = {line["username"]: line for line in lines if line["type"] == "row"}
+    assert by_user["op1"]["status"] == "created" and by_user["op1"]["roles"] == []
+    assert "Visor" in by_user["op1"]["error"]
+    assert by_user["boom"]["status"] == "error"
+    assert lines[-1]["created"] == 2 and lines[-1]["error"] == 1